@@ -0,0 +1,83 @@
+# checks users' llm provider API keys, caching the outcome so a key isn't re-checked over the network on every click
+import hashlib
+from abc import ABC, abstractmethod
+import threading
+import time
+import requests
+
+
+class KeyCheckFailedError(ValueError):
+  # the provider couldn't be asked (network error, timeout, or an error of its own), which says nothing about the key
+  pass
+
+
+class APIKeyVerifier(ABC):
+  # one per provider. subclasses implement _check, which asks the provider whether the key is valid
+  # results are cached by a hash of the key (the key itself isn't kept): valid keys for ttl_seconds, invalid ones for
+  # negative_ttl_seconds. when the provider can't be asked, verify raises KeyCheckFailedError rather than calling the key
+  # invalid, and nothing is cached
+  def __init__(self, ttl_seconds=600, negative_ttl_seconds=60, timeout_seconds=5, session=None):
+    self.ttl_seconds = ttl_seconds
+    self.negative_ttl_seconds = negative_ttl_seconds
+    self.timeout_seconds = timeout_seconds
+    self.session = session or requests.Session() # pooled, so repeat checks reuse the kept-alive connection
+    self._results = {} # key hash -> (is valid, expiry time)
+    self._lock = threading.Lock()
+
+  def verify(self, api_key):
+    if not api_key:
+      return False
+    key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+    now = time.monotonic()
+    with self._lock:
+      cached = self._results.get(key_hash)
+    if cached and cached[1] > now:
+      return cached[0]
+
+    try:
+      valid = self._check(api_key)
+    except requests.RequestException as e:
+      raise KeyCheckFailedError("couldn't reach the provider to check the API key") from e
+    ttl = self.ttl_seconds if valid else self.negative_ttl_seconds
+    with self._lock:
+      self._results[key_hash] = (valid, now + ttl)
+    return valid
+
+  def forget(self, api_key):
+    with self._lock:
+      self._results.pop(hashlib.sha256(api_key.encode()).hexdigest(), None)
+
+  @abstractmethod
+  def _check(self, api_key):
+    # True if the provider accepts the key, False if it rejects it. raises requests.RequestException if it can't be asked
+    pass
+
+
+class HuggingFaceKeyVerifier(APIKeyVerifier):
+  def __init__(self, whoami_url='https://huggingface.co/api/whoami-v2', **kwargs):
+    super().__init__(**kwargs)
+    self.whoami_url = whoami_url # can point at a local stand-in server
+
+  def _check(self, api_key):
+    response = self.session.get(self.whoami_url, headers={"Authorization": f"Bearer {api_key}"}, timeout=self.timeout_seconds)
+    if response.status_code in (401, 403): # only an auth rejection means the key is invalid
+      return False
+    response.raise_for_status() # anything else going wrong (rate limits, server errors) isn't about the key
+    return response.status_code == 200
+
+
+verifiers = {"hf": HuggingFaceKeyVerifier()} # endpoint (as in app_config.toml [model] endpoint) -> verifier
+
+def register_verifier(endpoint, verifier):
+  verifiers[endpoint] = verifier
+
+def configure_verifiers(api_keys_config):
+  for verifier in verifiers.values():
+    verifier.ttl_seconds = api_keys_config.get('ttl_seconds', verifier.ttl_seconds)
+    verifier.negative_ttl_seconds = api_keys_config.get('negative_ttl_seconds', verifier.negative_ttl_seconds)
+    verifier.timeout_seconds = api_keys_config.get('timeout_seconds', verifier.timeout_seconds)
+
+def verify_api_key(api_key, endpoint="hf"):
+  if endpoint not in verifiers:
+    raise ValueError("invalid/unsupported endpoint given in config")
+  return verifiers[endpoint].verify(api_key)
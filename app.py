@@ -1,10 +1,11 @@
 # the home page to initially run with streamlit
 import streamlit as st
 
-st.session_state.database = None # UserDatabase, SQLiteUserDatabase, etc object
+if "database" not in st.session_state: # kept across reruns, it's only opened again when the uploads change
+  st.session_state.database = None # UserDatabase, SQLiteUserDatabase, etc object
+  st.session_state.upload_ids = ()
 
 st.session_state.db_file_bytes = None
-st.session_state.db_path = "temp/user_db.db"
 st.session_state.topics = []
 
 st.session_state.llm_api_key = None
@@ -13,14 +14,36 @@ st.session_state.llm_api_key = None
 st.session_state.quiz_question_form_elements = []
 st.session_state.user_answers = []
 st.session_state.quiz = None
+st.session_state.quiz_feedback = None
 st.session_state.submitted = False
 
-from database import SQLiteUserDatabase # at the moment, only SQLite supported :P
-from util import remove_file_if_exists, create_temp_folder
-from model import verify_api_key
-
-remove_file_if_exists(st.session_state.db_path)
-create_temp_folder()
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from database import UserDatabase, SQLiteUserDatabase, DuckDBUserDatabase, QueryLimits
+from column_profiles import ColumnProfiler
+from sessions import session_databases, SessionEnd, UploadTooLargeError
+from cache import introspection_cache
+from util import load_app_config
+from api_keys import verify_api_key, configure_verifiers, KeyCheckFailedError
+from model import quiz_llms
+from tracing import tracer
+from llm_cache import configure_response_cache
+
+st.session_state.config = load_app_config()
+session_databases.configure(st.session_state.config['database'])
+introspection_cache.path = st.session_state.config['cache']['introspection_path']
+introspection_cache.max_bytes = st.session_state.config['cache']['introspection_max_mb'] * 1024 * 1024
+configure_verifiers(st.session_state.config['api_keys'])
+tracer.configure(st.session_state.config.get('tracing', {}))
+configure_response_cache(st.session_state.config.get('llm_cache', {}))
+UserDatabase.column_profiler = ColumnProfiler(sample_rows=st.session_state.config['database'].get('profile_sample_rows', 2000),
+                                              top_k=st.session_state.config['database'].get('profile_top_values', 5))
+
+def _end_session(session_id):
+  quiz_llms.invalidate(session_id)
+  session_databases.release(session_id) # drops the session's database and any files spooled for it
+
+if "session_end" not in st.session_state:
+  st.session_state.session_end = SessionEnd(get_script_run_ctx().session_id, _end_session)
 
 st.header("SQL practice app :0")
 
@@ -56,15 +79,21 @@ def _check_topic_selection():
 
 def quiz_can_be_made():
   try:
-    if _check_topic_selection() and st.session_state.database.assert_valid_db_file() and verify_api_key(st.session_state.llm_api_key):
+    # replays never reach the endpoint, so they don't need a key
+    replaying = st.session_state.config.get('llm_cache', {}).get('mode') == "replay"
+    valid_api_key = replaying or verify_api_key(st.session_state.llm_api_key, st.session_state.config['model']['endpoint']) # cached, so checked once per key
+    if _check_topic_selection() and st.session_state.database.assert_valid_db_file() and valid_api_key:
       return True
-    elif not verify_api_key(st.session_state.llm_api_key):
+    elif not valid_api_key:
       st.toast("invalid API key entered, try again!")
     elif not _check_topic_selection():
       st.toast("you must select at least 3 topics!")
     else:
       st.toast("You must upload a valid database file, try again!")
     
+    return False
+  except KeyCheckFailedError:
+    st.toast("couldn't check your API key right now (the provider didn't respond), try again in a moment")
     return False
   except:
     return False
@@ -75,12 +104,32 @@ with st.sidebar:
   if api_key:
     st.session_state.llm_api_key = api_key
 
-  uploaded_db_file = st.file_uploader("Upload an sqlite3 .db file:", type=".db", key="db_upload")
-  if uploaded_db_file and not st.session_state.database:
-    try:
-      st.session_state.database = SQLiteUserDatabase(uploaded_db_file)
-    except:
-      st.toast("invalid database uploaded, try another file")
+  # a single .db file runs on whichever engine is set in app_config.toml, .parquet / .csv files (one per table) always use duckdb
+  uploaded_db_files = st.file_uploader("Upload an sqlite3 .db file, or .parquet / .csv files:", type=["db", "parquet", "csv"],
+                                       accept_multiple_files=True, key="db_upload")
+  # file ids are new for every upload (even of the same file), and stay the same across reruns, so the uploads are only
+  # spooled, hashed and imported again when they've actually changed
+  upload_ids = tuple(upload.file_id for upload in uploaded_db_files or [])
+  if upload_ids != st.session_state.upload_ids:
+    st.session_state.upload_ids = upload_ids
+    session_id = get_script_run_ctx().session_id
+    quiz_llms.invalidate(session_id) # anything built around this session's previous upload
+    if st.session_state.database is not None:
+      st.session_state.database.close()
+      st.session_state.database = None
+    if uploaded_db_files:
+      try:
+        limits = QueryLimits.from_config(st.session_state.config['database'])
+        only_db_file = len(uploaded_db_files) == 1 and uploaded_db_files[0].name.lower().endswith(".db")
+        if only_db_file and st.session_state.config['database'].get('engine', "sqlite") == "sqlite":
+          st.session_state.database = SQLiteUserDatabase(uploaded_db_files[0], session_id=session_id, limits=limits)
+        else:
+          with st.spinner("importing into duckdb..."):
+            st.session_state.database = DuckDBUserDatabase(uploaded_db_files, session_id=session_id, limits=limits)
+      except UploadTooLargeError as e:
+        st.toast(f"{e}, try a smaller one")
+      except:
+        st.toast("invalid database uploaded, try another file")
 
   # topic selection
   topic_selection = st.multiselect("Select SQL topics to be tested on:", options=topics)
@@ -88,7 +137,7 @@ with st.sidebar:
 
   # button to take this data and load the test page, run the model etc...
   button_clicked = st.button("Make me a quiz!",
-                             args=[uploaded_db_file, topic_selection])
+                             args=[uploaded_db_files, topic_selection])
   
   if button_clicked:
     if quiz_can_be_made():
@@ -0,0 +1 @@
+# generates and grades quizzes for many databases without the streamlit pages, run with `python -m batch` (see batch/__main__.py)
@@ -0,0 +1,77 @@
+# generates a quiz for every database in a directory (or loads them from a file), then grades a csv of student answers
+# eg: python -m batch --databases dbs/ --topics WHERE "GROUP BY" HAVING --quizzes quizzes.json --answers answers.csv --output results/
+import argparse
+import asyncio
+import os
+import sys
+
+from util import load_app_config
+from tracing import tracer
+from llm_cache import configure_response_cache
+from batch.quizzes import find_databases, load_quizzes, save_quizzes, generate_quizzes
+from batch.marking import read_submissions, grade_submissions, default_chunk_size, add_feedback
+from batch.reports import write_reports
+
+
+def main():
+  parser = argparse.ArgumentParser(prog="python -m batch", description="generate and grade sql quizzes for many databases at once")
+  parser.add_argument("--databases", required=True, help="a directory of sqlite .db files, one quiz is made for each")
+  parser.add_argument("--topics", nargs="+", help="topics to generate quizzes on (not needed when the quizzes are loaded from --quizzes)")
+  parser.add_argument("--quizzes", default="quizzes.json", help="quizzes are loaded from this file if it exists, otherwise generated and saved to it")
+  parser.add_argument("--regenerate", action="store_true", help="generate new quizzes even if --quizzes exists")
+  parser.add_argument("--num-questions", type=int, help="questions per quiz, defaults to [quiz] num_questions")
+  parser.add_argument("--answers", help="a csv with columns student, database (file name), question (from 1), answer")
+  parser.add_argument("--output", default="batch_results", help="directory for scores.csv, answers.csv and report.json")
+  parser.add_argument("--config", default="app_config.toml")
+  parser.add_argument("--api-key", default=os.environ.get("HF_TOKEN"), help="defaults to the HF_TOKEN environment variable")
+  parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes grading answers")
+  parser.add_argument("--chunk-size", type=int, help="students per grading task, by default sized to keep every worker busy")
+  parser.add_argument("--max-llm-requests", type=int, help="llm requests running at once, defaults to [quiz] max_concurrent_requests")
+  parser.add_argument("--feedback", action="store_true", help="ask the llm for feedback on each student's incorrect answers")
+  args = parser.parse_args()
+
+  config = load_app_config(args.config)
+  tracer.configure(config.get('tracing', {}))
+  configure_response_cache(config.get('llm_cache', {}))
+  max_llm_requests = args.max_llm_requests or config['quiz'].get('max_concurrent_requests', 4)
+  databases = find_databases(args.databases)
+  if not databases:
+    parser.error(f"no database files in {args.databases}")
+
+  errors = {}
+  if os.path.exists(args.quizzes) and not args.regenerate:
+    quizzes = load_quizzes(args.quizzes)
+    print(f"loaded quizzes for {len(quizzes['quizzes'])} databases from {args.quizzes}", file=sys.stderr)
+  else:
+    if not args.topics:
+      parser.error("--topics is needed to generate quizzes")
+    print(f"generating quizzes for {len(databases)} databases...", file=sys.stderr)
+    quizzes, generation_errors = asyncio.run(generate_quizzes(databases, args.topics, args.num_questions or config['quiz']['num_questions'],
+                                                              config, args.api_key, max_llm_requests))
+    errors.update({name: {"generation": error} for name, error in generation_errors.items()})
+    save_quizzes(args.quizzes, quizzes)
+    print(f"quizzes saved to {args.quizzes}", file=sys.stderr)
+
+  if not args.answers:
+    return 1 if errors else 0
+
+  submissions = read_submissions(args.answers)
+  chunk_size = args.chunk_size or default_chunk_size(submissions, args.workers)
+  print(f"grading {sum(len(students) for students in submissions.values())} submissions...", file=sys.stderr)
+  grades, grading_errors = grade_submissions(databases, quizzes['quizzes'], submissions, config, args.workers, chunk_size)
+  for name, error in grading_errors.items():
+    errors.setdefault(name, {})["grading"] = error
+
+  if args.feedback:
+    print("getting feedback on incorrect answers...", file=sys.stderr)
+    asyncio.run(add_feedback(grades, databases, quizzes['quizzes'], config, args.api_key, max_llm_requests))
+
+  scores = write_reports(args.output, grades, quizzes, errors,
+                         {"databases": args.databases, "answers": args.answers, "quizzes": args.quizzes, "workers": args.workers})
+  print(f"{len(scores)} scores written to {args.output}", file=sys.stderr)
+  for name, database_errors in errors.items():
+    print(f"error: {name}: {database_errors}", file=sys.stderr)
+  return 1 if errors else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
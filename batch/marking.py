@@ -0,0 +1,116 @@
+# grading submissions in a pool of worker processes (the database work), and asking for feedback on incorrect answers
+# in a bounded pool of async llm requests
+import asyncio
+import csv
+import math
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from batch.quizzes import open_database
+from cache import introspection_cache
+from grading import grade_answer, rule_based_feedback, aget_feedback
+from model import SQLQuizLLM
+from sessions import session_databases
+
+_worker_config = {}
+_worker_databases = {} # path -> UserDatabase, each worker process opens a database once however many chunks it grades
+
+
+def read_submissions(path):
+  # a csv of student, database, question, answer (question numbers start at 1) -> {database: {student: {question: answer}}}
+  submissions = {}
+  with open(path, newline="") as answers_file:
+    for row in csv.DictReader(answers_file):
+      student, database = row["student"].strip(), row["database"].strip()
+      submissions.setdefault(database, {}).setdefault(student, {})[int(row["question"])] = (row["answer"] or "").strip()
+  return submissions
+
+def _init_worker(config):
+  _worker_config.update(config)
+  session_databases.configure(config['database'])
+  introspection_cache.path = config['cache']['introspection_path'] # a shared sqlite file, so workers reuse each other's introspection
+
+def _worker_database(path):
+  if path not in _worker_databases:
+    _worker_databases[path] = open_database(path, _worker_config['database'])
+  return _worker_databases[path]
+
+def grade_chunk(database_name, path, quiz, students):
+  # runs in a worker process. students is [(student, {question number: answer})], returns one plain dict per answer
+  database = _worker_database(path)
+  database.prefetch_queries([question["correct_sql_answer"] for question in quiz])
+  grades = []
+  for student, answers in students:
+    for number, question in enumerate(quiz, 1):
+      answer = answers.get(number, "")
+      if answer:
+        grade = grade_answer(database, question["correct_sql_answer"], answer)
+        # an ungraded answer counts as not correct, but keeps method "ungraded" and why, so it can be checked by hand
+        correct, method, error = bool(grade.correct), grade.method, grade.comparison_error if grade.ungraded else grade.user_error
+        # worked out here, while the results are at hand, so only what the rules can't explain is left for --feedback's llm
+        feedback = (rule_based_feedback(grade, question["correct_sql_answer"], answer) or "") if grade.correct is False else ""
+      else:
+        correct, method, error, feedback = False, "missing", None, ""
+      grades.append({"student": student, "database": database_name, "question": number, "correct": bool(correct),
+                     "method": method, "error": (str(error) or type(error).__name__) if error is not None else "", "answer": answer,
+                     "feedback": feedback})
+  return grades
+
+def grade_submissions(databases, quizzes, submissions, config, workers, chunk_size):
+  # chunks of each database's students are spread across the worker processes
+  grades, errors = [], {}
+  with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config,)) as executor:
+    futures = {}
+    for database_name, students in submissions.items():
+      if database_name not in databases or database_name not in quizzes:
+        errors[database_name] = "no database file or quiz for these submissions"
+        continue
+      students = sorted(students.items())
+      for start in range(0, len(students), chunk_size):
+        future = executor.submit(grade_chunk, database_name, databases[database_name], quizzes[database_name], students[start:start + chunk_size])
+        futures[future] = database_name
+    for future in as_completed(futures):
+      try:
+        grades.extend(future.result())
+      except Exception as e:
+        errors[futures[future]] = f"{type(e).__name__}: {e}"
+      print(f"  graded {len(grades)} answers", file=sys.stderr)
+  grades.sort(key=lambda grade: (grade["database"], grade["student"], grade["question"]))
+  return grades, errors
+
+def default_chunk_size(submissions, workers):
+  # enough chunks to keep every worker busy, without reopening a database for every few students
+  num_students = sum(len(students) for students in submissions.values())
+  return max(10, math.ceil(num_students / (workers * 4)))
+
+async def add_feedback(grades, databases, quizzes, config, api_key, max_concurrent_requests):
+  # one feedback request per student and database with incorrect answers the rules couldn't explain while grading,
+  # each comment is put on the grade it's about
+  semaphore = asyncio.Semaphore(max_concurrent_requests)
+  incorrect = {}
+  for grade in grades:
+    if not grade["correct"] and grade["answer"] and grade["method"] != "ungraded" and not grade.get("feedback"):
+      incorrect.setdefault((grade["database"], grade["student"]), []).append(grade)
+
+  async def feedback_for_database(database_name, students):
+    database = await asyncio.to_thread(open_database, databases[database_name], config['database']) # off the event loop, like opening for quizzes
+    try:
+      llm = SQLQuizLLM(config, api_key, database)
+      async def feedback_for_student(student_grades):
+        quiz = quizzes[database_name]
+        async with semaphore:
+          try:
+            feedback = await aget_feedback(llm, [(quiz[grade["question"] - 1]["quiz_question"], quiz[grade["question"] - 1]["correct_sql_answer"],
+                                                  grade["answer"]) for grade in student_grades])
+          except ValueError:
+            return
+        for grade, comment in zip(student_grades, feedback.comments):
+          grade["feedback"] = comment
+      await asyncio.gather(*(feedback_for_student(student_grades) for student_grades in students))
+    finally:
+      database.close()
+
+  by_database = {}
+  for (database_name, student), student_grades in incorrect.items():
+    by_database.setdefault(database_name, []).append(student_grades)
+  await asyncio.gather(*(feedback_for_database(database_name, students) for database_name, students in by_database.items()))
@@ -0,0 +1,62 @@
+# opening the databases in a directory, and generating (or loading) a quiz for each of them
+import asyncio
+import io
+import json
+import os
+import sys
+
+from database import SQLiteUserDatabase, DuckDBUserDatabase, QueryLimits
+from model import SQLQuizLLM
+
+DATABASE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+
+def find_databases(directory):
+  # file name -> path, for every database file directly in directory
+  return {name: os.path.join(directory, name) for name in sorted(os.listdir(directory))
+          if name.lower().endswith(DATABASE_EXTENSIONS) and os.path.isfile(os.path.join(directory, name))}
+
+def open_database(path, database_config):
+  # the same engine choice as the home page makes for a .db upload
+  with open(path, "rb") as db_file:
+    db_bytes = io.BytesIO(db_file.read())
+  db_bytes.name = os.path.basename(path)
+  limits = QueryLimits.from_config(database_config)
+  if database_config.get('engine', "sqlite") == "duckdb":
+    return DuckDBUserDatabase([db_bytes], limits=limits)
+  return SQLiteUserDatabase(db_bytes, limits=limits)
+
+def load_quizzes(path):
+  with open(path) as quiz_file:
+    return json.load(quiz_file)
+
+def save_quizzes(path, quizzes):
+  # {"topics": [...], "quizzes": {database file name: [{topic, quiz_question, correct_sql_answer}, ...]}}, reusable with --quizzes
+  directory = os.path.dirname(path)
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  with open(path, "w") as quiz_file:
+    json.dump(quizzes, quiz_file, indent=2)
+
+async def generate_quizzes(databases, topics, num_questions, config, api_key, max_concurrent_requests):
+  # one quiz per database, all generated at once, with max_concurrent_requests llm requests running across all of them
+  semaphore = asyncio.Semaphore(max_concurrent_requests)
+  quizzes, errors = {}, {}
+
+  async def generate(name, path):
+    database = None
+    try:
+      database = await asyncio.to_thread(open_database, path, config['database']) # reads and loads the file, off the event loop
+      llm = SQLQuizLLM(config, api_key, database)
+      quiz = await llm.agenerate_quiz(topics, num_questions, semaphore)
+      quizzes[name] = [question.model_dump() for question in quiz]
+      print(f"  generated {len(quiz)} questions for {name}", file=sys.stderr)
+    except Exception as e:
+      errors[name] = f"{type(e).__name__}: {e}"
+      print(f"  couldn't generate a quiz for {name}: {errors[name]}", file=sys.stderr)
+    finally:
+      if database is not None:
+        database.close()
+
+  await asyncio.gather(*(generate(name, path) for name, path in databases.items()))
+  return {"topics": list(topics), "quizzes": {name: quizzes[name] for name in databases if name in quizzes}}, errors
@@ -0,0 +1,47 @@
+# score reports: a csv of scores per student, a csv of every graded answer, and a json report with both plus per-question stats
+import csv
+import json
+import os
+import time
+
+GRADE_COLUMNS = ["student", "database", "question", "correct", "method", "error", "answer", "feedback"]
+
+
+def summarise_scores(grades):
+  scores = {}
+  for grade in grades:
+    score = scores.setdefault((grade["student"], grade["database"]), {"student": grade["student"], "database": grade["database"], "score": 0, "total": 0})
+    score["score"] += grade["correct"]
+    score["total"] += 1
+  return sorted(scores.values(), key=lambda score: (score["database"], score["student"]))
+
+def summarise_questions(grades, quizzes):
+  # database -> each question with how many students got it right, the hardest questions are the interesting ones
+  summary = {}
+  for database_name, quiz in quizzes.items():
+    database_grades = [grade for grade in grades if grade["database"] == database_name]
+    questions = []
+    for number, question in enumerate(quiz, 1):
+      question_grades = [grade for grade in database_grades if grade["question"] == number]
+      questions.append({"question": number, "quiz_question": question["quiz_question"], "correct_sql_answer": question["correct_sql_answer"],
+                        "answered": sum(1 for grade in question_grades if grade["method"] != "missing"),
+                        "correct_rate": sum(grade["correct"] for grade in question_grades) / len(question_grades) if question_grades else None})
+    summary[database_name] = questions
+  return summary
+
+def write_reports(output_dir, grades, quizzes, errors, parameters):
+  os.makedirs(output_dir, exist_ok=True)
+  scores = summarise_scores(grades)
+  with open(os.path.join(output_dir, "scores.csv"), "w", newline="") as scores_file:
+    writer = csv.DictWriter(scores_file, fieldnames=["student", "database", "score", "total"])
+    writer.writeheader()
+    writer.writerows(scores)
+  with open(os.path.join(output_dir, "answers.csv"), "w", newline="") as answers_file:
+    writer = csv.DictWriter(answers_file, fieldnames=GRADE_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(grades)
+  report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "parameters": parameters, "scores": scores,
+            "questions": summarise_questions(grades, quizzes["quizzes"]), "answers": grades, "errors": errors}
+  with open(os.path.join(output_dir, "report.json"), "w") as report_file:
+    json.dump(report, report_file, indent=2)
+  return scores
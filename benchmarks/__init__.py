@@ -0,0 +1 @@
+# offline benchmarks for the app, run with `python -m benchmarks` (see benchmarks/__main__.py for the options)
@@ -0,0 +1,82 @@
+# runs the benchmark scenarios over synthetic databases and writes the timings to a JSON file
+# eg: python -m benchmarks --rows 1000 100000 --tables 3 20 --output results.json --baseline previous.json
+import argparse
+import json
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+
+from benchmarks.scenarios import SCENARIOS, Workload
+
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(rows, tables, scenarios, repeat, seed):
+  results = []
+  for num_tables in tables:
+    for total_rows in rows:
+      print(f"generating {num_tables} tables, {total_rows} rows...", file=sys.stderr)
+      with Workload(num_tables, total_rows, seed=seed, repeat=repeat) as workload: # its temporary files go once it's measured
+        for scenario in scenarios:
+          print(f"  {scenario}", file=sys.stderr)
+          start = time.perf_counter()
+          try:
+            measurements, error = SCENARIOS[scenario](workload), None
+          except Exception as e: # one broken scenario shouldn't lose the rest of the run
+            measurements, error = {}, f"{type(e).__name__}: {e}"
+          results.append({"scenario": scenario, "tables": num_tables, "rows": total_rows, "measurements": measurements,
+                          "error": error, "seconds": time.perf_counter() - start})
+  return results
+
+def find_regressions(results, baseline, threshold):
+  # measurements whose median got more than threshold times slower than the same measurement in the baseline run
+  previous = {(result["scenario"], result["tables"], result["rows"], name): timings["median"]
+              for result in baseline["results"] for name, timings in result["measurements"].items()}
+  regressions = []
+  for result in results:
+    for name, timings in result["measurements"].items():
+      key = (result["scenario"], result["tables"], result["rows"], name)
+      if key in previous and previous[key] > 0 and timings["median"] > previous[key] * threshold:
+        regressions.append({"scenario": key[0], "tables": key[1], "rows": key[2], "measurement": name,
+                            "baseline_median": previous[key], "median": timings["median"], "ratio": timings["median"] / previous[key]})
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(prog="python -m benchmarks", description="offline benchmarks over synthetic sqlite databases")
+  parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000], help="total rows per database (1k to 10M)")
+  parser.add_argument("--tables", type=int, nargs="+", default=[3, 20], help="tables per database (3 to 100)")
+  parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", default="benchmark_results.json")
+  parser.add_argument("--baseline", help="an earlier results file, to flag measurements that got slower")
+  parser.add_argument("--threshold", type=float, default=1.25, help="how many times slower counts as a regression")
+  args = parser.parse_args()
+
+  report = {
+    "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "commit": git_commit(),
+    "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform()},
+    "parameters": {"rows": args.rows, "tables": args.tables, "repeat": args.repeat, "seed": args.seed},
+    "results": run(args.rows, args.tables, args.scenarios, args.repeat, args.seed),
+  }
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      report["regressions"] = find_regressions(report["results"], json.load(baseline_file), args.threshold)
+
+  with open(args.output, "w") as output_file:
+    json.dump(report, output_file, indent=2)
+  print(f"results written to {args.output}", file=sys.stderr)
+  for regression in report.get("regressions", []):
+    print(f"regression: {regression['scenario']}/{regression['measurement']} ({regression['tables']} tables, {regression['rows']} rows) "
+          f"{regression['ratio']:.2f}x slower", file=sys.stderr)
+  return 1 if report.get("regressions") else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
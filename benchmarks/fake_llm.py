@@ -0,0 +1,106 @@
+# an offline stand-in for the quiz model: answers the app's prompts with valid, deterministic JSON, optionally paced
+# like a real endpoint, so generation and feedback can be benchmarked without an API key or network
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from model import register_model_builder
+from api_keys import APIKeyVerifier, register_verifier
+
+ANSWER_TEMPLATES = [
+  "SELECT COUNT(*) FROM {table};",
+  "SELECT * FROM {table} LIMIT {number};",
+  "SELECT * FROM {table} WHERE rowid > {number};",
+  "SELECT * FROM {table} ORDER BY rowid DESC LIMIT {number};",
+  "DELETE FROM {table} WHERE rowid = {number};",
+]
+
+
+class FakeQuizChatModel(BaseChatModel):
+  latency_seconds: float = 0.0 # before the first token
+  tokens_per_second: float = 0.0 # 0 sends the whole response at once
+  invalid_answer_rate: float = 0.0 # fraction of answers that reference a table that doesn't exist, to exercise repairs
+  seed: int = 0
+  calls: int = 0
+
+  @property
+  def _llm_type(self):
+    return "fake-quiz"
+
+  def respond(self, prompt):
+    self.calls += 1
+    rng = random.Random(f"{self.seed}:{self.calls}:{hashlib.sha256(prompt.encode()).hexdigest()}")
+    if "marking an SQL quiz" in prompt:
+      num_comments = prompt.count("Question:")
+      return json.dumps({"comments": [f"comment {i + 1}" for i in range(num_comments)]})
+
+    tables = re.findall(r'CREATE TABLE (?:IF NOT EXISTS )?["`\[]?(\w+)', prompt, re.IGNORECASE) or ["missing_table"]
+    topics = re.search(r"in their functionality: \[(.*?)\]", prompt)
+    topics = [topic.strip(" '\"") for topic in topics.group(1).split(",")] if topics else re.findall(r"^Topic: (.*)$", prompt, re.MULTILINE)
+    num_questions = re.search(r"(?:quiz, with|fixing) (\d+) question", prompt)
+    num_questions = int(num_questions.group(1)) if num_questions else 1
+
+    questions = []
+    for i in range(num_questions):
+      table = rng.choice(tables) if rng.random() >= self.invalid_answer_rate else "no_such_table"
+      answer = rng.choice(ANSWER_TEMPLATES).format(table=table, number=rng.randrange(1, 50))
+      questions.append({"topic": topics[i % len(topics)] if topics else "",
+                        "quiz_question": f"Question {self.calls}.{i + 1} about {table}",
+                        "correct_sql_answer": answer})
+    return json.dumps({"questions_and_answers": questions})
+
+  def _chunks(self, text):
+    size = 16 # about 4 tokens
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+  def _chunk_delay(self):
+    return 4 / self.tokens_per_second if self.tokens_per_second else 0
+
+  def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+    text = self.respond(messages[-1].content)
+    time.sleep(self.latency_seconds + self._chunk_delay() * len(self._chunks(text)))
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+  async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+    text = self.respond(messages[-1].content)
+    await asyncio.sleep(self.latency_seconds + self._chunk_delay() * len(self._chunks(text)))
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+  def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+    text = self.respond(messages[-1].content)
+    time.sleep(self.latency_seconds)
+    for chunk in self._chunks(text):
+      time.sleep(self._chunk_delay())
+      yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+  async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+    text = self.respond(messages[-1].content)
+    await asyncio.sleep(self.latency_seconds)
+    for chunk in self._chunks(text):
+      await asyncio.sleep(self._chunk_delay())
+      yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+
+class AcceptAnyKeyVerifier(APIKeyVerifier):
+  def _check(self, api_key):
+    return True
+
+
+def build_fake_model(model_config, api_key):
+  return FakeQuizChatModel(latency_seconds=model_config.get('latency_seconds', 0.0),
+                           tokens_per_second=model_config.get('tokens_per_second', 0.0),
+                           invalid_answer_rate=model_config.get('invalid_answer_rate', 0.0),
+                           seed=model_config.get('seed', 0))
+
+def register_fake_endpoint(endpoint="fake"):
+  # after this, a config with [model] endpoint = "fake" builds a FakeQuizChatModel through the usual SQLQuizLLM.set_model
+  register_model_builder(endpoint, build_fake_model)
+  register_verifier(endpoint, AcceptAnyKeyVerifier())
@@ -0,0 +1,171 @@
+# the benchmarked scenarios. each takes a Workload and returns {measurement name: timings}, timings from measure()
+import io
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import DiskCache
+from database import SQLiteUserDatabase, QueryLimits
+from grading import grade_answer
+from sessions import SessionDatabaseManager
+from model import SQLQuizLLM
+from prompt_context import PromptContextBuilder
+from benchmarks.synthetic_db import generate_database, table_name
+from benchmarks.fake_llm import register_fake_endpoint
+
+TOPICS = ["WHERE", "GROUP BY", "Joins (INNER, LEFT, RIGHT, OUTER)", "Self-Joins", "Text-matching (LIKE)", "BETWEEN"]
+
+
+def measure(run, repeat=5):
+  # runs run() repeat times and returns timings in seconds
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    run()
+    times.append(time.perf_counter() - start)
+  return {"runs": repeat, "min": min(times), "median": statistics.median(times), "mean": statistics.fmean(times), "max": max(times)}
+
+
+class Workload:
+  # one synthetic database, and everything the scenarios need to open it the way the app does
+  # used as a context manager: the caches (and any spilled uploads) go in a temporary directory that's removed on exit,
+  # unless a work_dir is given, and the sessions opened in the manager are released
+  def __init__(self, num_tables, total_rows, seed=0, repeat=5, work_dir=None):
+    self.num_tables = num_tables
+    self.total_rows = total_rows
+    self.seed = seed
+    self.repeat = repeat
+    self._temp_dir = tempfile.TemporaryDirectory(prefix="sql-quiz-benchmark-") if work_dir is None else None
+    self.work_dir = work_dir or self._temp_dir.name
+    self.db_bytes = generate_database(num_tables, total_rows, seed)
+    self.manager = SessionDatabaseManager(memory_budget=16 * 1024 * 1024 * 1024, spool_dir=os.path.join(self.work_dir, "uploads"))
+    self._session_ids = set()
+    self._next_cache = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    for session_id in self._session_ids:
+      self.manager.release(session_id)
+    self._session_ids.clear()
+    if self._temp_dir is not None:
+      self._temp_dir.cleanup()
+
+  def new_cache(self):
+    self._next_cache += 1
+    return DiskCache(os.path.join(self.work_dir, f"introspection_{self._next_cache}.db"))
+
+  def open_database(self, session_id="benchmark", cache=None):
+    self._session_ids.add(session_id)
+    return SQLiteUserDatabase(io.BytesIO(self.db_bytes.getbuffer()), session_id=session_id, manager=self.manager,
+                              limits=QueryLimits(timeout_seconds=0), cache=cache if cache is not None else self.new_cache())
+
+  def config(self, **model_config):
+    return {"model": {"endpoint": "fake", "repo_id": "fake/quiz", "provider": "offline", **model_config},
+            "quiz": {"num_questions": 5, "questions_per_request": 2, "max_concurrent_requests": 4},
+            "prompt": {"context_token_budget": 3000, "max_value_chars": 40}}
+
+
+def upload(workload):
+  # a first upload does every check and introspection query, a repeat upload of the same file is served from the cache
+  warm_cache = workload.new_cache()
+  workload.open_database(cache=warm_cache)
+  return {"cold": measure(lambda: workload.open_database(), workload.repeat),
+          "warm": measure(lambda: workload.open_database(cache=warm_cache), workload.repeat)}
+
+def introspection(workload):
+  database = workload.open_database()
+  def profile():
+    database._column_profiles = None
+    database.cache = workload.new_cache()
+    database.get_column_profiles()
+  builder = PromptContextBuilder()
+  def build_context():
+    builder._built.clear()
+    builder.build(database, TOPICS[:3])
+  return {"table_info": measure(database.get_table_info, workload.repeat),
+          "column_profiles": measure(profile, workload.repeat),
+          "prompt_context": measure(build_context, workload.repeat)}
+
+def quiz_generation(workload, latency_seconds=0.05, tokens_per_second=400):
+  # the fake model is paced like a (fast) real endpoint, so this shows what concurrent, streamed generation saves
+  register_fake_endpoint()
+  database = workload.open_database()
+  results = {}
+  for name, model_config in {"no_latency": {}, "paced": {"latency_seconds": latency_seconds, "tokens_per_second": tokens_per_second},
+                             "paced_with_repairs": {"latency_seconds": latency_seconds, "tokens_per_second": tokens_per_second,
+                                                    "invalid_answer_rate": 0.3}}.items():
+    llm = SQLQuizLLM(workload.config(**model_config), "offline", database)
+    first_question = []
+    def generate():
+      start = time.perf_counter()
+      first_question.clear()
+      llm.generate_quiz_concurrently(TOPICS[:3], on_question=lambda question: first_question.append(time.perf_counter() - start) if not first_question else None)
+    results[name] = measure(generate, workload.repeat)
+    results[name]["first_question"] = first_question[0] if first_question else None
+  return results
+
+def grading(workload):
+  # grade_answer, as pages/quiz.py and the batch CLI mark answers: canonical forms first, then fingerprints, then the
+  # in-database comparison when they don't match. results are cleared each time, so every answer is run
+  database = workload.open_database()
+  table = table_name(0)
+  pairs = {
+    "identical": (f"SELECT id, name FROM {table} WHERE quantity > 50;", f"SELECT id, name FROM {table} WHERE quantity > 50;"),
+    "rewritten": (f"SELECT id, name FROM {table} WHERE quantity > 50;", f'select t.ID, t."name" from {table} t where 50 < t.quantity'),
+    "equivalent": (f"SELECT id, name FROM {table} WHERE quantity > 50;", f"SELECT id, name FROM {table} WHERE NOT quantity <= 50;"),
+    "different": (f"SELECT id, name FROM {table} WHERE quantity > 50;", f"SELECT id, name FROM {table} WHERE quantity > 49;"),
+    "ordered": (f"SELECT id FROM {table} ORDER BY amount;", f"SELECT id FROM {table} ORDER BY amount DESC;"),
+    "aggregate": (f"SELECT category, COUNT(*) FROM {table} GROUP BY category;", f"SELECT category, COUNT(id) FROM {table} GROUP BY 1;"),
+  }
+  def mark(model_answer, user_answer):
+    database._result_cache.clear()
+    return grade_answer(database, model_answer, user_answer).correct
+  return {name: measure(lambda pair=pair: mark(*pair), workload.repeat) for name, pair in pairs.items()}
+
+def sandboxing(workload):
+  database = workload.open_database()
+  table, last_table = table_name(0), table_name(workload.num_tables - 1)
+  queries = {
+    "update_one_row": f"UPDATE {table} SET quantity = 0 WHERE id = 1;",
+    "update_many_rows": f"UPDATE {table} SET quantity = quantity + 1 WHERE category = 'red';",
+    "delete_many_rows": f"DELETE FROM {last_table} WHERE quantity < 10;",
+    "insert_row": f"INSERT INTO {table} (name, category, amount, quantity) VALUES ('new', 'red', 1.0, 1);",
+    "create_table": "CREATE TABLE benchmark_new (id INTEGER PRIMARY KEY, name TEXT NOT NULL);",
+    "create_index": f"CREATE INDEX benchmark_amount ON {table}(amount);",
+    "alter_table": f"ALTER TABLE {table} ADD COLUMN benchmark_flag INTEGER;",
+    "create_view": f"CREATE VIEW benchmark_view AS SELECT category, SUM(amount) FROM {table} GROUP BY category;",
+  }
+  return {name: measure(lambda query=query: database.execute_query(query), workload.repeat) for name, query in queries.items()}
+
+def concurrent_sessions(workload, num_sessions=8, queries_per_session=20):
+  # several sessions, each on its own in-memory copy, running queries at the same time from a thread pool like streamlit's
+  table = table_name(0)
+  databases = [workload.open_database(session_id=f"benchmark-{i}") for i in range(num_sessions)]
+  query = f"SELECT category, AVG(amount) FROM {table} WHERE quantity BETWEEN 10 AND 60 GROUP BY category;"
+  def session_work(database):
+    for _ in range(queries_per_session):
+      database.execute_query(query)
+  def run_all():
+    with ThreadPoolExecutor(max_workers=num_sessions) as executor:
+      list(executor.map(session_work, databases))
+  timings = measure(run_all, workload.repeat)
+  timings["queries_per_second"] = num_sessions * queries_per_session / timings["median"]
+  timings["memory_in_use_bytes"] = workload.manager.memory_in_use()
+  return {f"{num_sessions}_sessions": timings}
+
+
+SCENARIOS = {
+  "upload": upload,
+  "introspection": introspection,
+  "quiz_generation": quiz_generation,
+  "grading": grading,
+  "sandboxing": sandboxing,
+  "concurrent_sessions": concurrent_sessions,
+}
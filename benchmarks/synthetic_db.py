@@ -0,0 +1,74 @@
+# generates sqlite databases of a chosen size and shape for benchmarking, the same every time for the same arguments
+import io
+import os
+import random
+import sqlite3
+import tempfile
+
+CATEGORIES = ["red", "orange", "yellow", "green", "blue", "indigo", "violet", "black", "white", "grey"]
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet", "kilo", "lima"]
+
+
+def table_name(i):
+  return f"table_{i}"
+
+def create_statement(i):
+  # every table past the first references the one before it, and every fifth also references itself, so joins and
+  # self-joins have something to work with
+  columns = ["id INTEGER PRIMARY KEY", "name TEXT NOT NULL", "category TEXT", "amount REAL", "quantity INTEGER", "created TEXT", "notes TEXT"]
+  if i > 0:
+    columns.append(f"{table_name(i - 1)}_id INTEGER REFERENCES {table_name(i - 1)}(id)")
+  if i % 5 == 4:
+    columns.append(f"parent_id INTEGER REFERENCES {table_name(i)}(id)")
+  return f"CREATE TABLE {table_name(i)} ({', '.join(columns)});"
+
+def generate_rows(rng, i, num_rows, previous_rows):
+  for row_id in range(1, num_rows + 1):
+    row = [row_id,
+           f"{rng.choice(WORDS)} {row_id}",
+           rng.choice(CATEGORIES) if rng.random() > 0.05 else None,
+           round(rng.lognormvariate(3, 1), 2),
+           rng.randrange(1, 100),
+           f"20{rng.randrange(10, 26)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+           " ".join(rng.choice(WORDS) for _ in range(rng.randrange(0, 12))) or None]
+    if i > 0:
+      row.append(rng.randrange(1, previous_rows + 1))
+    if i % 5 == 4:
+      row.append(rng.randrange(1, row_id) if row_id > 1 and rng.random() > 0.2 else None)
+    yield row
+
+def write_database(path, num_tables=3, total_rows=1000, seed=0, views=True):
+  # total_rows is shared out evenly between the tables (each gets at least 4, the app's minimum)
+  if num_tables < 3:
+    raise ValueError("the app needs at least 3 tables")
+  rng = random.Random(seed)
+  rows_per_table = max(4, total_rows // num_tables)
+  if os.path.exists(path):
+    os.remove(path)
+  conn = sqlite3.connect(path)
+  try:
+    conn.execute("PRAGMA journal_mode=OFF;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    for i in range(num_tables):
+      conn.execute(create_statement(i))
+      num_columns = 7 + (i > 0) + (i % 5 == 4)
+      conn.executemany(f"INSERT INTO {table_name(i)} VALUES ({', '.join('?' * num_columns)});",
+                       generate_rows(rng, i, rows_per_table, rows_per_table))
+      conn.execute(f"CREATE INDEX {table_name(i)}_category ON {table_name(i)}(category);")
+    if views:
+      conn.execute(f"CREATE VIEW expensive AS SELECT id, name, amount FROM {table_name(0)} WHERE amount > 50;")
+    conn.commit()
+  finally:
+    conn.close()
+  return path
+
+def generate_database(num_tables=3, total_rows=1000, seed=0):
+  # as a BytesIO, like a streamlit upload
+  handle, path = tempfile.mkstemp(suffix=".db")
+  os.close(handle)
+  try:
+    write_database(path, num_tables, total_rows, seed)
+    with open(path, "rb") as db_file:
+      return io.BytesIO(db_file.read())
+  finally:
+    os.remove(path)
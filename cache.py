@@ -0,0 +1,118 @@
+# caches: on-disk ones are kept in sqlite files so they survive restarts and can be shared between worker processes,
+# in-memory ones hold live objects for the lifetime of the process
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class DiskCache:
+  # key -> pickled value. once the stored values go over max_bytes, the least recently used entries are evicted
+  # entries older than ttl_seconds (if set) are treated as missing. the file is only opened on first use
+  def __init__(self, path, max_bytes=64 * 1024 * 1024, ttl_seconds=0):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.ttl_seconds = ttl_seconds
+    self._conn = None
+    self._lock = threading.Lock()
+
+  def _connection(self):
+    if self._conn is None:
+      directory = os.path.dirname(self.path)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+      self._conn.execute("PRAGMA journal_mode=WAL;")
+      self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL);""")
+    return self._conn
+
+  def get(self, key, default=None):
+    with self._lock:
+      conn = self._connection()
+      row = conn.execute("SELECT value, created FROM entries WHERE key = ?;", (key,)).fetchone()
+      if row is None:
+        return default
+      value, created = row
+      now = time.time()
+      if self.ttl_seconds and created < now - self.ttl_seconds:
+        conn.execute("DELETE FROM entries WHERE key = ?;", (key,))
+        return default
+      conn.execute("UPDATE entries SET last_used = ? WHERE key = ?;", (now, key))
+    try:
+      return pickle.loads(value)
+    except Exception: # written by an older version of the app, treat it as a miss
+      self.delete(key)
+      return default
+
+  def set(self, key, value):
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if self.max_bytes and len(data) > self.max_bytes:
+      return # would evict everything else and still not fit
+    now = time.time()
+    with self._lock:
+      conn = self._connection()
+      conn.execute("INSERT OR REPLACE INTO entries (key, value, size, created, last_used) VALUES (?, ?, ?, ?, ?);",
+                   (key, data, len(data), now, now))
+      self._evict(conn)
+
+  def __contains__(self, key):
+    return self.get(key, None) is not None
+
+  def delete(self, key):
+    with self._lock:
+      self._connection().execute("DELETE FROM entries WHERE key = ?;", (key,))
+
+  def clear(self):
+    with self._lock:
+      self._connection().execute("DELETE FROM entries;")
+
+  def size(self):
+    with self._lock:
+      return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM entries;").fetchone()[0]
+
+  def _evict(self, conn):
+    if not self.max_bytes:
+      return
+    # keeps the most recently used entries that fit within max_bytes, and drops the rest
+    conn.execute("""DELETE FROM entries WHERE key IN (
+      SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, rowid DESC) AS running_size FROM entries)
+      WHERE running_size > ?);""", (self.max_bytes,))
+
+
+class ResourceCache:
+  # in-memory, least recently used first, for objects that are expensive to build but can't be pickled (eg model clients)
+  # bounded by number of entries. keys are tuples, so entries can be invalidated by any part of their key
+  def __init__(self, max_size=32):
+    self.max_size = max_size
+    self._resources = OrderedDict()
+    self._lock = threading.RLock()
+
+  def get_or_create(self, key, create):
+    with self._lock:
+      if key in self._resources:
+        self._resources.move_to_end(key)
+        return self._resources[key]
+      resource = create()
+      self._resources[key] = resource
+      while len(self._resources) > self.max_size:
+        self._resources.popitem(last=False)
+      return resource
+
+  def invalidate(self, matches=None):
+    # drops every entry whose key contains matches, or everything if it isn't given
+    with self._lock:
+      for key in list(self._resources):
+        if matches is None or matches in key:
+          del self._resources[key]
+
+  def __len__(self):
+    return len(self._resources)
+
+
+# schema, tables, row-count checks and sample rows of uploaded databases, keyed by a sha-256 of the upload
+introspection_cache = DiskCache("cache/introspection.db")
+# chat model responses, keyed by a hash of the model config and prompt, see llm_cache.py
+llm_response_cache = DiskCache("cache/llm_responses.db", ttl_seconds=24 * 60 * 60)
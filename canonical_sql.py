@@ -0,0 +1,124 @@
+# canonical forms of sql queries, so answers that are written differently but are structurally the same query (whitespace,
+# keyword case, identifier quoting and case, the order of commutative predicates, redundant aliases) can be matched without
+# running them. also gives results a cache key that's the same for every way of writing a query
+from functools import lru_cache
+import sqlglot
+from sqlglot import exp
+from sqlglot.tokens import TokenType
+
+DIALECTS = {"SQLite": "sqlite", "DuckDB": "duckdb"} # UserDatabase.rdbms -> sqlglot dialect
+COMMUTATIVE = (exp.EQ, exp.NEQ, exp.NullSafeEQ, exp.NullSafeNEQ)
+FLIPPED = {exp.GT: exp.LT, exp.LT: exp.GT, exp.GTE: exp.LTE, exp.LTE: exp.GTE} # a > b is b < a
+
+
+def canonical_query(query, rdbms="SQLite", schema_names=frozenset()):
+  # None for anything that doesn't parse as a single statement, which then just isn't matched. schema_names are the
+  # (lowercased) table and column names of the database, see UserDatabase.schema_names
+  return _canonical_query(query, DIALECTS.get(rdbms, rdbms.lower()), frozenset(schema_names))
+
+@lru_cache(maxsize=4096) # model answers are canonicalised again for every student who answers that question
+def _canonical_query(query, dialect, schema_names):
+  try:
+    statements = [statement for statement in sqlglot.parse(query, read=dialect) if statement is not None]
+  except sqlglot.errors.SqlglotError:
+    return None
+  if len(statements) != 1:
+    return None
+  expression = statements[0]
+  if isinstance(expression, exp.Command): # sqlglot's fallback for statements it doesn't understand
+    return None
+  expression = _unalias_tables(expression)
+  expression = expression.transform(lambda node: _normalise_names(node, schema_names)).transform(_normalise_order)
+  return expression.sql(dialect=dialect)
+
+def same_query(model_query, user_query, rdbms="SQLite", schema_names=frozenset()):
+  dialect = DIALECTS.get(rdbms, rdbms.lower())
+  model_tokens = _tokens(model_query, dialect)
+  if model_tokens is not None and model_tokens == _tokens(user_query, dialect): # only whitespace between them
+    return True
+  model_canonical = canonical_query(model_query, rdbms, schema_names)
+  return model_canonical is not None and model_canonical == canonical_query(user_query, rdbms, schema_names)
+
+def canonical_definition(sql, rdbms="SQLite", schema_names=frozenset()):
+  # for a schema object's CREATE statement: its canonical form, or for statements sqlglot can't parse (eg triggers) its
+  # tokens, with keywords and schema names in lower case. string literals (and sqlite's double-quoted strings) stay as written
+  canonical = canonical_query(sql, rdbms, schema_names)
+  if canonical is not None:
+    return canonical
+  tokens = _tokens(sql, DIALECTS.get(rdbms, rdbms.lower()))
+  if tokens is None:
+    return " ".join(sql.split())
+  return " ".join("'" + text.replace("'", "''") + "'" if token_type == TokenType.STRING
+                  else text if token_type == TokenType.IDENTIFIER and text.lower() not in schema_names
+                  else text.lower() for token_type, text in tokens)
+
+def _tokens(query, dialect):
+  # compared token by token rather than with the whitespace collapsed, which would change what's inside string literals
+  try:
+    return [(token.token_type, token.text) for token in sqlglot.tokenize(query, read=dialect)]
+  except sqlglot.errors.SqlglotError:
+    return None
+
+def _normalise_names(node, schema_names):
+  if isinstance(node, exp.Identifier):
+    # sqlite and duckdb both match identifiers case-insensitively, quoted or not. but sqlite reads a double-quoted name
+    # that isn't a table or column as a string ("Bob"), whose case matters, so those are left exactly as written
+    if node.quoted and node.name.lower() not in schema_names:
+      return node
+    return exp.Identifier(this=node.name.lower(), quoted=False)
+  if isinstance(node, exp.Alias) and isinstance(node.this, exp.Column) and node.alias.lower() == node.this.name.lower():
+    return node.this # SELECT name AS name
+  return node
+
+def _normalise_order(node):
+  # operands are put in order by their own (already normalised) sql, so however they were written they end up the same
+  # UPDATE ... SET a = 1 (or ON CONFLICT ... DO UPDATE SET a = 1) is an assignment, not a comparison
+  if isinstance(node, COMMUTATIVE) and not isinstance(node.parent, (exp.Update, exp.OnConflict)):
+    left, right = sorted((node.left.transform(_normalise_order), node.right.transform(_normalise_order)), key=lambda side: side.sql())
+    return node.__class__(this=left, expression=right)
+  if type(node) in FLIPPED:
+    left, right = node.left.transform(_normalise_order), node.right.transform(_normalise_order)
+    return FLIPPED[type(node)](this=right, expression=left) if right.sql() < left.sql() else node.__class__(this=left, expression=right)
+  if isinstance(node, (exp.And, exp.Or)) and not isinstance(node.parent, node.__class__):
+    # the whole chain of ANDs (or ORs), in brackets or not, bracketed parts of any other kind staying as they are
+    operands = sorted((operand.transform(_normalise_order) for operand in _chain_operands(node)), key=lambda operand: operand.sql())
+    chain = operands[0]
+    for operand in operands[1:]:
+      chain = node.__class__(this=chain, expression=operand)
+    return chain
+  return node
+
+def _chain_operands(node):
+  for operand in node.flatten(unnest=False):
+    if isinstance(operand, exp.Paren) and isinstance(operand.this, node.__class__):
+      yield from _chain_operands(operand.this)
+    else:
+      yield operand
+
+def _unalias_tables(expression):
+  # FROM students s WHERE s.age > 20 -> FROM students WHERE students.age > 20, and with a single table, no qualifiers at
+  # all. only for queries without subqueries or CTEs where each table appears once, where it can't change what a column means
+  if expression.find(exp.Subquery, exp.With) is not None or len(list(expression.find_all(exp.Select))) > 1:
+    return expression
+  tables = list(expression.find_all(exp.Table))
+  names = [table.name.lower() for table in tables]
+  if not tables or len(set(names)) != len(names):
+    return expression
+  # a table with an alias can only be referred to by its alias, so each qualifier names exactly one table. the map is
+  # built in one pass over the original names (FROM a AS b JOIN b AS a swaps them), and if a qualifier could mean
+  # two tables the query is left alone
+  qualifiers = {}
+  for table in tables:
+    qualifier = (table.alias or table.name).lower()
+    if qualifier in qualifiers:
+      return expression
+    qualifiers[qualifier] = table.name
+  columns = list(expression.find_all(exp.Column))
+  if any(column.table and column.table.lower() not in qualifiers for column in columns):
+    return expression # eg a table referred to by its name after being given an alias, which doesn't run
+  for table in tables:
+    table.set("alias", None)
+  for column in columns:
+    if column.table:
+      column.set("table", None if len(tables) == 1 else exp.to_identifier(qualifiers[column.table.lower()]))
+  return expression
@@ -0,0 +1,137 @@
+# per-column statistics worked out from a sample of each table, so questions can be written against values that actually occur
+import math
+from collections import Counter
+
+from tracing import tracer
+
+
+class ColumnProfile:
+  # everything here is estimated from the sampled rows, apart from row_count on tables small enough to read in full
+  def __init__(self, table, column, sampled_rows, row_count, null_ratio, approx_distinct, min_value, max_value, top_values):
+    self.table = table
+    self.column = column
+    self.sampled_rows = sampled_rows
+    self.row_count = row_count # estimated rows in the whole table
+    self.null_ratio = null_ratio
+    self.approx_distinct = approx_distinct
+    self.min_value = min_value
+    self.max_value = max_value
+    self.top_values = top_values # [(value, count in the sample)], most frequent first
+
+  def __repr__(self):
+    return (f"ColumnProfile({self.table}.{self.column}, nulls={self.null_ratio:.0%}, distinct~{self.approx_distinct}, "
+            f"range={self.min_value!r}..{self.max_value!r}, top={self.top_values})")
+
+
+class JoinProfile:
+  # how a foreign key column joins to the table it references
+  def __init__(self, table, column, references_table, references_column, matched_ratio, avg_fanout):
+    self.table = table
+    self.column = column
+    self.references_table = references_table
+    self.references_column = references_column
+    self.matched_ratio = matched_ratio # of the sampled non-null keys, the fraction with a row to join to
+    self.avg_fanout = avg_fanout # estimated rows in table per distinct key, ie rows each referenced row joins with
+
+  def __repr__(self):
+    return (f"JoinProfile({self.table}.{self.column} -> {self.references_table}.{self.references_column}, "
+            f"matched={self.matched_ratio:.0%}, fanout~{self.avg_fanout:.1f})")
+
+
+class TableProfile:
+  def __init__(self, table, row_count, columns, joins):
+    self.table = table
+    self.row_count = row_count
+    self.columns = columns # column name -> ColumnProfile
+    self.joins = joins # [JoinProfile], one per foreign key
+
+
+def estimate_distinct(values, row_count):
+  # GEE estimator (Charikar et al.): values seen once in the sample stand in for the many unseen ones, scaled by how much
+  # of the table was sampled. exact when the sample is the whole table
+  counts = Counter(values)
+  if not values or len(values) >= row_count:
+    return len(counts)
+  frequency_of_frequencies = Counter(counts.values())
+  seen_once = frequency_of_frequencies.get(1, 0)
+  if seen_once == len(values): # nothing repeated at all, most likely a unique column (where GEE badly underestimates)
+    return row_count
+  estimate = math.sqrt(row_count / len(values)) * seen_once + sum(f for count, f in frequency_of_frequencies.items() if count > 1)
+  return max(len(counts), min(round(estimate), row_count))
+
+
+def _comparable_range(values):
+  # min/max over values that can be compared with each other, sqlite columns can mix types
+  for kind in ((int, float), (str,), (bytes,)):
+    of_kind = [value for value in values if isinstance(value, kind) and not isinstance(value, bool)]
+    if of_kind:
+      return min(of_kind), max(of_kind)
+  return None, None
+
+
+class ColumnProfiler:
+  # sample_rows bounds the rows read per table, whatever the table's size. how they are picked is up to the database
+  # (UserDatabase.sample_table_rows), SQLite reads short runs of rows from random points across the rowid range
+  def __init__(self, sample_rows=2000, top_k=5, max_key_probes=200):
+    self.sample_rows = sample_rows
+    self.top_k = top_k
+    self.max_key_probes = max_key_probes # distinct sampled foreign key values checked against the referenced table
+
+  def profile(self, database):
+    with tracer.span("introspection.column_profiles", tables=len(database.tables), sample_rows=self.sample_rows):
+      return self._profile(database)
+
+  def _profile(self, database):
+    profiles = {}
+    samples = {}
+    for table in database.tables:
+      try:
+        samples[table] = database.sample_table_rows(table, self.sample_rows)
+      except ValueError: # too slow to sample within the query limits, the table is just left unprofiled
+        continue
+      profiles[table] = self._profile_table(table, *samples[table])
+
+    for table, profile in profiles.items():
+      columns, rows, _ = samples[table]
+      for foreign_key in database.table_info.get(table, {}).get("foreign_keys", []):
+        if foreign_key["column"] not in columns:
+          continue
+        i = columns.index(foreign_key["column"])
+        join = self._profile_join(database, profile, foreign_key, [row[i] for row in rows])
+        if join:
+          profile.joins.append(join)
+    return profiles
+
+  def _profile_table(self, table, columns, rows, row_count):
+    column_profiles = {}
+    for i, column in enumerate(columns):
+      values = [row[i] for row in rows]
+      non_null = [value for value in values if value is not None]
+      min_value, max_value = _comparable_range(non_null)
+      hashable = [value for value in non_null if not isinstance(value, bytes)]
+      column_profiles[column] = ColumnProfile(
+        table, column, len(rows), row_count,
+        null_ratio=(len(values) - len(non_null)) / len(values) if values else 0.0,
+        approx_distinct=estimate_distinct(hashable, round(row_count * len(non_null) / len(values)) if values else 0),
+        min_value=min_value, max_value=max_value,
+        top_values=Counter(hashable).most_common(self.top_k))
+    return TableProfile(table, row_count, column_profiles, [])
+
+  def _profile_join(self, database, profile, foreign_key, sampled_values):
+    column = profile.columns[foreign_key["column"]]
+    sampled_keys = list(dict.fromkeys(value for value in sampled_values if value is not None))[:self.max_key_probes]
+    if not sampled_keys or foreign_key["references_table"] not in database.tables:
+      return None
+    references_column = foreign_key["references_column"] or self._primary_key(database, foreign_key["references_table"])
+    try:
+      matched = database.count_matching_keys(foreign_key["references_table"], references_column, sampled_keys)
+    except ValueError:
+      return None
+    non_null_rows = column.row_count * (1 - column.null_ratio)
+    return JoinProfile(profile.table, foreign_key["column"], foreign_key["references_table"], references_column,
+                       matched_ratio=matched / len(sampled_keys), avg_fanout=non_null_rows / max(column.approx_distinct, 1))
+
+  def _primary_key(self, database, table):
+    # a foreign key to a table's primary key can leave the column out
+    columns = database.table_info.get(table, {}).get("columns", [])
+    return next((column["name"] for column in columns if column["primary_key"]), "rowid")
@@ -1,6 +1,24 @@
 # handles database interaction
 from sqlalchemy import create_engine, text, event
-import sqlite3
+import sqlglot
+from sqlglot import exp
+from contextlib import contextmanager
+import threading
+import hashlib
+import random
+import time
+import math
+import re
+from collections import Counter, OrderedDict
+
+from sessions import session_databases, new_session_id
+from cache import introspection_cache
+from util import hash_file_bytes
+from column_profiles import ColumnProfiler
+from tracing import tracer
+from canonical_sql import canonical_query, canonical_definition
+
+RESULT_CACHE_SIZE = 256 # query results memoised per database, model answers and (in grading) every distinct answer
 
 def valid_sql_query(query):
   first_word = query.split()[0].upper()
@@ -8,20 +26,212 @@ def valid_sql_query(query):
     return True
   return False
 
+def query_command(query):
+  # the statement's verb. a WITH can lead into a DELETE, INSERT or UPDATE as well as a SELECT, so those are parsed to find
+  # out which, otherwise they would be run as reads, outside any sandbox
+  command = query.split()[0].upper()
+  if command != "WITH":
+    return command
+  try:
+    statement = sqlglot.parse_one(query, read="sqlite")
+  except sqlglot.errors.SqlglotError:
+    return command # read as a SELECT, and reads can't write (see SQLiteUserDatabase.read_connection)
+  return {exp.Delete: "DELETE", exp.Insert: "INSERT", exp.Update: "UPDATE"}.get(type(statement), command)
+
+def is_select_query(query):
+  return query_command(query) in ('SELECT', 'WITH')
+
+def query_has_order_by(query):
+  # rough check, but only used to decide whether row order should matter when marking
+  return re.search(r'\bORDER\s+BY\b', query, re.IGNORECASE) is not None
+
+def quote_identifier(name):
+  # for table and column names taken from the database's catalog, which can have spaces or punctuation in them
+  return '"' + name.replace('"', '""') + '"'
+
+def _strip_terminator(query):
+  return query.strip().rstrip(';').strip()
+
+
+def _plain_rows(result):
+  return QueryResult([tuple(row) for row in result], getattr(result, "columns", ()), getattr(result, "truncated", False))
+
+
+class QueryCancelledError(ValueError):
+  # a query that went over its time or VM-step budget and was stopped by the database
+  pass
+
+
+class QueryLimits:
+  # bounds on how much work any one query can do, set in the [database] section of app_config.toml. 0 means no limit
+  def __init__(self, timeout_seconds=5, max_vm_steps=0, max_result_rows=1000, progress_interval=1000):
+    self.timeout_seconds = timeout_seconds
+    self.max_vm_steps = max_vm_steps
+    self.max_result_rows = max_result_rows
+    self.progress_interval = progress_interval # VM instructions between checks of the budget
+
+  @classmethod
+  def from_config(cls, database_config):
+    return cls(timeout_seconds=database_config.get('query_timeout_seconds', 5),
+               max_vm_steps=database_config.get('query_max_vm_steps', 0),
+               max_result_rows=database_config.get('max_result_rows', 1000))
+
+
+class QueryResult(list):
+  # the rows of a query result (so it still compares and indexes like fetchall() did), plus how it was fetched
+  def __init__(self, rows=(), columns=(), truncated=False, fingerprint=None):
+    super().__init__(rows)
+    self.columns = list(columns)
+    self.truncated = truncated # True if there were more rows than the row cap, only the first max_result_rows are held
+    self.fingerprint = fingerprint # QueryFingerprint of the whole result, when it was asked for
+
+
+class QueryFingerprint:
+  # hashes of an entire result, built up row by row while it streams past, so two results can be checked for equality
+  # without either being kept. a matching fingerprint means the same rows, a mismatch might still be eg 1 vs 1.0
+  def __init__(self, num_columns):
+    self.num_columns = num_columns
+    self.row_count = 0
+    self.unordered_hash = 0 # sum of row hashes, so row order doesn't change it but duplicates do
+    self._ordered = hashlib.blake2b(digest_size=16)
+
+  def add(self, row):
+    row_hash = hashlib.blake2b(repr(tuple(row)).encode(), digest_size=8).digest()
+    self.unordered_hash = (self.unordered_hash + int.from_bytes(row_hash, "big")) % (1 << 64)
+    self._ordered.update(row_hash)
+    self.row_count += 1
+
+  @property
+  def ordered_hash(self):
+    return self._ordered.hexdigest()
+
+  def matches(self, other, ordered=False):
+    if other is None or (self.num_columns, self.row_count, self.unordered_hash) != (other.num_columns, other.row_count, other.unordered_hash):
+      return False
+    return self.ordered_hash == other.ordered_hash if ordered else True
+
+
+class ChangeSet(QueryResult):
+  # what an INSERT/UPDATE/DELETE changed in its table, rather than the whole table afterwards. the rows are a preview (up to
+  # the row cap) with a "change" column in front: inserted, deleted, or before/after pairs for updated rows. equality goes
+  # by fingerprints of every added and removed row, so an UPDATE and an equivalent DELETE + INSERT compare equal
+  def __init__(self, table, columns=(), rows=(), counts=None, added=None, removed=None, truncated=False):
+    super().__init__(rows, ["change"] + list(columns), truncated)
+    self.table = table
+    self.counts = counts or {"inserted": 0, "deleted": 0, "updated": 0}
+    self.added = added or QueryFingerprint(len(columns)) # new values: inserted rows and updated rows' after values
+    self.removed = removed or QueryFingerprint(len(columns)) # old values: deleted rows and updated rows' before values
+
+  @classmethod
+  def from_changes(cls, table, columns, changes, max_rows=0):
+    # changes is (label, row) pairs in the order they happened, label being "inserted", "deleted", "before" or "after"
+    counts = {"inserted": 0, "deleted": 0, "updated": 0}
+    added, removed = QueryFingerprint(len(columns)), QueryFingerprint(len(columns))
+    rows = []
+    num_changes = 0
+    for label, row in changes:
+      row = tuple(row)
+      (added if label in ("inserted", "after") else removed).add(row)
+      if label == "before":
+        counts["updated"] += 1
+      elif label != "after":
+        counts[label] += 1
+      num_changes += 1
+      if not max_rows or len(rows) < max_rows:
+        rows.append((label,) + row)
+    return cls(table, columns, rows, counts, added, removed, truncated=bool(max_rows) and num_changes > max_rows)
+
+  def summary(self):
+    parts = [f"{count} row{'s' if count != 1 else ''} {label}" for label, count in self.counts.items() if count]
+    return (", ".join(parts) if parts else "no rows changed") + f" in {self.table}"
+
+  def __eq__(self, other):
+    if not isinstance(other, ChangeSet):
+      return False
+    return (self.table.lower() == other.table.lower() and self.added.matches(other.added) and self.removed.matches(other.removed))
+
+  def __ne__(self, other):
+    return not self == other
+
+  __hash__ = None
+
+
+class SchemaDiff(QueryResult):
+  # the schema objects a CREATE/ALTER/DROP added, removed or changed, instead of the whole schema afterwards. each change is
+  # (change, object type, name, structure afterwards), the structure being normalised (see SQLiteUserDatabase.get_object_structure)
+  # so answers that only differ in whitespace, quoting, case or index names still compare equal. removed objects have no
+  # structure, only which object went matters. the rows are (change, type, name, definition) for display
+  def __init__(self, changes=(), definitions=None):
+    changes = sorted(changes, key=lambda change: (change[1], change[2].lower(), change[0]))
+    definitions = definitions or {}
+    super().__init__([(change, object_type, name, definitions.get((object_type, name.lower()), ""))
+                      for change, object_type, name, _ in changes], ["change", "type", "name", "definition"])
+    self.changes = changes
+
+  def _key(self):
+    return [(change, object_type, name.lower(), structure) for change, object_type, name, structure in self.changes]
+
+  def summary(self):
+    if not self.changes:
+      return "no schema objects changed"
+    return ", ".join(f"{object_type} {name} {change}" for change, object_type, name, _ in self.changes)
+
+  def __eq__(self, other):
+    if not isinstance(other, SchemaDiff):
+      return False
+    return self._key() == other._key()
+
+  def __ne__(self, other):
+    return not self == other
+
+  __hash__ = None
+
+
+class ResultComparison:
+  # compact summary of how a user's SELECT result differs from the model answer's result
+  # rows are only ever held as small previews, never the full result sets
+  def __init__(self, matches, model_columns=0, user_columns=0, missing_count=0, extra_count=0,
+               missing_rows=None, extra_rows=None, order_mismatch_at=None):
+    self.matches = matches
+    self.model_columns = model_columns
+    self.user_columns = user_columns
+    self.missing_count = missing_count # rows in the model result but not the user's
+    self.extra_count = extra_count # rows in the user's result but not the model's
+    self.missing_rows = missing_rows or []
+    self.extra_rows = extra_rows or []
+    self.order_mismatch_at = order_mismatch_at # first row index where an ORDER BY result diverges
+
+  @property
+  def column_mismatch(self):
+    return self.model_columns != self.user_columns
+
+  def __bool__(self):
+    return self.matches
+
+  def __repr__(self):
+    return (f"ResultComparison(matches={self.matches}, columns={self.model_columns}/{self.user_columns}, "
+            f"missing={self.missing_count}, extra={self.extra_count}, order_mismatch_at={self.order_mismatch_at})")
+
 class UserDatabase:
-  def __init__(self, engine_string:str):
+  column_profiler = ColumnProfiler() # shared by every database, configured from app_config.toml by app.py
+
+  def __init__(self, engine_string:str, limits=None):
     self.engine = create_engine(engine_string, connect_args={"autocommit": False})
+    self.db_hash = hashlib.sha256(engine_string.encode()).hexdigest()
+    self.limits = limits or QueryLimits()
+    self._init_connection_state()
     self.rdbms = engine_string.split('/')[0]
     self.select_schema_query = "" # overridden by specific child classes __init__
     self.schema = self._set_schema()
     self.tables = self.get_tables()
     self.assert_db_contains_enough_data()
     self.sample_data = self.get_sample_rows()
+    self.table_info = self.get_table_info()
 
   def get_sample_rows(self):
     sample_rows = {}
     for table in self.tables:
-      rows = self.execute_query(f"SELECT * FROM {table} LIMIT 3;")
+      rows = self.execute_query(f"SELECT * FROM {quote_identifier(table)} LIMIT 3;")
       sample_rows[table] = rows
     return sample_rows
 
@@ -29,7 +239,8 @@ class UserDatabase:
     if len(self.tables) < 3:
       raise ValueError("database doesn't contain enough tables (3 minimum)")
     for table in self.tables:
-      num_rows = self.execute_query(f"SELECT COUNT(*) FROM {table};")[0][0]
+      # only needs to know there are at least 4 rows, so it stops looking after 4 instead of counting the whole table
+      num_rows = self.execute_query(f"SELECT COUNT(*) FROM (SELECT 1 FROM {quote_identifier(table)} LIMIT 4);")[0][0]
       if num_rows < 4:
         raise ValueError("a table doesn't contain enough rows of data (4 minimum)")
 
@@ -37,60 +248,366 @@ class UserDatabase:
     tables = []
     return tables
 
+  def get_table_info(self): # same again. table -> {"columns": [{name, type, not_null, primary_key}], "foreign_keys": [{column, references_table, references_column}]}
+    return {}
+
+  def get_column_profiles(self):
+    # table -> TableProfile, worked out on first use rather than at upload, as only quiz generation needs them
+    with self._lock:
+      if self._column_profiles is None:
+        self._column_profiles = self.column_profiler.profile(self)
+      return self._column_profiles
+
+  def sample_table_rows(self, table, sample_rows):
+    # (columns, rows, estimated row count) for column profiling. this just takes the first rows, rdbms classes can do better
+    try:
+      with self.read_connection() as conn, self.execution_budget(conn):
+        result = conn.exec_driver_sql(f"SELECT * FROM {quote_identifier(table)} LIMIT {int(sample_rows)};")
+        columns, rows = list(result.keys()), result.fetchall()
+        row_count = len(rows) if len(rows) < sample_rows else conn.exec_driver_sql(f"SELECT COUNT(*) FROM {quote_identifier(table)};").scalar()
+      return columns, rows, row_count
+    except QueryCancelledError:
+      raise
+    except:
+      raise ValueError
+
+  def count_matching_keys(self, table, column, keys):
+    # how many of keys appear in table.column, for profiling foreign key joins
+    params = {f"key_{i}": key for i, key in enumerate(keys)}
+    placeholders = ", ".join(f":{name}" for name in params)
+    try:
+      with self.read_connection() as conn, self.execution_budget(conn):
+        column = quote_identifier(column)
+        return conn.execute(text(f"SELECT COUNT(DISTINCT {column}) FROM {quote_identifier(table)} WHERE {column} IN ({placeholders});"), params).scalar()
+    except QueryCancelledError:
+      raise
+    except:
+      raise ValueError
+
   def _set_schema(self):
     schema = self.execute_query(self.select_schema_query)
     return schema
 
+  def schema_names(self):
+    # lowercased table and column names, so canonical_query can tell a quoted name from a (sqlite) double-quoted string
+    if self._schema_names is None:
+      names = {table.lower() for table in self.tables}
+      for table, info in self.table_info.items():
+        names.add(table.lower())
+        names.update(column["name"].lower() for column in info["columns"])
+      self._schema_names = frozenset(names)
+    return self._schema_names
+
   def get_schema(self):
     return self.schema # (text of SQL schema statements (create table, etc))
 
-  def execute_query(self, query):
+  def get_schema_hash(self):
+    # identifies the schema regardless of the data in it, eg for sharing generated questions between uploads of the same database
+    schema_text = "\n".join(row[0] for row in self.schema if row[0])
+    return hashlib.sha256(schema_text.encode()).hexdigest()
+
+  def execute_query(self, query, bounded=True, fingerprint=False):
+    # bounded: stop the query if it goes over self.limits, and only fetch up to the row cap
+    # fingerprint: for SELECTs within the row cap, give the result a QueryFingerprint (results past the cap don't get one)
     if valid_sql_query(query):
-      query_first_command = query.split()[0].upper()
-      match query_first_command:
-        case "SELECT" | "WITH":
-          result = self._execute_select_query(query)
-        case "CREATE" | "ALTER" | "DROP":
-          result = self._execute_ddl_query(query)
-        case "INSERT" | "UPDATE" | "DELETE":
-          result = self._execute_insert_update_delete_query(query)
+      query_first_command = query_command(query)
+      with tracer.span("database.execute_query", command=query_first_command, rdbms=self.rdbms, bounded=bounded) as span:
+        match query_first_command:
+          case "SELECT" | "WITH":
+            result = self._execute_select_query(query, bounded, fingerprint)
+          case "CREATE" | "ALTER" | "DROP":
+            result = self._execute_ddl_query(query, bounded)
+          case "INSERT" | "UPDATE" | "DELETE":
+            result = self._execute_insert_update_delete_query(query, bounded)
+        span.set(rows=len(result), truncated=getattr(result, "truncated", False))
       return result
     else:
       raise ValueError
     
-  def _execute_select_query(self, query):
+  def execute_query_cached(self, query):
+    # memoised execute_query, for queries whose result can't change (the database is only ever changed inside sandboxes),
+    # eg model answers, which are run in the background as soon as a quiz is generated. errors are remembered too
+    # keyed by the query's canonical form, so the same query written differently (eg by different students) is run once
+    key = (self.db_hash, canonical_query(query, self.rdbms, self.schema_names()) or query) # raw text when it doesn't parse, whitespace can be part of a literal
+    with self._lock, tracer.span("database.execute_query_cached", cached=key in self._result_cache): # so a caller waits for a background run of the same query to finish, rather than running it again
+      if key not in self._result_cache:
+        try:
+          self._result_cache[key] = (self.execute_query(query, fingerprint=True), None)
+        except Exception as e:
+          self._result_cache[key] = (None, e)
+        while len(self._result_cache) > RESULT_CACHE_SIZE:
+          self._result_cache.popitem(last=False)
+      self._result_cache.move_to_end(key)
+      result, error = self._result_cache[key]
+    if error is not None:
+      raise error
+    return result
+
+  def prefetch_queries(self, queries):
+    for query in queries:
+      try:
+        self.execute_query_cached(query)
+      except Exception:
+        pass # remembered by execute_query_cached, and raised again to whoever asks for it
+
+  def _init_connection_state(self, lock=None):
+    # one long-lived connection per database, opened on first use, instead of a new connection (and its setup) for every query
+    self._conn = None
+    self._lock = lock or threading.RLock()
+    self._read_conn = None
+    self._sandbox_depth = 0
+    self._result_cache = OrderedDict() # least recently used first
+    self._schema_objects = None # the schema before any sandboxed DDL, for diffing against
+    self._column_profiles = None
+    self._schema_names = None
+
+  def _open_connection(self):
+    return self.engine.connect()
+
+  def _close_connection(self):
+    with self._lock:
+      for conn in (self._conn, self._read_conn):
+        if conn is not None:
+          conn.close()
+      self._conn = None
+      self._read_conn = None
+
+  def _touch(self): # overridden where something needs to know the database is in use
+    pass
+
+  def _in_transaction(self, conn):
+    return True
+
+  @contextmanager
+  def connection(self):
+    with self._lock:
+      if self._conn is None or self._conn.closed:
+        self._conn = self._open_connection()
+      self._touch()
+      yield self._conn
+
+  @contextmanager
+  def read_connection(self):
+    # for queries that only read. rdbms classes can hand out a separate read-only connection, this is just the main one
+    with self.connection() as conn:
+      yield conn
+
+  @contextmanager
+  def sandbox(self):
+    # everything executed inside is undone afterwards. savepoints nest, so sandboxes can be opened within sandboxes
+    with self.connection() as conn:
+      self._sandbox_depth += 1
+      savepoint = f"sandbox_{self._sandbox_depth}"
+      conn.exec_driver_sql(f"SAVEPOINT {savepoint}")
+      try:
+        yield conn
+      finally:
+        if self._in_transaction(conn): # an interrupted write can make the database roll the whole transaction back itself
+          conn.exec_driver_sql(f"ROLLBACK TO {savepoint}") # undo any changes made, ensure they are NOT committed :O
+          conn.exec_driver_sql(f"RELEASE {savepoint}")
+        self._sandbox_depth -= 1
+        if self._sandbox_depth == 0:
+          conn.rollback() # ends the outer transaction, where the connection needed one for the savepoint
+
+  def explain_query(self, query):
+    # compiles the query with EXPLAIN without running it (so DML/DDL don't need a sandbox either)
+    # returns None if it would run, otherwise the database's error message
+    if not valid_sql_query(query):
+      return "not a valid SQL query: it must be one statement starting with a supported command, ending in a semi-colon"
+    with tracer.span("database.explain_query", rdbms=self.rdbms) as span:
+      try:
+        with self.read_connection() as conn:
+          conn.exec_driver_sql(f"EXPLAIN {_strip_terminator(query)};").close()
+        return None
+      except Exception as e:
+        span.set(invalid=True)
+        return str(getattr(e, "orig", e))
+
+  @contextmanager
+  def execution_budget(self, conn, bounded=True): # overridden by rdbms that can interrupt a running query
+    yield
+
+  def _fetch(self, result, bounded=True, fingerprint=False):
+    # fetches up to the row cap with fetchmany rather than pulling everything with fetchall()
+    max_rows = self.limits.max_result_rows if bounded else 0
     try:
-      with self.engine.connect() as conn:
-        result = conn.execute(text(query)).fetchall()
+      if not result.returns_rows:
+        return QueryResult()
+      if fingerprint and max_rows:
+        # only results within the row cap are fingerprinted, hashing every row of a huge result in python would take
+        # longer than the query. past the cap there's no fingerprint, and grading compares inside the database instead
+        rows = result.fetchmany(max_rows + 1)
+        if len(rows) > max_rows:
+          return QueryResult(rows[:max_rows], result.keys(), truncated=True)
+        result_fingerprint = QueryFingerprint(len(result.keys()))
+        for row in rows:
+          result_fingerprint.add(row)
+        return QueryResult(rows, result.keys(), fingerprint=result_fingerprint)
+      if not max_rows:
+        return QueryResult(result.fetchall(), result.keys())
+      rows = result.fetchmany(max_rows + 1)
+      return QueryResult(rows[:max_rows], result.keys(), truncated=len(rows) > max_rows)
+    finally:
+      result.close() # a partly read result would otherwise keep its statement running
+
+  def _execute_select_query(self, query, bounded=True, fingerprint=False):
+    try:
+      with self.read_connection() as conn, self.execution_budget(conn, bounded):
+        result = self._fetch(conn.execute(text(query)), bounded, fingerprint)
       return result
+    except QueryCancelledError:
+      raise
     except:
       raise ValueError
     
-  def _execute_insert_update_delete_query(self, query):
+  def _execute_insert_update_delete_query(self, query, bounded=True):
     db_object = self._extract_db_object_from_query(query)
     try:
-      with self.engine.connect() as conn:
-        with conn.begin() as transaction: # for sqlite this matters less as the file is a copy of the user's database, however for databases with connections the app shouldn't edit any of their data
-          conn.execute(text(query))
-          result = conn.execute(text(f"SELECT * FROM {db_object};")).fetchall()
-          transaction.rollback() # undo any changes made, ensure they are NOT committed :O
-        return result
+      with self.sandbox() as conn, self.execution_budget(conn, bounded): # for sqlite this matters less as the database is a copy of the user's, however for databases with connections the app shouldn't edit any of their data
+        result = self._capture_changes(conn, query, db_object, bounded)
+      return result
+    except QueryCancelledError:
+      raise
     except:
       raise ValueError
 
-  def _execute_ddl_query(self, query):
+  def _capture_schema_changes(self, conn, query, bounded=True):
+    # diffs the schema objects before and after the DDL, and only introspects the objects whose definitions changed. indexes
+    # are counted as part of their table, so CREATE INDEX shows up as its table changing. rdbms classes that can't list their
+    # schema objects (_list_schema_objects) just get the whole schema afterwards
+    if self._schema_objects is None: # the sandbox hasn't changed anything yet, so this is the uploaded schema
+      self._schema_objects = self._list_schema_objects(conn)
+    before = self._schema_objects
+    conn.execute(text(query))
+    if before is None:
+      return self._fetch(conn.execute(text(self.select_schema_query)), bounded=False)
+    after = self._list_schema_objects(conn)
+
+    changes = {}
+    definitions = {}
+    for key in before.keys() | after.keys():
+      if before.get(key) == after.get(key):
+        continue
+      object_type, name_key = key
+      if object_type == "index":
+        object_type, name_key = "table", (after.get(key) or before.get(key))[1].lower()
+        key = (object_type, name_key)
+        if key not in after or key in changes:
+          continue
+      name, _, definition = after.get(key) or before[key]
+      change = "removed" if key not in after else "added" if key not in before else "changed"
+      structure = None if change == "removed" else self.get_object_structure(conn, object_type, name)
+      changes[key] = (change, object_type, name, structure)
+      definitions[key] = definition
+    return SchemaDiff(changes.values(), definitions)
+
+  def _list_schema_objects(self, conn):
+    # (type, lower-cased name) -> (name, the table it belongs to, whitespace-collapsed sql), or None if the rdbms can't list them
+    return None
+
+  def get_object_structure(self, conn, object_type, name):
+    # a normalised, comparable description of a schema object, overridden along with _list_schema_objects
+    return None
+
+  def _view_structure(self, conn, quoted_name, sql):
+    # a view is described by its columns and its definition in canonical form, rather than by its rows, which would mean
+    # reading the whole view inside the statement's budget. identifiers are normalised, literals stay as written
+    result = conn.exec_driver_sql(f"SELECT * FROM {quoted_name} LIMIT 0;")
+    columns = tuple(column.lower() for column in result.keys())
+    result.close()
+    return ("view", columns, canonical_definition(sql, self.rdbms, self.schema_names()))
+
+  def _capture_changes(self, conn, query, table, bounded=True):
+    # runs the DML and returns its ChangeSet. this works on any database, by diffing the whole table before and after,
+    # rdbms classes that can record just the changed rows should override it
+    before = Counter(tuple(row) for row in conn.execute(text(f"SELECT * FROM {table};")))
+    conn.execute(text(query))
+    after_result = conn.execute(text(f"SELECT * FROM {table};"))
+    columns = list(after_result.keys())
+    after = Counter(tuple(row) for row in after_result)
+    changes = [("deleted", row) for row in (before - after).elements()] + [("inserted", row) for row in (after - before).elements()]
+    return ChangeSet.from_changes(table, columns, changes, self.limits.max_result_rows if bounded else 0)
+
+  def _execute_ddl_query(self, query, bounded=True):
     try:
-      with self.engine.connect() as conn:
-        with conn.begin() as transaction:
-          conn.execute(text(query))
-          schema = conn.execute(text(self.select_schema_query))
-          conn.exec_driver_sql("ROLLBACK")
+      with self.sandbox() as conn, self.execution_budget(conn, bounded):
+        schema = self._capture_schema_changes(conn, query, bounded)
       return schema
+    except QueryCancelledError:
+      raise
     except:
       raise ValueError
   
+  def compare_select_queries(self, model_query, user_query, ordered=False, preview_rows=5):
+    with tracer.span("database.compare_select_queries", rdbms=self.rdbms, ordered=ordered) as span:
+      comparison = self._compare_select_queries(model_query, user_query, ordered, preview_rows)
+      span.set(matches=comparison.matches)
+    return comparison
+
+  def _compare_select_queries(self, model_query, user_query, ordered=False, preview_rows=5):
+    # marks two SELECT/WITH queries against each other inside the database, so neither result has to be pulled into python
+    # both queries are wrapped as CTEs and their rows are counted with +1/-1 so the comparison is a multiset one (duplicates matter, order doesn't)
+    try:
+      with self.read_connection() as conn, self.execution_budget(conn):
+        model_columns = self._count_result_columns(conn, model_query)
+        user_columns = self._count_result_columns(conn, user_query)
+        if model_columns != user_columns:
+          return ResultComparison(False, model_columns, user_columns)
+
+        diff_sql = self._result_diff_sql(model_query, user_query, model_columns)
+        missing_count, extra_count = conn.exec_driver_sql(
+          diff_sql + " SELECT COALESCE(SUM(CASE WHEN n > 0 THEN n ELSE 0 END), 0), COALESCE(SUM(CASE WHEN n < 0 THEN -n ELSE 0 END), 0) FROM diff;").fetchone()
+
+        if missing_count or extra_count:
+          missing_rows = [tuple(row[:-1]) for row in conn.exec_driver_sql(
+            diff_sql + f" SELECT * FROM diff WHERE n > 0 LIMIT {int(preview_rows)};").fetchall()]
+          extra_rows = [tuple(row[:-1]) for row in conn.exec_driver_sql(
+            diff_sql + f" SELECT * FROM diff WHERE n < 0 LIMIT {int(preview_rows)};").fetchall()]
+          return ResultComparison(False, model_columns, user_columns, missing_count, extra_count, missing_rows, extra_rows)
+
+        if ordered:
+          order_mismatch_at = self._first_order_mismatch(conn, model_query, user_query, model_columns)
+          if order_mismatch_at is not None:
+            return ResultComparison(False, model_columns, user_columns, order_mismatch_at=order_mismatch_at)
+
+      return ResultComparison(True, model_columns, user_columns)
+    except QueryCancelledError:
+      raise
+    except:
+      raise ValueError
+
+  def _count_result_columns(self, conn, query):
+    result = conn.exec_driver_sql(f"SELECT * FROM ({_strip_terminator(query)}) LIMIT 0;")
+    num_columns = len(result.keys())
+    result.close()
+    return num_columns
+
+  def _result_diff_sql(self, model_query, user_query, num_columns):
+    # CTE column lists give both results the same column names, whatever the queries aliased them as
+    columns = ", ".join(f"c{i}" for i in range(num_columns))
+    return f"""WITH model_result({columns}) AS ({_strip_terminator(model_query)}),
+user_result({columns}) AS ({_strip_terminator(user_query)}),
+diff AS (SELECT {columns}, SUM(n) AS n FROM (SELECT {columns}, 1 AS n FROM model_result UNION ALL SELECT {columns}, -1 AS n FROM user_result) GROUP BY {columns} HAVING SUM(n) <> 0)"""
+
+  def _first_order_mismatch(self, conn, model_query, user_query, num_columns):
+    # only used once the two results are known to hold the same rows. every row is tagged with its position (row_number()
+    # over an empty window numbers rows in the order the query returns them) and counted with +1/-1 as in the multiset
+    # comparison, so the first position whose rows don't cancel out is where the orders first differ
+    columns = ", ".join(f"c{i}" for i in range(num_columns))
+    first_mismatch = conn.exec_driver_sql(f"""WITH model_result({columns}) AS ({_strip_terminator(model_query)}),
+user_result({columns}) AS ({_strip_terminator(user_query)})
+SELECT MIN(position) FROM (SELECT position, {columns} FROM (SELECT ROW_NUMBER() OVER () AS position, {columns}, 1 AS n FROM model_result
+UNION ALL SELECT ROW_NUMBER() OVER () AS position, {columns}, -1 AS n FROM user_result) GROUP BY position, {columns} HAVING SUM(n) <> 0);""").scalar()
+    return None if first_mismatch is None else first_mismatch - 1
+
   def _extract_db_object_from_query(self, query):
-    # not needed for SELECT statements
+    # not needed for SELECT statements. DML can have an OR <conflict resolution> after its command (eg INSERT OR REPLACE INTO)
+    match = re.match(r'\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+([\w.]+|"[^"]+"|`[^`]+`|\[[^\]]+\])',
+                     query, re.IGNORECASE)
+    if match:
+      return match.group(1)
+    if query_command(query) in ("INSERT", "UPDATE", "DELETE"): # WITH ... DELETE FROM t
+      return sqlglot.parse_one(query, read="sqlite").this.find(exp.Table).name
     words = query.upper().split()
     for word in words:
       if word not in ("CREATE", "INSERT", "UPDATE", "ALTER", "DROP", "DELETE") and word not in ("TABLE", "VIEW") and word not in ("FROM", "INTO"):
@@ -100,82 +617,494 @@ class UserDatabase:
 class SQLiteUserDatabase(UserDatabase):
   # overrides various checking functions to have sqlite-specific functionality (eg initially opening db from file not connection str)
 
-  def __init__(self, db_bytes, file_path = "temp/user_db.db"):
-    self.db_bytes = db_bytes
-    self.db_file_path = self.write_db_bytes_to_file(self.db_bytes, file_path)
+  def __init__(self, db_bytes, session_id=None, manager=None, limits=None, cache=None):
+    self.db_hash = hash_file_bytes(db_bytes) # the upload itself is only kept by the session manager, for as long as it needs it
+    self.session_id = session_id or new_session_id()
+    self.manager = manager or session_databases
+    self.limits = limits or QueryLimits()
+    self.cache = cache if cache is not None else introspection_cache
     self.rdbms = "SQLite"
 
-    assert self.assert_valid_db_file() # this error gets handled within the app
+    # the upload is loaded into a private in-memory database for this session, nothing is written to disk
+    self.session_db = self.manager.open(self.session_id, db_bytes)
+    self.engine = self.session_db.engine
+    self._init_connection_state(lock=self.session_db.lock) # the manager won't unload the database while this lock is held
+    self.session_db.on_unload = self._close_connection
 
-    self.db_engine_string = self.sqlite_engine_string(self.db_file_path)
-    self.engine = create_engine(self.db_engine_string)
-    
     self.sqlite_dbapi_handle_transactions()
 
-    self.select_schema_query = "SELECT sql FROM sqlite_schema WHERE type IN ('table', 'view');"
+    self.select_schema_query = "SELECT sql, name FROM sqlite_schema WHERE type IN ('table', 'view');" # (sql, table or view name) rows
 
-    self.schema = self._set_schema()
-    self.tables = self.get_tables()
+    # the same course database gets uploaded over and over, so everything below is cached against the upload's hash
+    # (only databases that passed every check are cached, so a cache hit can skip them all)
+    with tracer.span("introspection.upload", rdbms=self.rdbms, spooled=self.session_db.path is not None) as span:
+      cached = self._load_introspection()
+      span.set(cached=cached)
+      if not cached:
+        with tracer.span("introspection.validate"):
+          assert self.assert_valid_db_file() # this error gets handled within the app
 
-    self.assert_db_contains_enough_data()
+        with tracer.span("introspection.schema"):
+          self.schema = self._set_schema()
+          self.tables = self.get_tables()
 
-    self.sample_data = self.get_sample_rows()
-    
+        with tracer.span("introspection.data_check"):
+          self.assert_db_contains_enough_data()
 
-  def write_db_bytes_to_file(self, db_bytes, file_path):
-    try:
-      with open(file_path, "wb") as f:
-        f.write(db_bytes.getbuffer())
-      return file_path
-    except:
-      raise IOError
-  
+        with tracer.span("introspection.sample_rows"):
+          self.sample_data = self.get_sample_rows()
+        with tracer.span("introspection.table_info"):
+          self.table_info = self.get_table_info()
+        self._save_introspection()
+
+  def _introspection_cache_key(self):
+    return "sqlite:v2:" + self.db_hash # v2: schema rows have the object's name as well as its sql
+
+  def _load_introspection(self):
+    cached = self.cache.get(self._introspection_cache_key())
+    if not cached:
+      return False
+    self.schema = cached["schema"]
+    self.tables = cached["tables"]
+    self.sample_data = cached["sample_data"]
+    self.table_info = cached.get("table_info") or self.get_table_info()
+    return True
+
+  def _save_introspection(self):
+    # rows are stored as plain tuples, they repr the same as sqlalchemy Rows in the prompt
+    self.cache.set(self._introspection_cache_key(), {
+      "schema": _plain_rows(self.schema),
+      "tables": list(self.tables),
+      "sample_data": {table: _plain_rows(rows) for table, rows in self.sample_data.items()},
+      "table_info": self.table_info})
+    
   def assert_valid_db_file(self):
     try:
-      with sqlite3.connect(self.db_file_path) as conn:
-        cur = conn.cursor()
-        outcome = cur.execute("PRAGMA schema_version;").fetchone()
+      with self.connection() as conn:
+        outcome = conn.exec_driver_sql("PRAGMA schema_version;").fetchone()
       if outcome[0] == 0:
         return False
       return True
     except:
       return False
+
+  def get_column_profiles(self):
+    # profiles only depend on the upload and how it was sampled, so they're cached alongside the rest of the introspection
+    with self._lock:
+      if self._column_profiles is None:
+        profiler = self.column_profiler
+        key = f"sqlite-profiles:{self.db_hash}:{profiler.sample_rows}:{profiler.top_k}"
+        self._column_profiles = self.cache.get(key)
+        if self._column_profiles is None:
+          self._column_profiles = profiler.profile(self)
+          self.cache.set(key, self._column_profiles)
+      return self._column_profiles
+
+  def sample_table_rows(self, table, sample_rows, block_size=50):
+    # reads short runs of rows starting at random rowids spread across the table, each run is one seek down the table's
+    # b-tree, so sampling costs the same on a huge table as a small one (unlike LIMIT, which only ever sees the start)
+    # the sample is seeded by the upload's hash, so the same database always gets the same profiles
+    try:
+      with self.read_connection() as conn:
+        lowest, highest = conn.exec_driver_sql(f'SELECT MIN(rowid), MAX(rowid) FROM "{table}";').fetchone()
+    except: # WITHOUT ROWID table
+      return super().sample_table_rows(table, sample_rows)
+    if lowest is None:
+      return [], [], 0
+    rowid_range = highest - lowest + 1
+    if rowid_range <= sample_rows:
+      return super().sample_table_rows(table, sample_rows)
+
+    rng = random.Random(f"{self.db_hash}:{table}")
+    num_blocks = math.ceil(sample_rows / block_size)
+    stride = rowid_range / num_blocks
+    rows_by_rowid = {}
+    rows_read = rowids_covered = 0
+    try:
+      with self.read_connection() as conn, self.execution_budget(conn):
+        for block in range(num_blocks):
+          start = lowest + int((block + rng.random()) * stride)
+          result = conn.exec_driver_sql(f'SELECT rowid, * FROM "{table}" WHERE rowid >= ? ORDER BY rowid LIMIT ?;', (start, block_size))
+          columns = list(result.keys())[1:]
+          block_rows = result.fetchall()
+          if block_rows:
+            rows_read += len(block_rows)
+            rowids_covered += block_rows[-1][0] - block_rows[0][0] + 1
+            rows_by_rowid.update((row[0], tuple(row[1:])) for row in block_rows)
+    except QueryCancelledError:
+      raise
+    except:
+      raise ValueError
+    # deleted rows leave gaps in the rowids, so the table's size is scaled by how densely the sampled runs were filled
+    density = rows_read / rowids_covered if rowids_covered else 1
+    return columns, list(rows_by_rowid.values()), max(len(rows_by_rowid), round(rowid_range * density))
+
+  def close(self):
+    self.manager.release(self.session_id)
   
   def get_tables(self):
     tables = [row[0] for row in self.execute_query("SELECT tbl_name FROM sqlite_schema WHERE type ='table';")]
     return tables
 
-  def sqlite_engine_string(self, db_path):
-    return "sqlite:///" + db_path
-  
-  def _execute_insert_update_delete_query(self, query):
-    db_object = self._extract_db_object_from_query(query)
+  def get_table_info(self):
+    table_info = {}
+    with self.read_connection() as conn:
+      for table in self.tables:
+        columns = conn.exec_driver_sql(f'PRAGMA table_info("{table}");').fetchall()
+        foreign_keys = conn.exec_driver_sql(f'PRAGMA foreign_key_list("{table}");').fetchall()
+        table_info[table] = {
+          "columns": [{"name": column[1], "type": column[2].upper(), "not_null": bool(column[3]), "primary_key": bool(column[5])}
+                      for column in columns],
+          "foreign_keys": [{"column": foreign_key[3], "references_table": foreign_key[2], "references_column": foreign_key[4]}
+                           for foreign_key in foreign_keys]}
+    return table_info
+
+  def _open_connection(self):
+    # autocommit, so plain SELECTs don't hold a transaction open on the long-lived connection. sandboxes start theirs with SAVEPOINT
+    return self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+  def _capture_changes(self, conn, query, table, bounded=True):
+    # temporary triggers on the target table record each row the DML touches into a temporary table, so only the changed rows
+    # are ever read back, however big the table. they're created inside the sandbox, so they're rolled back along with the DML
+    table_name = table.strip('"`[]').split(".")[-1]
+    columns = [row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table_name}");')]
+    table_sql = conn.exec_driver_sql("SELECT sql FROM sqlite_schema WHERE type = 'table' AND name = ? COLLATE NOCASE;", (table_name,)).scalar()
+    if not columns or table_sql is None: # eg a view with INSTEAD OF triggers, which can't have triggers of its own
+      return super()._capture_changes(conn, query, table, bounded)
+    # rows removed by REPLACE conflict resolution only fire delete triggers with recursive_triggers on, and turning that on
+    # would change how the user's own triggers run. so statements that might replace rows are diffed against a snapshot instead
+    might_replace = re.search(r'\bREPLACE\b', query + " " + table_sql, re.IGNORECASE) is not None
+    if might_replace and not conn.exec_driver_sql("PRAGMA recursive_triggers;").scalar():
+      return self._capture_changes_by_snapshot(conn, query, table_name, columns, bounded)
+
+    placeholders = ", ".join(f"c{i}" for i in range(len(columns)))
+    new_values = ", ".join(f'NEW."{column}"' for column in columns)
+    old_values = ", ".join(f'OLD."{column}"' for column in columns)
+    conn.exec_driver_sql(f"CREATE TEMP TABLE sandbox_changes (change TEXT, {placeholders});")
+    conn.exec_driver_sql(f"""CREATE TEMP TRIGGER sandbox_changes_insert AFTER INSERT ON main."{table_name}"
+      BEGIN INSERT INTO sandbox_changes VALUES ('inserted', {new_values}); END;""")
+    conn.exec_driver_sql(f"""CREATE TEMP TRIGGER sandbox_changes_delete AFTER DELETE ON main."{table_name}"
+      BEGIN INSERT INTO sandbox_changes VALUES ('deleted', {old_values}); END;""")
+    conn.exec_driver_sql(f"""CREATE TEMP TRIGGER sandbox_changes_update AFTER UPDATE ON main."{table_name}"
+      BEGIN INSERT INTO sandbox_changes VALUES ('before', {old_values}); INSERT INTO sandbox_changes VALUES ('after', {new_values}); END;""")
+    conn.execute(text(query))
+
+    result = conn.exec_driver_sql("SELECT * FROM sandbox_changes ORDER BY rowid;")
     try:
-      with self.engine.connect() as conn:
-        with conn.begin() as transaction:
-          conn.execute(text(query))
-          result = conn.execute(text(f"SELECT * FROM {db_object};")).fetchall() 
-          conn.exec_driver_sql("ROLLBACK")
-        return result
-    except:
-      raise ValueError
+      changes = ((row[0], row[1:]) for batch in iter(lambda: result.fetchmany(500), []) for row in batch)
+      return ChangeSet.from_changes(table_name, columns, changes, self.limits.max_result_rows if bounded else 0)
+    finally:
+      result.close()
 
-  def _execute_ddl_query(self, query):
+  def _capture_changes_by_snapshot(self, conn, query, table_name, columns, bounded=True):
+    # the table is copied before the DML, and the copy and the table are counted against each other with +1/-1 (as in
+    # compare_select_queries), so the diff happens inside sqlite and only the changed rows come back. the temp table is
+    # rolled back with the sandbox. an update shows up as a delete and an insert
+    quoted_columns = ", ".join('"' + column.replace('"', '""') + '"' for column in columns)
+    conn.exec_driver_sql(f'CREATE TEMP TABLE sandbox_snapshot AS SELECT {quoted_columns} FROM main."{table_name}";')
+    conn.execute(text(query))
+    result = conn.exec_driver_sql(f"""SELECT SUM(n) AS n, {quoted_columns} FROM (SELECT 1 AS n, {quoted_columns} FROM sandbox_snapshot
+      UNION ALL SELECT -1 AS n, {quoted_columns} FROM main."{table_name}") GROUP BY {quoted_columns} HAVING SUM(n) <> 0;""")
     try:
-      with self.engine.connect() as conn:
-        with conn.begin() as transaction:
-          conn.execute(text(query))
-          schema = conn.execute(text(self.select_schema_query)).fetchall()
-          conn.exec_driver_sql("ROLLBACK")
-      return schema
-    except:
-      raise ValueError
+      changes = (("deleted" if row[0] > 0 else "inserted", tuple(row[1:])) for batch in iter(lambda: result.fetchmany(500), [])
+                 for row in batch for _ in range(abs(row[0])))
+      return ChangeSet.from_changes(table_name, columns, changes, self.limits.max_result_rows if bounded else 0)
+    finally:
+      result.close()
+
+  def _list_schema_objects(self, conn):
+    # (type, lower-cased name) -> (name, the table it belongs to, whitespace-collapsed sql). sqlite's own objects (eg the
+    # indexes behind UNIQUE constraints) are left out, get_object_structure picks them up through their table
+    rows = conn.exec_driver_sql("SELECT type, name, tbl_name, sql FROM sqlite_schema WHERE name NOT LIKE 'sqlite_%';")
+    return {(object_type, name.lower()): (name, table, " ".join((sql or "").split())) for object_type, name, table, sql in rows}
+
+  def get_object_structure(self, conn, object_type, name):
+    # a normalised, comparable description of a schema object: names lower-cased, types upper-cased, no index names
+    quoted = '"' + name.replace('"', '""') + '"'
+    if object_type == "table":
+      columns = tuple((column[1].lower(), " ".join(column[2].upper().split()), bool(column[3]), column[4], column[5])
+                      for column in conn.exec_driver_sql(f"PRAGMA table_info({quoted});"))
+      foreign_keys = tuple(sorted((foreign_key[3].lower(), foreign_key[2].lower(), (foreign_key[4] or "").lower(), foreign_key[5], foreign_key[6])
+                                  for foreign_key in conn.exec_driver_sql(f"PRAGMA foreign_key_list({quoted});")))
+      indexes = []
+      for index in conn.exec_driver_sql(f"PRAGMA index_list({quoted});").fetchall():
+        index_name = '"' + index[1].replace('"', '""') + '"'
+        index_columns = tuple((column[2] or "").lower() for column in conn.exec_driver_sql(f"PRAGMA index_info({index_name});"))
+        indexes.append((bool(index[2]), index_columns, bool(index[4])))
+      return ("table", columns, foreign_keys, tuple(sorted(indexes)))
+    sql = conn.exec_driver_sql("SELECT sql FROM sqlite_schema WHERE type = ? AND name = ?;", (object_type, name)).scalar() or ""
+    if object_type == "view":
+      return self._view_structure(conn, quoted, sql)
+    # triggers: there's no structure to read back, so just their sql
+    return (object_type, canonical_definition(sql, self.rdbms, self.schema_names()))
+
+  @contextmanager
+  def read_connection(self):
+    # large uploads have a read-only, memory-mapped connection of their own for everything that only reads. inside a
+    # sandbox, reads stay on the sandbox's connection so they see its changes
+    if self._sandbox_depth:
+      with self.connection() as conn:
+        yield conn
+      return
+    if self.session_db.read_engine is None:
+      # the main connection autocommits outside sandboxes, so it's made query_only while reading, in case a "read" writes
+      with self.connection() as conn:
+        query_only = conn.exec_driver_sql("PRAGMA query_only;").scalar()
+        conn.exec_driver_sql("PRAGMA query_only = ON;")
+        try:
+          yield conn
+        finally:
+          conn.exec_driver_sql(f"PRAGMA query_only = {query_only};")
+      return
+    with self._lock:
+      if self._read_conn is None or self._read_conn.closed:
+        self._read_conn = self.session_db.read_engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+      self._touch()
+      yield self._read_conn
+
+  def _touch(self):
+    self.manager.touch(self.session_id)
+
+  def _in_transaction(self, conn):
+    return conn.connection.dbapi_connection.in_transaction
+
+  @contextmanager
+  def execution_budget(self, conn, bounded=True):
+    # sqlite calls the progress handler every progress_interval VM instructions, and abandons the query if it returns non-zero
+    # so a runaway query (eg an accidental cartesian join) is stopped cleanly instead of pinning the worker
+    limits = self.limits
+    if not bounded or not (limits.timeout_seconds or limits.max_vm_steps):
+      yield
+      return
+
+    deadline = time.monotonic() + limits.timeout_seconds if limits.timeout_seconds else None
+    budget = {"steps": 0, "cancelled": False}
+    def progress_handler():
+      budget["steps"] += limits.progress_interval
+      if (limits.max_vm_steps and budget["steps"] > limits.max_vm_steps) or (deadline and time.monotonic() > deadline):
+        budget["cancelled"] = True
+        return 1
+      return 0
+
+    dbapi_connection = conn.connection.dbapi_connection
+    dbapi_connection.set_progress_handler(progress_handler, limits.progress_interval)
+    try:
+      yield
+    except Exception as e:
+      if budget["cancelled"]:
+        raise QueryCancelledError("query was stopped for going over its time or step limit") from e
+      raise
+    finally:
+      dbapi_connection.set_progress_handler(None, 0)
   
   def sqlite_dbapi_handle_transactions(self): # because the sqlite dbapi is odd
     @event.listens_for(self.engine, "connect")
     def do_connect(dbapi_connection, connection_record):
       dbapi_connection.isolation_level = None
 
-    @event.listens_for(self.engine, "begin")
-    def do_begin(conn):
-      conn.exec_driver_sql("BEGIN")
\ No newline at end of file
+
+class DuckDBUserDatabase(UserDatabase):
+  # runs the quiz in duckdb's vectorised engine, for aggregation and join heavy quizzes on datasets too big for sqlite to
+  # answer interactively. uploads are an sqlite .db file and/or .parquet / .csv files (one table each), imported into a
+  # duckdb file for the session by SessionDatabaseManager.open_duckdb
+
+  def __init__(self, uploads, session_id=None, manager=None, limits=None):
+    self.uploads = list(uploads)
+    self.db_hash = hashlib.sha256("".join(upload.name + ":" + hash_file_bytes(upload) for upload in self.uploads).encode()).hexdigest()
+    self.session_id = session_id or new_session_id()
+    self.manager = manager or session_databases
+    self.limits = limits or QueryLimits()
+    self.rdbms = "DuckDB"
+
+    with tracer.span("introspection.upload", rdbms=self.rdbms, files=len(self.uploads)):
+      with tracer.span("introspection.import"):
+        self.session_db = self.manager.open_duckdb(self.session_id, self.uploads)
+      self.engine = self.session_db.engine
+      self._init_connection_state(lock=self.session_db.lock)
+      self.session_db.on_unload = self._close_connection
+
+      # duckdb's sql ends in a semi-colon, sqlite's doesn't (chr(59), as execute_query only takes one semi-colon per query)
+      self.select_schema_query = """SELECT rtrim(sql, chr(59)), name FROM (
+        SELECT sql, 0 AS kind, table_name AS name FROM duckdb_tables() WHERE database_name = current_database() AND schema_name = 'main' AND NOT temporary
+        UNION ALL
+        SELECT sql, 1 AS kind, view_name AS name FROM duckdb_views() WHERE database_name = current_database() AND schema_name = 'main' AND NOT internal AND NOT temporary
+      ) ORDER BY kind, name;"""
+      with tracer.span("introspection.schema"):
+        self.schema = self._set_schema()
+        self.tables = self.get_tables()
+      with tracer.span("introspection.data_check"):
+        self.assert_db_contains_enough_data()
+      with tracer.span("introspection.sample_rows"):
+        self.sample_data = self.get_sample_rows()
+      with tracer.span("introspection.table_info"):
+        self.table_info = self.get_table_info()
+
+  def assert_valid_db_file(self):
+    return bool(self.tables)
+
+  def close(self):
+    self.manager.release(self.session_id)
+
+  def get_tables(self):
+    return [row[0] for row in self.execute_query("""SELECT table_name FROM duckdb_tables()
+      WHERE database_name = current_database() AND schema_name = 'main' AND NOT temporary ORDER BY table_name;""")]
+
+  def get_table_info(self):
+    table_info = {table: {"columns": [], "foreign_keys": []} for table in self.tables}
+    with self.read_connection() as conn:
+      primary_keys = {(table, column) for table, columns in conn.exec_driver_sql(
+        """SELECT table_name, constraint_column_names FROM duckdb_constraints()
+           WHERE database_name = current_database() AND schema_name = 'main' AND constraint_type = 'PRIMARY KEY';""") for column in columns}
+      for table, column, data_type, nullable in conn.exec_driver_sql(
+          """SELECT table_name, column_name, data_type, is_nullable FROM duckdb_columns()
+             WHERE database_name = current_database() AND schema_name = 'main' ORDER BY table_name, column_index;"""):
+        if table in table_info:
+          table_info[table]["columns"].append({"name": column, "type": data_type.upper(), "not_null": not nullable,
+                                               "primary_key": (table, column) in primary_keys})
+      # foreign keys of imported sqlite tables are recorded rather than enforced, see duckdb_import
+      for table, column, references_table, references_column in conn.exec_driver_sql(
+          "SELECT table_name, column_name, references_table, references_column FROM upload_meta.foreign_keys;"):
+        if table in table_info:
+          table_info[table]["foreign_keys"].append({"column": column, "references_table": references_table, "references_column": references_column})
+    return table_info
+
+  def sample_table_rows(self, table, sample_rows):
+    # a reservoir sample is one vectorised pass over the table, seeded by the upload's hash so profiles are repeatable
+    quoted = '"' + table.replace('"', '""') + '"'
+    seed = int(self.db_hash[:8], 16) & 0x7fffffff # duckdb's REPEATABLE only takes a signed 32-bit seed
+    try:
+      with self.read_connection() as conn, self.execution_budget(conn):
+        row_count = conn.exec_driver_sql(f"SELECT COUNT(*) FROM {quoted};").scalar()
+        result = conn.exec_driver_sql(f"SELECT * FROM {quoted} USING SAMPLE reservoir({int(sample_rows)} ROWS) REPEATABLE ({seed});")
+        columns, rows = list(result.keys()), [tuple(row) for row in result.fetchall()]
+      return columns, rows, row_count
+    except QueryCancelledError:
+      raise
+    except:
+      raise ValueError
+
+  @contextmanager
+  def read_connection(self):
+    # duckdb_engine begins a transaction on a connection's first statement, and a failed statement aborts it, so outside
+    # sandboxes each read ends its transaction rather than leaving the connection stuck after an invalid answer
+    with self.connection() as conn:
+      try:
+        yield conn
+      finally:
+        if not self._sandbox_depth:
+          conn.rollback()
+
+  @contextmanager
+  def sandbox(self):
+    # duckdb has no savepoints, so the outermost sandbox is a transaction that's always rolled back, and nested ones share it
+    with self.connection() as conn:
+      if not self._sandbox_depth:
+        conn.rollback() # starts from a fresh transaction, begun by the next statement
+      self._sandbox_depth += 1
+      try:
+        yield conn
+      finally:
+        self._sandbox_depth -= 1
+        if self._sandbox_depth == 0:
+          conn.rollback()
+
+  @contextmanager
+  def execution_budget(self, conn, bounded=True):
+    # duckdb has no progress handler, so a timer interrupts the connection once a query runs past the time limit
+    # (there's no equivalent of sqlite's VM steps, max_vm_steps is ignored). interrupt() only reaches queries on the
+    # session's own connection, so everything bounded has to run through conn, never a cursor() of its own
+    if not bounded or not self.limits.timeout_seconds:
+      yield
+      return
+    budget = {"running": True, "cancelled": False}
+    budget_lock = threading.Lock()
+    def interrupt():
+      with budget_lock:
+        if budget["running"]:
+          budget["cancelled"] = True
+          self.session_db.connection.interrupt()
+    timer = threading.Timer(self.limits.timeout_seconds, interrupt)
+    timer.daemon = True
+    timer.start()
+    try:
+      yield
+    except Exception as e:
+      if budget["cancelled"]:
+        raise QueryCancelledError("query was stopped for going over its time limit") from e
+      raise
+    finally:
+      with budget_lock:
+        budget["running"] = False
+      timer.cancel()
+
+  def _capture_changes(self, conn, query, table, bounded=True):
+    # plain INSERTs and DELETEs hand back the rows they changed with RETURNING. anything else (UPDATE, upserts) is diffed
+    # against a snapshot of the table, inside duckdb so only the changed rows come back out, with rows matched up by rowid
+    # (an update that moves a row, eg changing its primary key, shows as a delete and an insert)
+    table_name = table.strip('"`[]').split(".")[-1]
+    quoted = '"' + table_name.replace('"', '""') + '"'
+    columns = [row[0] for row in conn.exec_driver_sql(
+      """SELECT column_name FROM duckdb_columns() WHERE database_name = current_database() AND schema_name = 'main'
+         AND table_name = ? ORDER BY column_index;""", (table_name,))]
+    if not columns:
+      return super()._capture_changes(conn, query, table, bounded)
+    max_rows = self.limits.max_result_rows if bounded else 0
+    command = query_command(query)
+    plain = not re.search(r"\bRETURNING\b|\bON\s+CONFLICT\b|^\s*INSERT\s+OR\b", query, re.IGNORECASE)
+    if command in ("INSERT", "DELETE") and plain:
+      result = conn.exec_driver_sql(_strip_terminator(query) + " RETURNING *;")
+      label = "inserted" if command == "INSERT" else "deleted"
+      try:
+        changes = ((label, row) for batch in iter(lambda: result.fetchmany(500), []) for row in batch)
+        return ChangeSet.from_changes(table_name, columns, changes, max_rows)
+      finally:
+        result.close()
+
+    conn.exec_driver_sql(f"CREATE TEMP TABLE sandbox_before AS SELECT rowid AS sandbox_rowid, * FROM {quoted};")
+    conn.execute(text(query))
+    before_columns = ", ".join(f'b."{column}"' for column in columns)
+    after_columns = ", ".join(f'a."{column}"' for column in columns)
+    changed = " OR ".join(f'b."{column}" IS DISTINCT FROM a."{column}"' for column in columns)
+    result = conn.exec_driver_sql(f"""SELECT CASE WHEN a.rowid IS NULL THEN 'deleted' WHEN b.sandbox_rowid IS NULL THEN 'inserted' ELSE 'updated' END,
+      {before_columns}, {after_columns} FROM sandbox_before b FULL OUTER JOIN {quoted} a ON a.rowid = b.sandbox_rowid
+      WHERE a.rowid IS NULL OR b.sandbox_rowid IS NULL OR {changed} ORDER BY coalesce(b.sandbox_rowid, a.rowid);""")
+    def changes():
+      for batch in iter(lambda: result.fetchmany(500), []):
+        for row in batch:
+          before, after = row[1:len(columns) + 1], row[len(columns) + 1:]
+          if row[0] == "updated":
+            yield "before", before
+            yield "after", after
+          else:
+            yield row[0], before if row[0] == "deleted" else after
+    try:
+      return ChangeSet.from_changes(table_name, columns, changes(), max_rows)
+    finally:
+      result.close()
+
+  def _list_schema_objects(self, conn):
+    rows = conn.exec_driver_sql("""
+      SELECT 'table', table_name, table_name, sql FROM duckdb_tables() WHERE database_name = current_database() AND schema_name = 'main' AND NOT temporary
+      UNION ALL
+      SELECT 'view', view_name, view_name, sql FROM duckdb_views() WHERE database_name = current_database() AND schema_name = 'main' AND NOT internal AND NOT temporary
+      UNION ALL
+      SELECT 'index', index_name, table_name, sql FROM duckdb_indexes() WHERE database_name = current_database() AND schema_name = 'main';""")
+    return {(object_type, name.lower()): (name, table, " ".join((sql or "").split())) for object_type, name, table, sql in rows}
+
+  def get_object_structure(self, conn, object_type, name):
+    # the same shape of description as SQLiteUserDatabase.get_object_structure, from duckdb's catalog functions
+    quoted = '"' + name.replace('"', '""') + '"'
+    if object_type == "table":
+      catalog = "database_name = current_database() AND schema_name = 'main' AND table_name = ?"
+      columns = tuple((column.lower(), " ".join(data_type.upper().split()), not nullable, default)
+                      for column, data_type, nullable, default in conn.exec_driver_sql(
+                        f"SELECT column_name, data_type, is_nullable, column_default FROM duckdb_columns() WHERE {catalog} ORDER BY column_index;", (name,)))
+      constraints = tuple(sorted((constraint_type, tuple(column.lower() for column in constraint_columns), (referenced_table or "").lower())
+                                 for constraint_type, constraint_columns, referenced_table in conn.exec_driver_sql(
+                                   f"SELECT constraint_type, constraint_column_names, referenced_table FROM duckdb_constraints() WHERE {catalog};", (name,))))
+      indexes = tuple(sorted((bool(unique), (expressions or "").lower()) for unique, expressions in conn.exec_driver_sql(
+        f"SELECT is_unique, expressions FROM duckdb_indexes() WHERE {catalog};", (name,))))
+      return ("table", columns, constraints, indexes)
+    sql = conn.exec_driver_sql("SELECT sql FROM duckdb_views() WHERE database_name = current_database() AND schema_name = 'main' AND view_name = ?;",
+                               (name,)).scalar() or ""
+    return self._view_structure(conn, quoted, sql)
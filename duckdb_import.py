@@ -0,0 +1,95 @@
+# loads uploads into a session's duckdb database: every table of an sqlite .db file, and each .parquet or .csv file as a
+# table named after the file. sqlite files are read with the sqlite3 module and copied across in arrow batches, rather
+# than through duckdb's sqlite extension, which would have to be downloaded at runtime
+import os
+import re
+import sqlite3
+import pyarrow as pa
+
+BATCH_ROWS = 100_000
+METADATA_SCHEMA = "upload_meta" # kept out of main, so it isn't one of the quiz's tables
+
+# column types are picked from the values actually stored (sqlite columns can hold anything whatever they're declared as)
+STORAGE_TYPES = {
+  frozenset(): ("VARCHAR", pa.string()),
+  frozenset({"integer"}): ("BIGINT", pa.int64()),
+  frozenset({"real"}): ("DOUBLE", pa.float64()),
+  frozenset({"integer", "real"}): ("DOUBLE", pa.float64()),
+  frozenset({"text"}): ("VARCHAR", pa.string()),
+  frozenset({"blob"}): ("BLOB", pa.binary()),
+}
+
+
+def quote_identifier(name):
+  return '"' + name.replace('"', '""') + '"'
+
+def table_name_for_file(file_name):
+  # data.csv -> data, "2024 sales.parquet" -> t_2024_sales
+  name = re.sub(r"\W+", "_", os.path.splitext(os.path.basename(file_name))[0]).strip("_") or "table"
+  return "t_" + name if name[0].isdigit() else name
+
+def import_uploads(connection, sources):
+  # sources are (path on disk, name it was uploaded as) pairs
+  connection.execute(f"CREATE SCHEMA IF NOT EXISTS {METADATA_SCHEMA};")
+  connection.execute(f"""CREATE TABLE IF NOT EXISTS {METADATA_SCHEMA}.foreign_keys
+    (table_name VARCHAR, column_name VARCHAR, references_table VARCHAR, references_column VARCHAR);""")
+  for path, file_name in sources:
+    extension = os.path.splitext(file_name)[1].lower()
+    table = quote_identifier(table_name_for_file(file_name))
+    if extension == ".parquet":
+      connection.execute(f"CREATE TABLE {table} AS SELECT * FROM read_parquet(?);", [path])
+    elif extension == ".csv":
+      connection.execute(f"CREATE TABLE {table} AS SELECT * FROM read_csv_auto(?);", [path])
+    else:
+      import_sqlite(connection, path)
+  connection.execute("CHECKPOINT;")
+
+def import_sqlite(connection, path):
+  source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+  try:
+    objects = source.execute("SELECT type, name, sql FROM sqlite_schema WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%' ORDER BY rowid;").fetchall()
+    for object_type, name, sql in objects:
+      if object_type == "table":
+        _copy_table(connection, source, name)
+    # foreign keys aren't made constraints, duckdb would enforce them where sqlite (by default) doesn't, and DML answers
+    # that sqlite accepts would fail. they're recorded for the prompt and column profiles instead
+    foreign_keys = [[name, foreign_key[3], foreign_key[2], foreign_key[4]] for object_type, name, sql in objects if object_type == "table"
+                    for foreign_key in source.execute(f"PRAGMA foreign_key_list({quote_identifier(name)});")]
+    if foreign_keys:
+      connection.executemany(f"INSERT INTO {METADATA_SCHEMA}.foreign_keys VALUES (?, ?, ?, ?);", foreign_keys)
+    for object_type, name, sql in objects:
+      if object_type == "view":
+        try:
+          connection.execute(sql)
+        except Exception: # sqlite-only syntax, the view is left out rather than failing the upload
+          pass
+  finally:
+    source.close()
+
+def _copy_table(connection, source, table):
+  quoted = quote_identifier(table)
+  columns = source.execute(f"PRAGMA table_info({quoted});").fetchall() # cid, name, type, notnull, default, pk
+  names = [quote_identifier(column[1]) for column in columns]
+  # one pass over the table for the storage classes in every column
+  storage = source.execute("SELECT " + ", ".join(f"GROUP_CONCAT(DISTINCT typeof({name}))" for name in names) + f" FROM {quoted};").fetchone()
+  storage = [frozenset((classes or "").split(",")) - {"null", ""} for classes in storage]
+  types = [STORAGE_TYPES.get(classes, ("VARCHAR", pa.string())) for classes in storage]
+
+  definitions = [f"{name} {duckdb_type}{' NOT NULL' if column[3] else ''}" for name, (duckdb_type, _), column in zip(names, types, columns)]
+  primary_key = [name for column, name in sorted(zip(columns, names), key=lambda pair: pair[0][5]) if column[5]]
+  if primary_key:
+    definitions.append(f"PRIMARY KEY ({', '.join(primary_key)})")
+  connection.execute(f"CREATE TABLE {quoted} ({', '.join(definitions)});")
+
+  cursor = source.execute(f"SELECT {', '.join(names)} FROM {quoted};")
+  while rows := cursor.fetchmany(BATCH_ROWS):
+    arrays = []
+    for values, (duckdb_type, arrow_type), classes in zip(zip(*rows), types, storage):
+      if classes not in STORAGE_TYPES: # mixed columns are kept as text
+        values = [value if value is None or isinstance(value, str) else str(value) for value in values]
+      arrays.append(pa.array(values, type=arrow_type))
+    connection.register("upload_batch", pa.Table.from_arrays(arrays, names=[str(i) for i in range(len(arrays))]))
+    try:
+      connection.execute(f"INSERT INTO {quoted} SELECT * FROM upload_batch;")
+    finally:
+      connection.unregister("upload_batch")
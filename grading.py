@@ -0,0 +1,186 @@
+# marks quiz answers against the model's answers, shared by the quiz page and the batch CLI (python -m batch)
+from concurrent.futures import ThreadPoolExecutor
+from database import is_select_query, query_command, query_has_order_by, QueryCancelledError, ChangeSet, SchemaDiff
+from tracing import tracer
+from canonical_sql import same_query
+
+# one per process, shared by every session (the quiz page script is rerun on every interaction, so it can't own one)
+model_answer_prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-answer-prefetch")
+
+
+class Grade:
+  # how one answer was marked, with both queries' results (or the errors that stopped them) for showing alongside
+  def __init__(self, correct, method, model_result, user_result, model_error=None, user_error=None, comparison=None, comparison_error=None):
+    self.correct = correct # None when the answer couldn't be marked (method ungraded)
+    self.method = method # identical, invalid, fingerprint, comparison, changes or ungraded
+    self.model_result = model_result
+    self.user_result = user_result
+    self.model_error = model_error
+    self.user_error = user_error
+    self.comparison = comparison # ResultComparison, for SELECT answers whose fingerprints didn't match
+    self.comparison_error = comparison_error # why the comparison stopped, for ungraded answers
+
+  @property
+  def ungraded(self):
+    return self.correct is None
+
+
+def prefetch_model_answers(database, model_queries):
+  # runs the model answers while the user is still writing theirs, so marking only has to run the user's queries
+  return model_answer_prefetcher.submit(database.prefetch_queries, model_queries)
+
+def execute_answer_query(database, query):
+  # memoised by the query's canonical form: model answers are usually already run in the background (see
+  # UserDatabase.prefetch_queries), and students who give the same answer, however it's written, share one run of it
+  try:
+    result = database.execute_query_cached(query)
+    return result, True, None
+  except Exception as e: # QueryCancelledError if it ran for too long
+    return [], False, e # empty answer
+
+def compare_answer_queries(database, model_answer, user_answer):
+  # SELECT answers are compared inside the database, other answers compare their (sandboxed) results directly
+  # returns the ResultComparison and None, or None and the error that stopped the comparison (QueryCancelledError if it
+  # ran out of time), which leaves the answer ungraded rather than wrong
+  try:
+    return database.compare_select_queries(model_answer, user_answer, ordered=query_has_order_by(model_answer)), None
+  except Exception as e:
+    return None, e
+
+def grade_answer(database, model_answer, user_answer):
+  with tracer.span("grading.mark_answer") as span:
+    model_result, valid_model_answer, model_error = execute_answer_query(database, model_answer)
+    if same_query(model_answer, user_answer, database.rdbms, database.schema_names()):
+      # structurally the same query as the model answer, so it gets the same result without being run
+      span.set(method="identical", correct=True)
+      return Grade(True, "identical", model_result, model_result, model_error, model_error)
+    user_result, valid_user_answer, user_error = execute_answer_query(database, user_answer)
+    comparison, comparison_error = None, None
+
+    if not valid_user_answer:
+      correct, method = False, "invalid"
+    elif is_select_query(model_answer) and is_select_query(user_answer):
+      # matching fingerprints settle it without running the model answer again, anything else gets the full comparison
+      model_fingerprint = getattr(model_result, "fingerprint", None)
+      if model_fingerprint and model_fingerprint.matches(user_result.fingerprint, ordered=query_has_order_by(model_answer)):
+        correct, method = True, "fingerprint"
+      else:
+        comparison, comparison_error = compare_answer_queries(database, model_answer, user_answer)
+        correct, method = (bool(comparison), "comparison") if comparison_error is None else (None, "ungraded")
+    else:
+      correct, method = (model_result == user_result), "changes" # ChangeSets for DML and SchemaDiffs for DDL, which only compare what was changed
+    span.set(method=method, correct=correct)
+  return Grade(correct, method, model_result, user_result, model_error, user_error, comparison, comparison_error)
+
+def _statement_type(query):
+  command = query_command(query) if query.split() else ""
+  return "SELECT" if command == "WITH" else command
+
+def _plural(count, word):
+  return f"{count} {word}{'s' if count != 1 else ''}"
+
+def _error_message(error):
+  # the database's own message, without sqlalchemy's statement and background link. execute_query raises a bare
+  # ValueError, so the message is on the exception it was raised from
+  while not str(error) and (error.__cause__ or error.__context__) is not None:
+    error = error.__cause__ or error.__context__
+  message = str(getattr(error, "orig", None) or error).strip().splitlines()
+  return message[0] if message else type(error).__name__
+
+def rule_based_feedback(grade, model_answer, user_answer):
+  # a comment worked out from how the answers ran and how their results differ, for mistakes that are mechanically
+  # obvious. None when it takes reading the queries to say what's wrong, those go to the llm
+  if isinstance(grade.user_error, QueryCancelledError):
+    return "your query was stopped for taking too long to run. check every table in it is joined on a condition, a missing join condition multiplies the rows"
+  if grade.user_error is not None or grade.method == "invalid":
+    message = _error_message(grade.user_error) if grade.user_error is not None else "it isn't a single, complete SQL statement"
+    return f"your query couldn't run: {message}. fix that first, then compare it with the correct answer above"
+  if grade.model_error is not None:
+    return None # nothing to compare against
+
+  model_type, user_type = _statement_type(model_answer), _statement_type(user_answer)
+  if model_type != user_type:
+    return f"the question is answered with {model_type}, but your answer uses {user_type}"
+
+  comparison = grade.comparison
+  if comparison is not None:
+    if comparison.column_mismatch:
+      return (f"your query returns {_plural(comparison.user_columns, 'column')} but the correct answer returns {comparison.model_columns}. "
+              "check which columns are in your SELECT list")
+    if comparison.order_mismatch_at is not None and not comparison.missing_count and not comparison.extra_count:
+      if not query_has_order_by(user_answer):
+        return "you've got the right rows, but the question asks for them in a particular order, and your query has no ORDER BY"
+      return (f"you've got the right rows, but in the wrong order (they first differ at row {comparison.order_mismatch_at + 1}). "
+              "check the ORDER BY column(s), and whether each should be ASC or DESC")
+    if comparison.extra_count and not comparison.missing_count:
+      example = f", eg {comparison.extra_rows[0]}" if comparison.extra_rows else ""
+      return (f"your query returns {_plural(comparison.extra_count, 'row')} too many{example}. every row it should return is there, "
+              "so it's probably missing a condition (in the WHERE, HAVING or a JOIN) that the correct answer filters on")
+    if comparison.missing_count and not comparison.extra_count:
+      example = f", eg {comparison.missing_rows[0]}" if comparison.missing_rows else ""
+      return (f"your query is missing {_plural(comparison.missing_count, 'row')} of the correct result{example}. every row it returns is right, "
+              "so a condition is probably too strict, or an INNER JOIN is dropping rows that a LEFT JOIN would keep")
+    return None
+
+  model_result, user_result = grade.model_result, grade.user_result
+  if isinstance(model_result, ChangeSet) and isinstance(user_result, ChangeSet):
+    if model_result.table.lower() != user_result.table.lower():
+      return f"your statement changed {user_result.table}, but the question is about {model_result.table}"
+    if not user_result and model_result:
+      return "your statement didn't change any rows, its WHERE condition probably doesn't match any"
+    if user_result.counts != model_result.counts:
+      return f"your statement: {user_result.summary()}, the correct answer: {model_result.summary()}. check the WHERE condition picks out the right rows"
+  if isinstance(model_result, SchemaDiff) and isinstance(user_result, SchemaDiff):
+    if not user_result.changes and model_result.changes:
+      return "your statement didn't change the schema (maybe the object already existed, or IF EXISTS / IF NOT EXISTS skipped it)"
+    if {(object_type, name.lower()) for _, object_type, name, _ in user_result.changes} != {(object_type, name.lower()) for _, object_type, name, _ in model_result.changes}:
+      return f"your statement changed: {user_result.summary()}, but the question is about: {model_result.summary()}"
+  return None
+
+def feedback_prompt_input(incorrect_answers):
+  # incorrect_answers are (question, model answer, user answer), in the form the feedback prompt expects
+  prompt_input = ""
+  for question, model_answer, user_answer in incorrect_answers:
+    prompt_input = prompt_input + f"""
+Question: {question}
+Model Answer (correct): {model_answer}
+User Answer (incorrect): {user_answer}
+
+"""
+  return prompt_input
+
+def get_feedback(model, incorrect_answers):
+  # a ModelFeedback, one comment per incorrect answer. asked again with the improvement message if the first reply is invalid
+  prompt_input = feedback_prompt_input(incorrect_answers)
+  try:
+    return model.get_quiz_answer_feedback(prompt_input)
+  except:
+    try:
+      return model.get_quiz_answer_feedback(prompt_input, improvement=True)
+    except:
+      raise ValueError
+
+async def aget_feedback(model, incorrect_answers):
+  prompt_input = feedback_prompt_input(incorrect_answers)
+  try:
+    return await model.aget_quiz_answer_feedback(prompt_input)
+  except:
+    try:
+      return await model.aget_quiz_answer_feedback(prompt_input, improvement=True)
+    except:
+      raise ValueError
+
+def feedback_on_incorrect_answers(model, incorrect_answers):
+  # incorrect_answers are (question, model answer, user answer, Grade). one comment per answer: the rules' where they can
+  # explain it, the rest from a single llm request about all of them together (None if that fails)
+  comments = [rule_based_feedback(grade, model_answer, user_answer) for _, model_answer, user_answer, grade in incorrect_answers]
+  remaining = [(question, model_answer, user_answer) for (question, model_answer, user_answer, _), comment in zip(incorrect_answers, comments)
+               if comment is None]
+  llm_comments = []
+  if remaining:
+    try:
+      llm_comments = get_feedback(model, remaining).comments
+    except ValueError:
+      pass
+  llm_comments = iter(llm_comments)
+  return [comment if comment is not None else next(llm_comments, None) for comment in comments]
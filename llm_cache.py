@@ -0,0 +1,96 @@
+# caches the chat model's responses on disk, keyed by a hash of the model config and the rendered prompt. langchain's own
+# llm cache is skipped whenever a model is streamed, so this wraps the model instead, and covers invoke and stream alike
+# modes: "cache" serves repeated prompts from disk, "record" always asks the model and saves every response, and "replay"
+# only answers from what was recorded (without any network access), so the app can run offline and deterministically
+import hashlib
+import json
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from cache import llm_response_cache
+
+MODES = ("off", "cache", "record", "replay")
+
+
+class ResponseNotRecordedError(ValueError):
+  pass
+
+
+def configure_response_cache(cache_config):
+  mode = cache_config.get('mode', "off")
+  if mode not in MODES:
+    raise ValueError(f"invalid [llm_cache] mode {mode!r}, expected one of {', '.join(MODES)}")
+  llm_response_cache.path = cache_config.get('path', llm_response_cache.path)
+  llm_response_cache.max_bytes = cache_config.get('max_mb', llm_response_cache.max_bytes // (1024 * 1024)) * 1024 * 1024
+  # recordings are kept until they're recorded over, a ttl would have replays start failing after a while
+  llm_response_cache.ttl_seconds = 0 if mode in ("record", "replay") else cache_config.get('ttl_seconds', 0)
+
+
+class CachedChatModel(BaseChatModel):
+  chat_model: BaseChatModel
+  model_key: str # hash of the [model] config, so the model, provider and sampling settings are all part of the key
+  mode: str = "cache"
+  response_cache: Any = llm_response_cache
+
+  @property
+  def _llm_type(self):
+    return "cached-" + self.chat_model._llm_type
+
+  def _key(self, messages, stop):
+    prompt = json.dumps([[message.type, message.content] for message in messages] + [stop], sort_keys=True)
+    return "llm:" + hashlib.sha256((self.model_key + prompt).encode()).hexdigest()
+
+  def _lookup(self, key):
+    if self.mode == "record":
+      return None # always asks the model, so re-recording replaces old responses
+    text = self.response_cache.get(key)
+    if text is None and self.mode == "replay":
+      raise ResponseNotRecordedError("no recorded response for this prompt, record it first with [llm_cache] mode=\"record\"")
+    return text
+
+  def _result(self, text):
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+  def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+    key = self._key(messages, stop)
+    text = self._lookup(key)
+    if text is None:
+      text = self.chat_model.invoke(messages, stop=stop, **kwargs).content
+      self.response_cache.set(key, text)
+    return self._result(text)
+
+  async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+    key = self._key(messages, stop)
+    text = self._lookup(key)
+    if text is None:
+      text = (await self.chat_model.ainvoke(messages, stop=stop, **kwargs)).content
+      self.response_cache.set(key, text)
+    return self._result(text)
+
+  # a cached response comes back as a single chunk. a streamed one is only saved once the stream has finished, so
+  # a stream abandoned part way through isn't cached as a truncated response
+  def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+    key = self._key(messages, stop)
+    text = self._lookup(key)
+    if text is not None:
+      yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+      return
+    chunks = []
+    for chunk in self.chat_model.stream(messages, stop=stop, **kwargs):
+      chunks.append(chunk.content)
+      yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+    self.response_cache.set(key, "".join(chunks))
+
+  async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+    key = self._key(messages, stop)
+    text = self._lookup(key)
+    if text is not None:
+      yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+      return
+    chunks = []
+    async for chunk in self.chat_model.astream(messages, stop=stop, **kwargs):
+      chunks.append(chunk.content)
+      yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+    self.response_cache.set(key, "".join(chunks))
@@ -1,29 +1,25 @@
 # handles llm interaction
-import requests
 import re
-from pydantic import BaseModel, field_validator
+import json
+import asyncio
+from collections import deque
+from pydantic import BaseModel, field_validator, ValidationError
 from typing import List
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 from langchain_huggingface import HuggingFaceEndpoint, ChatHuggingFace
 
 from database import UserDatabase, SQLiteUserDatabase, valid_sql_query
-
-#################
-
-def verify_api_key(api_key):
-  # for now, as hf is the only supported endpoint
-  return _verify_hf_api_key(api_key)
-
-def _verify_hf_api_key(api_key):
-  response = requests.get('https://huggingface.co/api/whoami-v2', headers={"Authorization": f"Bearer {api_key}"})
-  if response.status_code == 200:
-    return True
-  return False
+from cache import ResourceCache
+from llm_cache import CachedChatModel
+from prompt_context import PromptContextBuilder
+from tracing import tracer
+from util import hash_config, hash_text
 
 #################
 
 class ModelQuizQuestionOutput(BaseModel):
+  topic: str = "" # the one requested topic the question mainly tests, used to file it in the question bank
   quiz_question: str
   correct_sql_answer: str
 
@@ -38,14 +34,113 @@ class ListOfQuizQuestions(BaseModel):
   questions_and_answers: List[ModelQuizQuestionOutput]
 
 quiz_question_parser = PydanticOutputParser(pydantic_object=ListOfQuizQuestions)
+quiz_format_instructions = quiz_question_parser.get_format_instructions() # worked out once, not per prompt template
 
 class ModelFeedback(BaseModel):
   comments: List[str]
 
 feedback_parser = PydanticOutputParser(pydantic_object=ModelFeedback)
+feedback_format_instructions = feedback_parser.get_format_instructions()
+
+class QuizQuestionStreamParser:
+  # pulls each question out of a streamed quiz response as soon as its object's closing brace arrives,
+  # rather than waiting for the whole JSON document like quiz_question_parser does
+  def __init__(self):
+    self.text = ""
+    self.position = None # where scanning is up to, once the questions_and_answers array has started
+    self.depth = 0
+    self.in_string = False
+    self.escaped = False
+    self.object_start = None
+    self.finished = False
+    self.rejected = [] # FailedQuizQuestion for each question that came back invalid, so it can be repaired
+
+  def feed(self, chunk):
+    self.text += chunk
+    questions = []
+    if self.position is None:
+      array_start = re.search(r'"questions_and_answers"\s*:\s*\[', self.text)
+      if not array_start:
+        return questions
+      self.position = array_start.end()
+
+    while self.position < len(self.text) and not self.finished:
+      char = self.text[self.position]
+      if self.in_string:
+        if self.escaped:
+          self.escaped = False
+        elif char == '\\':
+          self.escaped = True
+        elif char == '"':
+          self.in_string = False
+      elif char == '"':
+        self.in_string = True
+      elif char == '{':
+        if self.depth == 0:
+          self.object_start = self.position
+        self.depth += 1
+      elif char == '}':
+        self.depth -= 1
+        if self.depth == 0:
+          question = self._parse_question(self.text[self.object_start:self.position + 1])
+          if question:
+            questions.append(question)
+      elif char == ']' and self.depth == 0:
+        self.finished = True
+      self.position += 1
+    return questions
+
+  def _parse_question(self, object_text):
+    # a malformed or invalid question is set aside on its own, the rest of the quiz still counts
+    try:
+      return ModelQuizQuestionOutput.model_validate_json(object_text)
+    except ValidationError as e:
+      try:
+        fields = json.loads(object_text)
+        self.rejected.append(FailedQuizQuestion(fields.get('topic', ""), fields['quiz_question'], fields['correct_sql_answer'],
+                                                e.errors()[0]['msg']))
+      except:
+        pass # not even a question, nothing to repair
+      return None
+
+class FailedQuizQuestion:
+  # a generated question whose answer failed validation, kept with the error so the model can be asked to fix just this one
+  def __init__(self, topic, quiz_question, correct_sql_answer, error):
+    self.topic = topic
+    self.quiz_question = quiz_question
+    self.correct_sql_answer = correct_sql_answer
+    self.error = error
+
+  def __str__(self):
+    return f"""Topic: {self.topic}
+Question: {self.quiz_question}
+Answer: {self.correct_sql_answer}
+Error: {self.error}
+"""
 
 #################
 
+def build_huggingface_model(model_config, api_key):
+  hf_endpoint = HuggingFaceEndpoint(
+  repo_id=model_config['repo_id'], provider=model_config['provider'],
+  temperature=model_config.get('temperature', 0.95),
+  max_new_tokens=model_config.get('max_new_tokens', 768),
+  huggingfacehub_api_token=api_key)
+  return ChatHuggingFace(llm=hf_endpoint)
+
+model_builders = {"hf": build_huggingface_model} # endpoint (as in app_config.toml [model] endpoint) -> function building its chat model
+
+def register_model_builder(endpoint, build):
+  model_builders[endpoint] = build
+
+model_clients = ResourceCache(max_size=16) # (model config hash, api key hash) -> chat model
+quiz_llms = ResourceCache(max_size=64) # (config hash, api key hash, database hash, session id) -> SQLQuizLLM
+
+def get_quiz_llm(config_dict, api_key, database):
+  # streamlit reruns the page script on every interaction, this keeps one SQLQuizLLM (and its chains) per session instead
+  key = (hash_config(config_dict), hash_text(api_key), database.db_hash, getattr(database, "session_id", None))
+  return quiz_llms.get_or_create(key, lambda: SQLQuizLLM(config_dict, api_key, database))
+
 class SQLQuizLLM: # overall handling of the whole process
   def __init__(self, config_dict, api_key, database: UserDatabase | SQLiteUserDatabase):
     self.config = config_dict
@@ -54,41 +149,179 @@ class SQLQuizLLM: # overall handling of the whole process
     self.database = database
 
     self.quiz_prompt_template = self.set_prompt_template()
+    self.repair_prompt_template = self.set_repair_template()
     self.feedback_prompt_template = self.set_feedback_template()
     self.improvement_msg = self.set_improvement_msg()
     self.num_questions = self.config['quiz']['num_questions']
+    self.questions_per_request = self.config['quiz'].get('questions_per_request', 2) # for concurrent generation
+    self.max_concurrent_requests = self.config['quiz'].get('max_concurrent_requests', 4)
+    self.prompt_context = PromptContextBuilder.from_config(self.config.get('prompt', {}))
+    self.token_usage = deque(maxlen=100) # {"request", "schema", "sample_data", "total"} context token counts, one per request sent
 
-
-    self.quiz_chain = self.quiz_prompt_template | self.model | self._parse_llm_response | quiz_question_parser
-    self.feedback_chain = self.feedback_prompt_template | self.model | self._parse_llm_response | feedback_parser
+    quiz_model = self._with_response_cache(self.model, "quiz")
+    feedback_model = self._with_response_cache(self.model, "feedback")
+    self.quiz_stream_chain = self.quiz_prompt_template | quiz_model # parsed incrementally, by QuizQuestionStreamParser
+    self.repair_stream_chain = self.repair_prompt_template | quiz_model
+    self.feedback_chain = self.feedback_prompt_template | feedback_model | self._parse_llm_response | feedback_parser
 
   def set_model(self):
-    if self.config['model']['endpoint'] == 'hf':
-      hf_endpoint = HuggingFaceEndpoint(
-      repo_id=self.config['model']['repo_id'], provider=self.config['model']['provider'],
-      temperature=0.95,
-      max_new_tokens=768,
-      huggingfacehub_api_token=self.api_key)
-
-      model = ChatHuggingFace(llm=hf_endpoint)
-    else:
+    # model clients are shared by every SQLQuizLLM with the same model config and API key
+    key = (hash_config(self.config['model']), hash_text(self.api_key))
+    return model_clients.get_or_create(key, self._build_model)
+
+  def _with_response_cache(self, model, request):
+    cache_config = self.config.get('llm_cache', {})
+    mode = cache_config.get('mode', "off")
+    if mode == "off":
+      return model
+    # quizzes are sampled so that asking again gives new questions (for the question bank too), so outside of
+    # record/replay they're only cached if asked for
+    if mode == "cache" and request == "quiz" and not cache_config.get('cache_quiz_generation', False):
+      return model
+    return CachedChatModel(chat_model=model, model_key=hash_config(self.config['model']), mode=mode)
+
+  def _build_model(self):
+    if self.config['model']['endpoint'] not in model_builders:
       raise ValueError("invalid/unsupported endpoint given in config") # this would change in the future to accept different endpoints :)))
-    return model
+    return model_builders[self.config['model']['endpoint']](self.config['model'], self.api_key)
 
-  def generate_quiz(self, topic_list):
-    valid_quiz = False
-    while not valid_quiz:
-      try:
-        response = self._get_quiz_questions_and_answers(topic_list)
-        return response.questions_and_answers
-      except:
+  def generate_quiz_concurrently(self, topic_list, num_questions=None, on_question=None):
+    # sync entry point for the streamlit pages, which don't run an event loop of their own
+    # on_question is called with each question as it arrives, so a page can show them before the quiz is finished
+    async def collect_quiz():
+      quiz = []
+      async for question in self.astream_quiz(topic_list, num_questions):
+        quiz.append(question)
+        if on_question:
+          on_question(question)
+      return quiz
+    return asyncio.run(collect_quiz())
+
+  async def agenerate_quiz(self, topic_list, num_questions=None, semaphore=None):
+    return [question async for question in self.astream_quiz(topic_list, num_questions, semaphore)]
+
+  async def astream_quiz(self, topic_list, num_questions=None, semaphore=None):
+    # the quiz is split into small per-topic requests that run concurrently, so a longer quiz doesn't mean a longer wait
+    # and one malformed response only loses the few questions in that request. every request is streamed, and each
+    # question is yielded as soon as it has been parsed, from whichever request gets there first
+    # semaphore bounds the requests running at once, callers generating several quizzes together can share one
+    num_questions = num_questions or self.num_questions
+    semaphore = semaphore or asyncio.Semaphore(self.max_concurrent_requests)
+    arrived = asyncio.Queue()
+
+    async def run_sub_request(topics, sub_num_questions):
+      async with semaphore:
+        received = 0
+        failed = []
+        try:
+          async for question in self._astream_valid_questions(self._quiz_chain_input(topics, False, sub_num_questions), failed, request="quiz"):
+            if len(topics) == 1:
+              question.topic = topics[0]
+            received += 1
+            await arrived.put(question)
+        except:
+          pass
+        if received >= sub_num_questions:
+          return
+
+        # only what went wrong is retried: invalid questions are sent back with their errors to be repaired,
+        # and anything that never arrived at all is asked for again
+        for failed_question in failed:
+          failed_question.topic = failed_question.topic or topics[0]
+        retry_input = (self._repair_chain_input(failed[:sub_num_questions - received]) if failed
+                       else self._quiz_chain_input(topics, True, sub_num_questions - received))
+        chain = self.repair_stream_chain if failed else self.quiz_stream_chain
         try:
-          response = self._get_quiz_questions_and_answers(topic_list, improvement="""
-                                                          Your previous attempt failed to generate a valid output. Adhere strictly to the query and formatting rules given, and ensure the SQL queries you give are valid.
-                                                          """)
-          return response.questions_and_answers
+          async for question in self._astream_valid_questions(retry_input, [], chain=chain, request="repair" if failed else "quiz", retry=1):
+            if len(topics) == 1:
+              question.topic = topics[0]
+            await arrived.put(question)
         except:
-          raise RuntimeError
+          pass
+
+    async def run_sub_requests():
+      await asyncio.gather(*(run_sub_request(topics, n) for topics, n in self._split_quiz(topic_list, num_questions)))
+      await arrived.put(None)
+
+    sub_requests = asyncio.create_task(run_sub_requests())
+    seen_answers = set()
+    num_yielded = 0
+    while (question := await arrived.get()) is not None:
+      if num_yielded < num_questions and self._is_new_question(question, seen_answers):
+        num_yielded += 1
+        yield question
+    await sub_requests
+
+    if num_yielded < num_questions: # some sub-requests failed, one request across all the topics for whatever is missing
+      try:
+        async for question in self._astream_valid_questions(self._quiz_chain_input(topic_list, False, num_questions - num_yielded), [], request="quiz_top_up"):
+          if num_yielded < num_questions and self._is_new_question(question, seen_answers):
+            num_yielded += 1
+            yield question
+      except:
+        pass
+    if not num_yielded:
+      raise RuntimeError
+
+  async def _astream_valid_questions(self, chain_input, failed, chain=None, request="quiz", retry=0):
+    # yields each question once it has parsed and passed validate_question, anything that fails goes in failed instead
+    chain = chain or self.quiz_stream_chain
+    parser = QuizQuestionStreamParser()
+    with self._llm_span(request, chain, chain_input, retry) as span:
+      async for chunk in chain.astream(chain_input):
+        for question in parser.feed(chunk.content):
+          error = await asyncio.to_thread(self.validate_question, question) # runs a query, so off the event loop
+          if error:
+            failed.append(FailedQuizQuestion(question.topic, question.quiz_question, question.correct_sql_answer, error))
+          else:
+            yield question
+      failed.extend(parser.rejected)
+      span.set(completion_tokens=self.prompt_context.tokenizer(parser.text), invalid_questions=len(failed))
+
+  def _llm_span(self, request, chain, chain_input, retry=0):
+    # token counts are estimated with the prompt context's tokenizer, and only worked out while tracing is on
+    span = tracer.span("llm." + request, model=self.config['model'].get('repo_id'), provider=self.config['model'].get('provider'),
+                       endpoint=self.config['model'].get('endpoint'), retry=retry)
+    if tracer.enabled:
+      span.set(prompt_tokens=self.prompt_context.tokenizer(chain.first.format(**chain_input)))
+    return span
+
+  def _invoke_traced(self, request, chain, chain_input, retry=0):
+    with self._llm_span(request, chain, chain_input, retry) as span:
+      response = chain.invoke(chain_input)
+      if tracer.enabled:
+        span.set(completion_tokens=self.prompt_context.tokenizer(response.model_dump_json()))
+    return response
+
+  def validate_question(self, question):
+    # the syntax check already happened in ModelQuizQuestionOutput, this makes sure the answer actually compiles against
+    # the user's database (eg no made-up tables or columns). returns the error message, or None if it's fine
+    return self.database.explain_query(question.correct_sql_answer)
+
+  def _split_quiz(self, topic_list, num_questions):
+    # shares the questions out between the topics as evenly as possible, then breaks each topic's share into requests
+    # of at most questions_per_request. with fewer questions than topics, each question gets its own topic
+    topics = list(topic_list)[:num_questions] if num_questions < len(topic_list) else list(topic_list)
+    shares = [num_questions // len(topics) + (1 if i < num_questions % len(topics) else 0) for i in range(len(topics))]
+    sub_requests = []
+    for topic, share in zip(topics, shares):
+      while share > 0:
+        sub_num_questions = min(share, self.questions_per_request)
+        sub_requests.append(([topic], sub_num_questions))
+        share -= sub_num_questions
+    return sub_requests
+
+  def _is_new_question(self, question, seen_answers):
+    # drops repeats (the same answer query, ignoring case and whitespace) that separate requests came up with independently
+    answer_key = " ".join(question.correct_sql_answer.upper().split())
+    if answer_key in seen_answers:
+      return False
+    seen_answers.add(answer_key)
+    return True
+
+  def question_bank_key(self):
+    # questions are only reusable for the same schema, written by the same model
+    return self.database.get_schema_hash(), self.config['model']['repo_id']
 
   def _parse_llm_response(self, response):
     json_text = re.search(r'\{.*\}', response.content, re.DOTALL)
@@ -96,36 +329,57 @@ class SQLQuizLLM: # overall handling of the whole process
       return json_text.group(0)
     raise ValueError('no valid JSON found')
   
-  def _get_quiz_questions_and_answers(self, topic_list, improvement = False):
+  def _prompt_context(self, request, topics):
+    # the schema and sample data for a prompt, cut down to fit the configured token budget
+    context = self.prompt_context.build(self.database, topics)
+    self.token_usage.append({"request": request, **context.token_counts})
+    return context
+
+  def _quiz_chain_input(self, topic_list, improvement, num_questions):
     if not improvement:
       improvement = ""
     else:
       improvement = self.improvement_msg
-    
-    try:
-      response = self.quiz_chain.invoke({"schema": self.database.get_schema(),
-                                        "sample_data": self.database.sample_data,
-                                        "topics": str(topic_list),
-                                        "num_questions": str(self.num_questions),
-                                        "rdbms": self.database.rdbms,
-                                        "improvement": improvement})
-    except:
-      raise RuntimeError
-    return response
-  
+    context = self._prompt_context("quiz", topic_list)
+    return {"schema": context.schema,
+            "sample_data": context.sample_data,
+            "topics": str(topic_list),
+            "num_questions": str(num_questions or self.num_questions),
+            "rdbms": self.database.rdbms,
+            "improvement": improvement}
+
+  def _repair_chain_input(self, failed_questions):
+    context = self._prompt_context("repair", sorted({failed_question.topic for failed_question in failed_questions}))
+    return {"schema": context.schema,
+            "sample_data": context.sample_data,
+            "failed_questions": "\n".join(str(failed_question) for failed_question in failed_questions),
+            "num_questions": str(len(failed_questions)),
+            "rdbms": self.database.rdbms}
+
   def get_quiz_answer_feedback(self, input_questions_and_answers, improvement = False):
     if not improvement:
       improvement = ""
     else:
       improvement = self.improvement_msg
     try:
-      response = self.feedback_chain.invoke({"schema": self.database.get_schema(),
-                                            "questions_and_answers": input_questions_and_answers,
-                                            "improvement": improvement})
+      response = self._invoke_traced("feedback", self.feedback_chain, {"schema": self._prompt_context("feedback", []).schema,
+                                                                      "questions_and_answers": input_questions_and_answers,
+                                                                      "improvement": improvement}, retry=int(bool(improvement)))
       return response
     except:
       raise RuntimeError
   
+  async def aget_quiz_answer_feedback(self, input_questions_and_answers, improvement = False):
+    chain_input = {"schema": self._prompt_context("feedback", []).schema,
+                   "questions_and_answers": input_questions_and_answers,
+                   "improvement": self.improvement_msg if improvement else ""}
+    try:
+      with self._llm_span("feedback", self.feedback_chain, chain_input, retry=int(bool(improvement))):
+        response = await self.feedback_chain.ainvoke(chain_input)
+      return response
+    except:
+      raise RuntimeError
+
   def set_improvement_msg(self):
     return """
           Your previous attempt did not generate a valid json document within { }. Ensure the response is in this format.
@@ -138,15 +392,16 @@ You are setting an SQL quiz, with {num_questions} questions.
 The database to use for questions has the following schema:
 {schema}
 
-The following are examples of data in each table in the database:
+The following are examples of data in each table in the database, and summaries of the values in each column:
 {sample_data}
 
 Generate a list of {num_questions} question & answer pairs.
 Each question should ask the user to write a query specific to this database, and the answer is an SQL query that is the correct solution to the question.
 All answer queries MUST involve at least one of the following SQL query topics or keywords in their functionality: {topics}.
+Label each question with the one topic from that list that it mainly tests, written exactly as it appears in the list.
 If the answer is a SELECT statement, the question should explicitly tell the user which columns to return.
 Every answer should only contain ONE SQL query.
-You should use values from the example data provided, if questions require querying against specific values of columns.
+You should use values from the example data and column value summaries provided, if questions require querying against specific values of columns, so that answers return rows.
 Answer queries should end in a semi-colon, and be written in one line with no breaks.
 
 Ensure that all answer queries are correct given the schema, and all involve at least one of the topics given.
@@ -160,9 +415,36 @@ Return nothing but a valid JSON document described above.
     prompt_template = PromptTemplate(
     input_variables=["schema", "topics", "num_questions", "rdbms", "improvement"],
     template=text_template,
-    partial_variables={'format_instruction': quiz_question_parser.get_format_instructions()})
+    partial_variables={'format_instruction': quiz_format_instructions})
     return prompt_template
   
+  def set_repair_template(self):
+    text_template = """
+You are fixing {num_questions} question & answer pair(s) in an SQL quiz. Each answer query below failed when it was checked, with the error given:
+{failed_questions}
+
+The database to use for questions has the following schema:
+{schema}
+
+The following are examples of data in each table in the database, and summaries of the values in each column:
+{sample_data}
+
+Return a corrected version of each pair. Keep the question if it makes sense for this database and fix the answer query, otherwise rewrite both to test the same topic.
+Keep each question's topic label the same.
+If the answer is a SELECT statement, the question should explicitly tell the user which columns to return.
+Every answer should only contain ONE SQL query.
+Answer queries should end in a semi-colon, and be written in one line with no breaks.
+Queries should be written in {rdbms} syntax.
+
+{format_instruction}
+Return nothing but a valid JSON document described above.
+"""
+    prompt_template = PromptTemplate(
+    input_variables=["schema", "sample_data", "failed_questions", "num_questions", "rdbms"],
+    template=text_template,
+    partial_variables={'format_instruction': quiz_format_instructions})
+    return prompt_template
+
   def set_feedback_template(self):
     text_template = """
 You are marking an SQL quiz. Generate a list of text comments in response to the user's incorrect answers, one comment for each answer.
@@ -178,7 +460,7 @@ Return nothing but a valid JSON document described above.
     prompt_template = PromptTemplate(
     input_variables=["schema", "questions_and_answers", "improvement"],
     template=text_template,
-    partial_variables={'format_instruction': feedback_parser.get_format_instructions()})
+    partial_variables={'format_instruction': feedback_format_instructions})
     
     return prompt_template
   
\ No newline at end of file
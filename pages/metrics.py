@@ -0,0 +1,32 @@
+# a hidden page (only reachable at /metrics) summarising the spans recorded while [tracing] is enabled in app_config.toml
+import streamlit as st
+from util import load_app_config
+from tracing import tracer, summarise_latencies, summarise_token_spend
+
+config = load_app_config()
+tracer.configure(config.get('tracing', {}))
+
+st.title("metrics")
+
+if not tracer.enabled:
+  st.write("tracing is turned off, set `enabled=true` under `[tracing]` in `app_config.toml` to start recording")
+
+spans = tracer.read_spans()
+if not spans:
+  st.write(f"no spans recorded in `{tracer.path}` yet")
+else:
+  st.write(f"{len(spans)} spans from `{tracer.path}` (and its rotated files)")
+
+  st.subheader("latency")
+  st.dataframe(data=summarise_latencies(spans), hide_index=True)
+
+  st.subheader("llm token spend")
+  st.write("token counts are estimates from the prompt context's tokenizer, not the provider's own counts")
+  token_spend = summarise_token_spend(spans)
+  if token_spend:
+    st.dataframe(data=token_spend, hide_index=True)
+  else:
+    st.write("no llm requests recorded yet")
+
+  if st.button("refresh"):
+    st.rerun()
@@ -4,9 +4,20 @@ from util import load_app_config
 
 st.session_state.config = load_app_config()
 
-from model import SQLQuizLLM
-
-model = SQLQuizLLM(st.session_state.config, st.session_state.llm_api_key, st.session_state.database)
+from model import get_quiz_llm
+from question_bank import question_bank, question_bank_refiller
+from database import QueryCancelledError, ChangeSet, SchemaDiff
+from grading import grade_answer, feedback_on_incorrect_answers, prefetch_model_answers
+from result_pages import result_table, page_count, result_page
+from tracing import tracer
+from llm_cache import configure_response_cache
+
+question_bank.path = st.session_state.config['question_bank']['path']
+question_bank.target_per_topic = st.session_state.config['question_bank']['target_per_topic']
+tracer.configure(st.session_state.config.get('tracing', {}))
+configure_response_cache(st.session_state.config.get('llm_cache', {}))
+
+model = get_quiz_llm(st.session_state.config, st.session_state.llm_api_key, st.session_state.database)
 st.session_state.model = model
 
 class QuizElement:
@@ -17,6 +28,9 @@ class QuizElement:
     self.model_answer = question_and_answer.correct_sql_answer
     self.answerable = True
     self.correct = None
+    self.comparison = None # ResultComparison, for SELECT answers
+    self.grade = None
+    self.graded = False # results are kept once marked, so reruns of the results page don't touch the database
 
   def show(self):
     st.write("Question " + self.key + ":")
@@ -46,81 +60,87 @@ class QuizElement:
     self.correct = is_correct
 
 
-def execute_answer_query(query):
-  try:
-    result = st.session_state.database.execute_query(query)
-    return result, True
-  except:
-    return [], False # empty answer
-
-def display_query_and_result(query, result_data):
+def display_query_and_result(query, result_data, key):
   st.markdown("`" + query + "`")
-  st.dataframe(data=result_data)
+  if isinstance(result_data, (ChangeSet, SchemaDiff)): # DML and DDL answers show just what they changed
+    st.markdown(f"*{result_data.summary()}*")
+    if not result_data:
+      return
+  # a page of the result at a time, so big results aren't all sent to the browser on every rerun
+  table = result_table(st.session_state.database, query, result_data)
+  page_rows = st.session_state.config['database'].get('result_page_rows', 50)
+  pages = page_count(table, page_rows)
+  page = st.number_input(f"page (of {pages})", min_value=1, max_value=pages, key="page_" + key) if pages > 1 else 1
+  st.dataframe(data=result_page(table, page, page_rows), hide_index=True)
+  if pages > 1:
+    st.markdown(f"*rows {(page - 1) * page_rows + 1} to {min(page * page_rows, table.num_rows)} of {table.num_rows}*")
+  if getattr(result_data, "truncated", False):
+    st.markdown(f"*only the first {len(result_data)} rows were fetched*")
+
+def display_query_warning(error, warning):
+  if isinstance(error, QueryCancelledError):
+    st.markdown("*warning: this query was stopped for taking too long to run*")
+  elif error is not None:
+    st.markdown(warning)
+
+def mark_answer(element):
+  grade = grade_answer(st.session_state.database, element.model_answer, element.user_answer)
+  element.model_result, element.model_error = grade.model_result, grade.model_error
+  element.user_result, element.user_error = grade.user_result, grade.user_error
+  element.comparison = grade.comparison
+  element.grade = grade
+  element.set_correct(grade.correct)
+  element.graded = True
 
 def quiz_submitted():
   score = 0
+  ungraded = 0
   incorrect_questions = []
 
   for i, element in enumerate(st.session_state.quiz_question_form_elements):
     st.write(f"Question {i+1}: {element.question}")
 
-    model_answer_result, valid_model_answer = execute_answer_query(element.model_answer)
-    user_answer_result, valid_user_answer = execute_answer_query(element.user_answer)
+    if not element.graded:
+      mark_answer(element)
 
     st.write("The result of your query:")
-    display_query_and_result(element.user_answer, user_answer_result)
-    if not valid_user_answer:
-      st.markdown("*warning: you may not have entered a valid, executable query*")
+    display_query_and_result(element.user_answer, element.user_result, "user_" + element.key)
+    display_query_warning(element.user_error, "*warning: you may not have entered a valid, executable query*")
 
     st.write("The correct result:")
-    display_query_and_result(element.model_answer, model_answer_result)
-    if not valid_model_answer:
-      st.markdown("*warning: this result might not be valid or what was requested from the llm. these models can be a bit stupid*")
-
-    # mark each question as right/wrong
-    correct = (element.model_answer.upper() == element.user_answer.upper()) or (valid_user_answer and (model_answer_result == user_answer_result))
-
-
-    element.set_correct(correct)
-
-    if element.correct:
+    display_query_and_result(element.model_answer, element.model_result, "model_" + element.key)
+    display_query_warning(element.model_error, "*warning: this result might not be valid or what was requested from the llm. these models can be a bit stupid*")
+
+    if element.grade.ungraded: # not marked either way, rather than marked wrong because the comparison ran out of time
+      st.markdown("*this answer couldn't be marked: comparing it with the correct answer "
+                  + ("took too long" if isinstance(element.grade.comparison_error, QueryCancelledError) else "failed") + ". compare the results above yourself*")
+      ungraded += 1
+    elif element.correct:
       score += 1
     else:
       incorrect_questions.append(element)
 
 
   if incorrect_questions:
-    try:
-      feedback = get_feedback_on_incorrect_answers(incorrect_questions).comments
-      st.write(f"You got {score} question(s) right! Some feedback on your incorrect answer(s):")
-      for comment in feedback:
-        st.write(comment)
-        st.divider()
-      st.write("Please note that model responses may be incorrect, don't take it's answers as 100% correct!")
-    except:
-      st.write("uh oh! the llm failed to generate valid comments. sorry! hope u can spot ur mistakes anyway by looking at the answers above :P")
+    if st.session_state.get("quiz_feedback") is None: # only worked out once, not on every rerun
+      st.session_state.quiz_feedback = get_feedback_on_incorrect_answers(incorrect_questions)
+    feedback = st.session_state.quiz_feedback
+    st.write(f"You got {score} question(s) right! Some feedback on your incorrect answer(s):")
+    for element, comment in zip(incorrect_questions, feedback):
+      st.write(f"Question {element.key}: " + (comment or "uh oh! the llm failed to generate a valid comment on this one. sorry! hope u can spot ur mistake anyway by looking at the answers above :P"))
+      st.divider()
+    st.write("Please note that model responses may be incorrect, don't take it's answers as 100% correct!")
+  elif ungraded:
+    st.write(f"You got {score} question(s) right, and {ungraded} couldn't be marked!")
   else:
     st.write("You got every question right! Well Done!")
 
 
 def get_feedback_on_incorrect_answers(incorrect_questions):
-  prompt_input = ""
-  for element in incorrect_questions:
-    prompt_input = prompt_input + f"""
-Question: {element.question}
-Model Answer (correct): {element.model_answer}
-User Answer (incorrect): {element.get_user_answer()}
-
-"""
-  with st.spinner("getting feedback on incorrect results..."):
-    try:
-      feedback = st.session_state.model.get_quiz_answer_feedback(prompt_input)
-    except:
-      try:
-        feedback = st.session_state.model.get_quiz_answer_feedback(prompt_input, improvement=True)
-      except:
-        raise ValueError
-  return feedback
+  # mechanically obvious mistakes are explained straight away, the spinner is only for the llm's comments on the rest
+  with st.spinner("getting feedback on incorrect results..."), tracer.span("page.feedback", incorrect=len(incorrect_questions)):
+    return feedback_on_incorrect_answers(st.session_state.model, [(element.question, element.model_answer, element.get_user_answer(), element.grade)
+                                                                  for element in incorrect_questions])
 
 def all_answers_have_been_entered():
   for element in st.session_state.quiz_question_form_elements:
@@ -147,14 +167,40 @@ def validate_quiz_len(quiz):
     raise ValueError # is handled outside
 
 def generate_quiz_questions(): # returns a bool if a valid quiz was/wasn't created
-  with st.spinner("generating quiz..."):
-    try:
-      quiz = st.session_state.model.generate_quiz(st.session_state.topics)
-      st.session_state.quiz = quiz
-      validate_quiz_len(quiz) # errors if quiz is not the right length
-      return True
-    except: # i know this is poor error-handling, I will ammend this in the future
-      return False 
+  model = st.session_state.model
+  topics = st.session_state.topics
+  num_questions = st.session_state.config['quiz']['num_questions']
+  schema_hash, repo_id = model.question_bank_key()
+
+  # banked questions for this schema are served straight away, and only whatever the bank is short of gets generated now
+  quiz = question_bank.take(schema_hash, repo_id, topics, num_questions)
+  for question_and_answer in quiz:
+    add_quiz_element(question_and_answer)
+  try:
+    if len(quiz) < num_questions:
+      with st.status("generating quiz...") as status, tracer.span("page.generate_quiz", banked=len(quiz), generated=num_questions - len(quiz)):
+        def show_generated_question(question_and_answer): # streamed in as each question arrives
+          element = add_quiz_element(question_and_answer)
+          status.write(f"Question {element.key}: {element.question}")
+
+        generated = model.generate_quiz_concurrently(topics, num_questions=num_questions - len(quiz), on_question=show_generated_question)
+        question_bank.add_quiz(schema_hash, repo_id, topics, generated)
+        quiz = quiz + generated
+        status.update(label="quiz generated!", state="complete")
+    st.session_state.quiz = quiz
+    validate_quiz_len(quiz) # errors if quiz is not the right length
+    prefetch_model_answers(st.session_state.database, [question.correct_sql_answer for question in quiz])
+    return True
+  except: # i know this is poor error-handling, I will ammend this in the future
+    st.session_state.quiz_question_form_elements = []
+    return False
+  finally:
+    question_bank_refiller.request(model, topics) # tops up any topics running low, in the background
+
+def add_quiz_element(question_and_answer):
+  element = QuizElement(len(st.session_state.quiz_question_form_elements) + 1, question_and_answer)
+  st.session_state.quiz_question_form_elements.append(element)
+  return element
 
 def main():
   st.title("the quiz!")
@@ -171,12 +217,9 @@ def main():
 
     if not valid_quiz_generated:
       st.write("the LLM failed to generate a valid quiz. sorry! your best bet is going back to the home page and trying again :(")
-    else:
-      for i, question_and_answer in enumerate(st.session_state.quiz):
-        st.session_state.quiz_question_form_elements.append(QuizElement((i+1), question_and_answer))
 
 
-  if 'submit_button_clicked' in st.session_state:
+  if 'submit_button_clicked' in st.session_state and not st.session_state.submitted: # the answer boxes are gone once submitted
     if st.session_state.submit_button_clicked:
       if all_answers_have_been_entered():
         for element in st.session_state.quiz_question_form_elements:
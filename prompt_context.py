@@ -0,0 +1,194 @@
+# builds the schema and sample data parts of prompts, compactly and within a token budget
+import re
+
+def approximate_token_count(text):
+  # about 4 characters per token for english and SQL, close enough for budgeting without loading a real tokenizer
+  return (len(text) + 3) // 4
+
+# which parts of a database each topic needs, matched against the topic names in app.py (lowercased)
+TOPIC_FEATURES = [
+  ("self-join", "self_reference"),
+  ("join", "foreign_keys"),
+  ("exists", "foreign_keys"),
+  ("subquer", "foreign_keys"),
+  ("like", "text"),
+  ("text-matching", "text"),
+  ("aggregation", "numeric"),
+  ("group by", "numeric"),
+  ("having", "numeric"),
+  ("between", "numeric"),
+]
+
+NUMERIC_TYPES = ("INT", "REAL", "FLOA", "DOUB", "NUM", "DEC")
+TEXT_TYPES = ("CHAR", "CLOB", "TEXT")
+
+
+class PromptContext:
+  def __init__(self, schema, sample_data, token_counts):
+    self.schema = schema
+    self.sample_data = sample_data
+    self.token_counts = token_counts # {"schema": n, "sample_data": n, "total": n}
+
+
+class PromptContextBuilder:
+  # renders the schema as one compact CREATE statement per line, and sample rows as pipe-separated values with long values cut
+  # short. tables are ranked by how useful they are for the selected topics, and whatever doesn't fit in token_budget is left
+  # out, least useful first: sample columns with long values, then sample rows, then whole tables' samples, then their schema
+  # tokenizer is any callable from text to a token count
+  def __init__(self, token_budget=3000, max_value_chars=40, tokenizer=None, min_tables=3):
+    self.token_budget = token_budget
+    self.max_value_chars = max_value_chars
+    self.tokenizer = tokenizer or approximate_token_count
+    self.min_tables = min_tables
+    self._built = {} # (database hash, topics) -> PromptContext, the output only depends on these
+
+  @classmethod
+  def from_config(cls, prompt_config, tokenizer=None):
+    return cls(token_budget=prompt_config.get('context_token_budget', 3000),
+               max_value_chars=prompt_config.get('max_value_chars', 40),
+               tokenizer=tokenizer)
+
+  def build(self, database, topics=()):
+    key = (database.db_hash, tuple(topics))
+    if key not in self._built:
+      self._built[key] = self._build(database, topics)
+    return self._built[key]
+
+  def _build(self, database, topics):
+    table_info = getattr(database, "table_info", None) or {}
+    schema_statements = self._schema_statements(database)
+    ranked_tables = self.rank_tables(database.tables, table_info, topics)
+
+    # schema first, as questions can't be written without it. lowest ranked tables are dropped only if the schema alone won't fit
+    kept_tables = list(ranked_tables)
+    schema_text = self._render_schema(schema_statements, kept_tables)
+    while self.tokenizer(schema_text) > self.token_budget and len(kept_tables) > self.min_tables:
+      kept_tables.pop()
+      schema_text = self._render_schema(schema_statements, kept_tables)
+
+    remaining = self.token_budget - self.tokenizer(schema_text)
+    sample_parts = []
+    for table in kept_tables:
+      part = self._fit_sample(table, database.sample_data.get(table, []), table_info.get(table, {}), remaining)
+      if part:
+        sample_parts.append(part)
+        remaining -= self.tokenizer(part) + 1
+
+    # then a summary of the values each column actually holds, so questions filter on values that exist in the data
+    profiles = self._column_profiles(database)
+    for table in kept_tables:
+      if table not in profiles:
+        continue
+      lines = []
+      for line in self._profile_lines(profiles[table], table_info.get(table, {})):
+        if self.tokenizer(line) + 1 > remaining:
+          break
+        lines.append(line)
+        remaining -= self.tokenizer(line) + 1
+      if lines:
+        sample_parts.append(f"{table} column values:\n" + "\n".join(lines))
+    sample_text = "\n\n".join(sample_parts)
+
+    token_counts = {"schema": self.tokenizer(schema_text), "sample_data": self.tokenizer(sample_text)}
+    token_counts["total"] = token_counts["schema"] + token_counts["sample_data"]
+    return PromptContext(schema_text, sample_text, token_counts)
+
+  def rank_tables(self, tables, table_info, topics):
+    # sorted() is stable, so tables that score the same keep the database's own order
+    features = {feature for topic in topics for keyword, feature in TOPIC_FEATURES if keyword in topic.lower()}
+    linked_tables = {foreign_key["references_table"] for info in table_info.values() for foreign_key in info.get("foreign_keys", [])}
+
+    def score(table):
+      info = table_info.get(table, {})
+      column_types = [column["type"] for column in info.get("columns", [])]
+      has = {
+        "foreign_keys": bool(info.get("foreign_keys")) or table in linked_tables,
+        "self_reference": any(foreign_key["references_table"] == table for foreign_key in info.get("foreign_keys", [])),
+        "numeric": any(column_type.startswith(NUMERIC_TYPES) or "INT" in column_type for column_type in column_types),
+        "text": any(any(text_type in column_type for text_type in TEXT_TYPES) for column_type in column_types),
+      }
+      return sum(2 for feature in features if has.get(feature)) + (1 if has["foreign_keys"] else 0)
+
+    return sorted(tables, key=score, reverse=True)
+
+  def _schema_statements(self, database):
+    # table name -> compact CREATE statement, views are kept under their own names. schema rows are (sql, name), the name
+    # coming from the database's catalog, so quoted names with spaces or punctuation in them work too
+    statements = {}
+    for row in database.get_schema():
+      if not row[0]:
+        continue
+      statements[row[1]] = " ".join(row[0].split()) + ";"
+    return statements
+
+  def _render_schema(self, schema_statements, kept_tables):
+    # kept tables in rank order, then any views (which are short, and may be what a question is about)
+    lines = [schema_statements[table] for table in kept_tables if table in schema_statements]
+    lines += [statement for statement in schema_statements.values() if re.match(r'CREATE\s+VIEW', statement, re.IGNORECASE)]
+    return "\n".join(lines)
+
+  def _fit_sample(self, table, rows, info, budget):
+    if budget <= 0 or not rows:
+      return ""
+    columns = list(getattr(rows, "columns", [])) or [column["name"] for column in info.get("columns", [])]
+    if not columns:
+      columns = [f"column {i + 1}" for i in range(len(rows[0]))]
+    column_indexes = list(range(len(columns)))
+
+    # key columns are kept for as long as possible, so joins can still be seen in the example data
+    key_columns = {column["name"] for column in info.get("columns", []) if column["primary_key"]}
+    key_columns |= {foreign_key["column"] for foreign_key in info.get("foreign_keys", [])}
+    longest_first = sorted(column_indexes, key=lambda i: (columns[i] in key_columns, -self._longest_value(rows, i)))
+
+    num_rows = len(rows)
+    while True:
+      part = self._render_sample(table, columns, rows[:num_rows], column_indexes)
+      if self.tokenizer(part) <= budget:
+        return part
+      if len(column_indexes) > 1 and columns[longest_first[0]] not in key_columns:
+        column_indexes.remove(longest_first.pop(0))
+      elif num_rows > 1:
+        num_rows -= 1
+      else:
+        return ""
+
+  def _longest_value(self, rows, index):
+    return max((len(str(row[index])) for row in rows), default=0)
+
+  def _column_profiles(self, database):
+    try:
+      return database.get_column_profiles()
+    except Exception: # the prompt can do without them
+      return {}
+
+  def _profile_lines(self, profile, info):
+    key_columns = {column["name"] for column in info.get("columns", []) if column["primary_key"]}
+    lines = []
+    for name, column in profile.columns.items():
+      parts = [f"~{column.approx_distinct} distinct"]
+      if column.null_ratio:
+        parts.append(f"{column.null_ratio:.0%} NULL")
+      if column.min_value is not None and column.min_value != column.max_value:
+        parts.append(f"{self._render_value(column.min_value)} to {self._render_value(column.max_value)}")
+      # common values are only worth listing where values really repeat (at least 1% of the sample)
+      if name not in key_columns and column.top_values and column.top_values[0][1] >= max(2, column.sampled_rows / 100):
+        parts.append("common: " + ", ".join(self._render_value(value) for value, _ in column.top_values))
+      lines.append(f"{name}: " + ", ".join(parts))
+    for join in profile.joins:
+      fanout = f"{join.avg_fanout:.1f}" if join.avg_fanout < 10 else f"{join.avg_fanout:.0f}"
+      lines.append(f"{join.column} -> {join.references_table}.{join.references_column}: {join.matched_ratio:.0%} of keys match, "
+                   f"~{fanout} rows per {join.references_table} row")
+    return lines
+
+  def _render_sample(self, table, columns, rows, column_indexes):
+    header = f"{table} ({' | '.join(columns[i] for i in column_indexes)}):"
+    lines = [" | ".join(self._render_value(row[i]) for i in column_indexes) for row in rows]
+    return "\n".join([header] + lines)
+
+  def _render_value(self, value):
+    if value is None:
+      return "NULL"
+    text = " ".join(str(value).split())
+    if len(text) > self.max_value_chars:
+      return text[:self.max_value_chars - 3] + "..."
+    return text
@@ -0,0 +1,107 @@
+# keeps generated quiz questions so later quizzes on the same schema can be served without waiting on the llm
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from model import ModelQuizQuestionOutput
+
+
+class QuestionBank:
+  # validated questions, stored against (schema hash, model repo_id, topic)
+  # questions aren't used up when served, least-served ones are just preferred, so one bank serves a whole class
+  def __init__(self, path, target_per_topic=10):
+    self.path = path
+    self.target_per_topic = target_per_topic # the background refill tops each topic up to this many questions
+    self._conn = None
+    self._lock = threading.Lock()
+
+  def _connection(self):
+    if self._conn is None:
+      directory = os.path.dirname(self.path)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+      self._conn.execute("PRAGMA journal_mode=WAL;")
+      self._conn.execute("""CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY, schema_hash TEXT NOT NULL, repo_id TEXT NOT NULL, topic TEXT NOT NULL,
+        quiz_question TEXT NOT NULL, correct_sql_answer TEXT NOT NULL, created REAL NOT NULL, times_served INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (schema_hash, repo_id, topic, correct_sql_answer));""")
+    return self._conn
+
+  def add(self, schema_hash, repo_id, topic, questions):
+    now = time.time()
+    rows = [(schema_hash, repo_id, topic, question.quiz_question, question.correct_sql_answer, now) for question in questions]
+    with self._lock:
+      self._connection().executemany("""INSERT OR IGNORE INTO questions (schema_hash, repo_id, topic, quiz_question, correct_sql_answer, created)
+        VALUES (?, ?, ?, ?, ?, ?);""", rows)
+
+  def add_quiz(self, schema_hash, repo_id, topics, questions):
+    # questions generated for several topics at once are filed under the topic the model labelled them with
+    for topic in topics:
+      self.add(schema_hash, repo_id, topic, [question for question in questions if question.topic == topic])
+
+  def count(self, schema_hash, repo_id, topic):
+    with self._lock:
+      return self._connection().execute("SELECT COUNT(*) FROM questions WHERE schema_hash = ? AND repo_id = ? AND topic = ?;",
+                                        (schema_hash, repo_id, topic)).fetchone()[0]
+
+  def topics_running_low(self, schema_hash, repo_id, topics):
+    return [topic for topic in topics if self.count(schema_hash, repo_id, topic) < self.target_per_topic]
+
+  def take(self, schema_hash, repo_id, topics, num_questions):
+    # spreads the quiz across the selected topics, least-served questions first
+    with self._lock:
+      conn = self._connection()
+      candidates = {topic: conn.execute("""SELECT id, topic, quiz_question, correct_sql_answer FROM questions
+        WHERE schema_hash = ? AND repo_id = ? AND topic = ? ORDER BY times_served, RANDOM() LIMIT ?;""",
+        (schema_hash, repo_id, topic, num_questions)).fetchall() for topic in topics}
+
+      chosen = []
+      seen_answers = set()
+      while len(chosen) < num_questions and any(candidates.values()):
+        for topic in topics:
+          if candidates[topic] and len(chosen) < num_questions:
+            row = candidates[topic].pop(0)
+            if row[3] not in seen_answers:
+              seen_answers.add(row[3])
+              chosen.append(row)
+
+      conn.executemany("UPDATE questions SET times_served = times_served + 1 WHERE id = ?;", [(row[0],) for row in chosen])
+
+    return [ModelQuizQuestionOutput(topic=topic, quiz_question=question, correct_sql_answer=answer) for _, topic, question, answer in chosen]
+
+
+class QuestionBankRefiller:
+  # generates questions for topics the bank is short on, on a background thread so no page waits for it
+  def __init__(self, bank, max_workers=1):
+    self.bank = bank
+    self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="question-bank-refill")
+    self._in_flight = set()
+    self._lock = threading.Lock()
+
+  def request(self, llm, topics):
+    schema_hash, repo_id = llm.question_bank_key()
+    for topic in self.bank.topics_running_low(schema_hash, repo_id, topics):
+      key = (schema_hash, repo_id, topic)
+      with self._lock:
+        if key in self._in_flight:
+          continue
+        self._in_flight.add(key)
+      self._executor.submit(self._refill, llm, key)
+
+  def _refill(self, llm, key):
+    schema_hash, repo_id, topic = key
+    try:
+      questions = llm.generate_quiz_concurrently([topic]) # one topic, so everything that comes back belongs to it
+      self.bank.add(schema_hash, repo_id, topic, questions)
+    except: # a failed refill just means the next quiz for this topic is generated on demand
+      pass
+    finally:
+      with self._lock:
+        self._in_flight.discard(key)
+
+
+question_bank = QuestionBank("cache/question_bank.db") # one per process, configured from app_config.toml by the quiz page
+question_bank_refiller = QuestionBankRefiller(question_bank)
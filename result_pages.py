@@ -0,0 +1,46 @@
+# query results as arrow tables with their column names, for the results page to show a page at a time. converted once per
+# (database, query), so reruns of the page (eg turning a page) only slice the cached table rather than converting every row again
+import pyarrow as pa
+
+from cache import ResourceCache
+from canonical_sql import canonical_query
+from database import QueryResult
+
+result_tables = ResourceCache(max_size=128) # (database hash, canonical query) -> pa.Table
+
+
+def result_table(database, query, result):
+  # result is what execute_query gave back for query (a QueryResult, ChangeSet or SchemaDiff), or [] if it failed
+  if not isinstance(result, QueryResult):
+    return to_arrow(result)
+  key = (database.db_hash, canonical_query(query, database.rdbms, database.schema_names()) or query)
+  return result_tables.get_or_create(key, lambda: to_arrow(result))
+
+def to_arrow(result):
+  columns = list(getattr(result, "columns", []))
+  width = len(columns) or (len(result[0]) if result else 0)
+  names = _unique_names(columns or [f"column {i + 1}" for i in range(width)])
+  values_by_column = list(zip(*result)) if result else [() for _ in names]
+  return pa.Table.from_arrays([_column_array(values) for values in values_by_column], names=names)
+
+def page_count(table, page_rows):
+  return max(1, -(-table.num_rows // page_rows))
+
+def result_page(table, page, page_rows):
+  # pages start at 1. a slice shares the table's buffers, nothing is copied
+  return table.slice((page - 1) * page_rows, page_rows)
+
+def _column_array(values):
+  try:
+    return pa.array(values)
+  except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError): # sqlite columns can mix types, those are shown as text
+    return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+def _unique_names(names):
+  # SELECT a.id, b.id gives two columns called id, which a table can't show apart
+  seen = {}
+  unique = []
+  for name in map(str, names):
+    seen[name] = seen.get(name, 0) + 1
+    unique.append(name if seen[name] == 1 else f"{name} ({seen[name]})")
+  return unique
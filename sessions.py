@@ -0,0 +1,326 @@
+# keeps each user session's uploaded database in its own private sqlite database: in memory, or for large uploads, a spooled copy on disk
+# (or, for the duckdb engine, a duckdb database file built from the uploads)
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024 # bytes, across every session in this process
+CACHED_STATEMENTS = 256 # sqlite3's per-connection prepared statement cache, worth having now connections live for the whole session
+SPOOL_CHUNK_SIZE = 8 * 1024 * 1024
+STALE_SPOOL_SECONDS = 24 * 60 * 60
+
+
+class UploadTooLargeError(ValueError):
+  pass
+
+
+def new_session_id():
+  return uuid.uuid4().hex
+
+
+class SessionEnd:
+  # calls on_end(session_id) once it's garbage collected. kept in a streamlit session's state, which streamlit drops a
+  # while after the session's tab is closed, that being the only notice the app gets that a session has ended
+  def __init__(self, session_id, on_end):
+    self.session_id = session_id
+    weakref.finalize(self, on_end, session_id)
+
+
+class SessionDatabase:
+  # path is set for large uploads, which are queried from a copy spooled to disk rather than loaded into memory. SELECTs
+  # then go through read_engine, a read-only connection that memory-maps the file, so its pages are shared with the OS
+  # page cache instead of being copied into the worker
+  def __init__(self, session_id, db_bytes, path=None, mmap_size=0, read_cache_size=0):
+    self.session_id = session_id
+    self.db_bytes = db_bytes # the session's own upload, kept by reference so an evicted database can be reloaded
+    self.path = path
+    self.spill_path = None # where db_bytes went once the database was evicted, see SessionDatabaseManager._spill
+    self.mmap_size = mmap_size
+    self.read_cache_size = read_cache_size
+    self.connection = None
+    self.read_connection = None
+    self.engine = None
+    self.read_engine = None
+    self.size = 0
+    self.lock = threading.RLock() # held by the session's UserDatabase while it is running queries
+    self.on_unload = None # lets the session's UserDatabase let go of its long-lived connection first
+
+  def load(self):
+    if self.path is not None:
+      connection = sqlite3.connect(self.path, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+      # the file is this session's own scratch copy, sandboxes always roll back, so there's no need for a journal on disk
+      connection.execute("PRAGMA journal_mode=MEMORY;")
+      self.connection = connection
+      return connection
+
+    connection = sqlite3.connect(":memory:", check_same_thread=False, cached_statements=CACHED_STATEMENTS) # streamlit reruns a session's script on different threads
+    if self.db_bytes is None:
+      # copied back in from the spilled file a page at a time (sandboxes always roll back, so it's still the upload as it was)
+      spilled = sqlite3.connect(f"file:{self.spill_path}?mode=ro", uri=True)
+      try:
+        spilled.backup(connection)
+      finally:
+        spilled.close()
+      self.size = connection.execute("PRAGMA page_count;").fetchone()[0] * connection.execute("PRAGMA page_size;").fetchone()[0]
+    else:
+      # deserialize reads straight from the upload's buffer, so the only copy made is the one sqlite owns
+      with self.db_bytes.getbuffer() as buffer:
+        connection.deserialize(buffer)
+        self.size = buffer.nbytes
+    self.connection = connection
+    return connection
+
+  def load_read_only(self):
+    connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+    connection.execute("PRAGMA query_only=1;")
+    connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)};")
+    connection.execute(f"PRAGMA cache_size=-{int(self.read_cache_size // 1024)};") # negative is in KiB
+    self.read_connection = connection
+    return connection
+
+  def unload(self):
+    # disposing the StaticPool closes its connection, and the next checkout goes back through load()
+    with self.lock:
+      if self.on_unload is not None:
+        self.on_unload()
+      for engine in (self.engine, self.read_engine):
+        if engine is not None:
+          engine.dispose()
+      self.connection = None
+      self.read_connection = None
+
+  def remove_spooled_file(self):
+    for path in (self.path, self.spill_path):
+      if path is not None and os.path.exists(path):
+        os.remove(path)
+
+  @property
+  def loaded(self):
+    return self.connection is not None
+
+
+class DuckDBSessionDatabase(SessionDatabase):
+  # a duckdb database file in the spool directory, built once from the session's uploads. duckdb pages it in and out
+  # itself within memory_limit, so it doesn't count towards the manager's memory budget
+  def __init__(self, session_id, path, memory_limit=0, threads=0):
+    super().__init__(session_id, None, path=path)
+    self.memory_limit = memory_limit
+    self.threads = threads
+
+  def load(self):
+    import duckdb
+    config = {}
+    if self.memory_limit:
+      config["memory_limit"] = f"{self.memory_limit // (1024 * 1024)}MB"
+    if self.threads:
+      config["threads"] = self.threads
+    self.connection = duckdb.connect(self.path, config=config)
+    return self.connection
+
+  def remove_spooled_file(self):
+    for path in (self.path, self.path + ".wal"):
+      if os.path.exists(path):
+        os.remove(path)
+
+
+class SessionDatabaseManager:
+  # session id -> SessionDatabase, least recently used first
+  # when the loaded databases go over the memory budget, the least recently used idle ones are unloaded. their engines stay
+  # valid and reload the next time they're used (sessions are touched by their UserDatabase on every query). an unloaded
+  # database's upload is spilled to spool_dir and let go of, so idle sessions don't keep their uploads in memory either
+  # uploads over large_file_threshold are spooled to spool_dir and queried from there (only loaded databases count towards
+  # memory_budget, so these don't), and uploads over max_upload_size are turned away. 0 turns either off
+  def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, max_upload_size=0, large_file_threshold=0, spool_dir="temp/uploads",
+               mmap_size=4096 * 1024 * 1024, read_cache_size=64 * 1024 * 1024, duckdb_memory_limit=1024 * 1024 * 1024, duckdb_threads=0,
+               stale_spool_seconds=STALE_SPOOL_SECONDS):
+    self.memory_budget = memory_budget
+    self.max_upload_size = max_upload_size
+    self.large_file_threshold = large_file_threshold
+    self.spool_dir = spool_dir
+    self.mmap_size = mmap_size
+    self.read_cache_size = read_cache_size
+    self.duckdb_memory_limit = duckdb_memory_limit
+    self.duckdb_threads = duckdb_threads
+    self.stale_spool_seconds = stale_spool_seconds
+    self._databases = OrderedDict()
+    self._lock = threading.RLock()
+    self._swept_dirs = set()
+
+  def configure(self, database_config):
+    megabyte = 1024 * 1024
+    self.memory_budget = database_config.get('session_memory_budget_mb', self.memory_budget // megabyte) * megabyte
+    self.max_upload_size = database_config.get('max_upload_mb', self.max_upload_size // megabyte) * megabyte
+    self.large_file_threshold = database_config.get('large_file_threshold_mb', self.large_file_threshold // megabyte) * megabyte
+    self.spool_dir = database_config.get('spool_dir', self.spool_dir)
+    self.mmap_size = database_config.get('mmap_size_mb', self.mmap_size // megabyte) * megabyte
+    self.read_cache_size = database_config.get('read_cache_mb', self.read_cache_size // megabyte) * megabyte
+    self.duckdb_memory_limit = database_config.get('duckdb_memory_limit_mb', self.duckdb_memory_limit // megabyte) * megabyte
+    self.duckdb_threads = database_config.get('duckdb_threads', self.duckdb_threads)
+    self.stale_spool_seconds = database_config.get('stale_spool_hours', self.stale_spool_seconds / 3600) * 3600
+    if self.spool_dir not in self._swept_dirs: # configure runs on every rerun of the app, the sweep only once per process
+      self._swept_dirs.add(self.spool_dir)
+      self.sweep_spool_dir()
+
+  def sweep_spool_dir(self):
+    # spooled files are removed when their session is released, but a process that's killed (or a session that's never
+    # released) leaves them behind. anything not belonging to an open session that hasn't been touched for
+    # stale_spool_seconds is removed, the age check leaving alone files of other processes sharing the directory (eg batch workers)
+    if not self.stale_spool_seconds or not os.path.isdir(self.spool_dir):
+      return
+    with self._lock:
+      open_sessions = tuple(self._databases)
+    cutoff = time.time() - self.stale_spool_seconds
+    for entry in os.scandir(self.spool_dir):
+      if not entry.is_file() or entry.name.startswith(open_sessions):
+        continue
+      try:
+        if entry.stat().st_mtime < cutoff:
+          os.remove(entry.path)
+      except OSError:
+        pass # removed by someone else in the meantime
+
+  def open(self, session_id, db_bytes):
+    upload_size = self._check_upload_size([db_bytes])
+    self.release(session_id) # a re-upload replaces whatever the session had before
+    if self.large_file_threshold and upload_size > self.large_file_threshold:
+      # the session keeps the spooled file rather than the upload, so it isn't held in memory for reloads
+      session_db = SessionDatabase(session_id, None, path=self._spool(session_id, db_bytes),
+                                   mmap_size=self.mmap_size, read_cache_size=self.read_cache_size)
+      session_db.read_engine = create_engine("sqlite://", creator=lambda: self._load(session_id, read_only=True), poolclass=StaticPool)
+    else:
+      session_db = SessionDatabase(session_id, db_bytes)
+    # StaticPool hands out the one in-memory connection, which is the only way to share a :memory: database
+    session_db.engine = create_engine("sqlite://", creator=lambda: self._load(session_id), poolclass=StaticPool)
+    with self._lock:
+      self._databases[session_id] = session_db
+    return session_db
+
+  def open_duckdb(self, session_id, uploads):
+    # uploads are BytesIO-like files with a .name (.db, .parquet or .csv), spooled to disk for duckdb to read, imported into
+    # the session's duckdb file, then deleted
+    from duckdb_engine import ConnectionWrapper
+    from duckdb_import import import_uploads
+    self._check_upload_size(uploads)
+    self.release(session_id)
+    session_db = DuckDBSessionDatabase(session_id, os.path.join(self.spool_dir, f"{session_id}.duckdb"),
+                                       memory_limit=self.duckdb_memory_limit, threads=self.duckdb_threads)
+    sources = []
+    try:
+      for i, upload in enumerate(uploads):
+        extension = os.path.splitext(upload.name)[1].lower()
+        sources.append((self._spool(f"{session_id}-source-{i}", upload, extension), upload.name))
+      session_db.remove_spooled_file() # left over from a crashed run
+      connection = session_db.load()
+      try:
+        import_uploads(connection, sources)
+      finally:
+        connection.close()
+        session_db.connection = None
+    except:
+      session_db.remove_spooled_file()
+      raise
+    finally:
+      for path, _ in sources:
+        os.remove(path)
+    # duckdb_engine's wrapper runs every cursor on the one connection, so sandboxes' transactions cover everything run in them
+    session_db.engine = create_engine("duckdb://", creator=lambda: ConnectionWrapper(self._load(session_id)), poolclass=StaticPool)
+    with self._lock:
+      self._databases[session_id] = session_db
+    return session_db
+
+  def _check_upload_size(self, uploads):
+    upload_size = 0
+    for upload in uploads:
+      with upload.getbuffer() as buffer:
+        upload_size += buffer.nbytes
+    if self.max_upload_size and upload_size > self.max_upload_size:
+      raise UploadTooLargeError(f"database file is too large ({upload_size // (1024 * 1024)} MB, the limit is {self.max_upload_size // (1024 * 1024)} MB)")
+    return upload_size
+
+  def _spool(self, session_id, db_bytes, extension=".db"):
+    # written a chunk at a time from the upload's buffer, so no second copy of the whole file is made on the way
+    os.makedirs(self.spool_dir, exist_ok=True)
+    path = os.path.join(self.spool_dir, f"{session_id}{extension}")
+    partial_path = path + ".partial"
+    try:
+      with db_bytes.getbuffer() as buffer, open(partial_path, "wb") as spooled:
+        for offset in range(0, buffer.nbytes, SPOOL_CHUNK_SIZE):
+          spooled.write(buffer[offset:offset + SPOOL_CHUNK_SIZE])
+      os.replace(partial_path, path)
+    except:
+      if os.path.exists(partial_path):
+        os.remove(partial_path)
+      raise
+    return path
+
+  def get(self, session_id):
+    with self._lock:
+      return self._databases.get(session_id)
+
+  def touch(self, session_id):
+    with self._lock:
+      if session_id in self._databases:
+        self._databases.move_to_end(session_id)
+
+  def release(self, session_id):
+    with self._lock:
+      session_db = self._databases.pop(session_id, None)
+    if session_db is not None: # unloaded outside the manager lock, it may have to wait for the session to finish a query
+      session_db.unload()
+      session_db.remove_spooled_file()
+
+  def memory_in_use(self):
+    with self._lock:
+      return sum(session_db.size for session_db in self._databases.values() if session_db.loaded)
+
+  def _load(self, session_id, read_only=False):
+    with self._lock:
+      session_db = self._databases.get(session_id)
+      if session_db is None:
+        raise KeyError(f"no database open for session {session_id}")
+      connection = session_db.load_read_only() if read_only else session_db.load()
+      evicted = self._evict(keep=session_id)
+    for evicted_db in evicted: # written outside the manager lock, other sessions can carry on loading meanwhile
+      self._spill(evicted_db)
+    return connection
+
+  def _spill(self, session_db):
+    # skipped for a session that's busy (or been loaded again) by now, it'll be spilled the next time it's evicted
+    if not session_db.lock.acquire(blocking=False):
+      return
+    try:
+      if session_db.db_bytes is None or session_db.loaded:
+        return
+      session_db.spill_path = self._spool(session_db.session_id, session_db.db_bytes)
+      session_db.db_bytes = None
+    finally:
+      session_db.lock.release()
+    with self._lock:
+      released = self._databases.get(session_db.session_id) is not session_db
+    if released: # while it was being written, so release didn't know about the file
+      session_db.remove_spooled_file()
+
+  def _evict(self, keep=None):
+    evicted = []
+    for session_id, session_db in list(self._databases.items()):
+      if self.memory_in_use() <= self.memory_budget:
+        break
+      if session_id == keep or not session_db.loaded:
+        continue
+      # a session that's mid-query holds its lock, it isn't idle so it's skipped rather than waited on
+      if session_db.lock.acquire(blocking=False):
+        try:
+          session_db.unload()
+          evicted.append(session_db)
+        finally:
+          session_db.lock.release()
+    return evicted
+
+
+session_databases = SessionDatabaseManager() # one per process, shared by every streamlit session
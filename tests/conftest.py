@@ -0,0 +1,59 @@
+# shared fixtures: small uploaded databases opened the same way the app opens them, with their own session manager,
+# spool directory and introspection cache so nothing is written to the app's cache/ or temp/ directories
+import io
+import os
+import sqlite3
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import DiskCache
+from database import SQLiteUserDatabase, DuckDBUserDatabase, QueryLimits
+from sessions import SessionDatabaseManager
+
+
+def make_sqlite_bytes(path):
+  # three tables of 20 rows each, enough to pass assert_db_contains_enough_data
+  conn = sqlite3.connect(path)
+  conn.executescript("""
+    CREATE TABLE a (id INTEGER PRIMARY KEY, grp INTEGER, t TEXT);
+    CREATE TABLE b (id INTEGER PRIMARY KEY, a_id INTEGER REFERENCES a(id), amount REAL);
+    CREATE TABLE c (id INTEGER PRIMARY KEY, t TEXT);
+  """)
+  conn.executemany("INSERT INTO a VALUES (?, ?, ?);", [(i, i % 3, "Bob" if i % 2 else "bob") for i in range(1, 21)])
+  conn.executemany("INSERT INTO b VALUES (?, ?, ?);", [(i, (i % 20) + 1, i * 1.5) for i in range(1, 21)])
+  conn.executemany("INSERT INTO c VALUES (?, ?);", [(i, "Bob" if i % 2 else "bob") for i in range(1, 21)])
+  conn.commit()
+  conn.close()
+  with open(path, "rb") as db_file:
+    return db_file.read()
+
+@pytest.fixture
+def manager(tmp_path):
+  manager = SessionDatabaseManager(spool_dir=str(tmp_path / "spool"))
+  yield manager
+  for session_id in list(manager._databases):
+    manager.release(session_id)
+
+@pytest.fixture
+def db_bytes(tmp_path):
+  return make_sqlite_bytes(str(tmp_path / "upload.db"))
+
+@pytest.fixture
+def open_sqlite(tmp_path, manager, db_bytes):
+  def open_database(max_result_rows=1000, timeout_seconds=5):
+    return SQLiteUserDatabase(io.BytesIO(db_bytes), manager=manager, cache=DiskCache(str(tmp_path / "introspection.db")),
+                              limits=QueryLimits(timeout_seconds=timeout_seconds, max_result_rows=max_result_rows))
+  return open_database
+
+@pytest.fixture
+def database(open_sqlite):
+  return open_sqlite()
+
+@pytest.fixture
+def duckdb_database(manager, db_bytes):
+  pytest.importorskip("duckdb_engine")
+  upload = io.BytesIO(db_bytes)
+  upload.name = "upload.db"
+  return DuckDBUserDatabase([upload], manager=manager)
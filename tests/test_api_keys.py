@@ -0,0 +1,43 @@
+import pytest
+import requests
+
+from api_keys import APIKeyVerifier, HuggingFaceKeyVerifier, KeyCheckFailedError
+
+
+class FakeSession:
+  # answers every request with the next status code, or raises it if it's an exception
+  def __init__(self, *responses):
+    self.responses = list(responses)
+    self.requests = 0
+
+  def get(self, url, headers=None, timeout=None):
+    self.requests += 1
+    response = self.responses.pop(0)
+    if isinstance(response, Exception):
+      raise response
+    fake = requests.Response()
+    fake.status_code = response
+    return fake
+
+
+def test_valid_and_rejected_keys_are_cached():
+  session = FakeSession(200, 401)
+  verifier = HuggingFaceKeyVerifier(session=session)
+  assert verifier.verify("good") and verifier.verify("good")
+  assert not verifier.verify("bad") and not verifier.verify("bad")
+  assert session.requests == 2
+
+def test_transport_errors_are_not_a_rejection():
+  session = FakeSession(requests.ConnectionError(), 503, 200)
+  verifier = HuggingFaceKeyVerifier(session=session)
+  with pytest.raises(KeyCheckFailedError):
+    verifier.verify("good")
+  with pytest.raises(KeyCheckFailedError):
+    verifier.verify("good")
+  assert verifier.verify("good") # nothing was cached for the failed checks
+
+def test_verifiers_must_implement_check():
+  class NoCheckVerifier(APIKeyVerifier):
+    pass
+  with pytest.raises(TypeError):
+    NoCheckVerifier()
@@ -0,0 +1,29 @@
+import io
+import time
+import pytest
+
+from conftest import make_sqlite_bytes
+from database import DuckDBUserDatabase, QueryLimits, QueryCancelledError
+from grading import grade_answer
+
+CROSS_JOIN = "SELECT a1.id, a2.id, a3.id, a4.id, a5.id, a6.id FROM a a1, a a2, a a3, a a4, a a5, a a6"
+
+
+@pytest.fixture
+def slow_duckdb_database(tmp_path, manager):
+  pytest.importorskip("duckdb_engine")
+  upload = io.BytesIO(make_sqlite_bytes(str(tmp_path / "upload.db")))
+  upload.name = "upload.db"
+  return DuckDBUserDatabase([upload], manager=manager, limits=QueryLimits(timeout_seconds=0.3, max_result_rows=5))
+
+def test_duckdb_queries_are_stopped(slow_duckdb_database):
+  start = time.monotonic()
+  with pytest.raises(QueryCancelledError):
+    slow_duckdb_database.execute_query("SELECT COUNT(*) FROM (" + CROSS_JOIN + ", a a7);")
+  assert time.monotonic() - start < 5
+  assert slow_duckdb_database.execute_query("SELECT COUNT(*) FROM a;")[0][0] == 20 # the connection still works afterwards
+
+def test_duckdb_comparisons_are_stopped(slow_duckdb_database):
+  # each answer's first rows come back straight away, it's comparing all 64M rows that goes over the budget
+  grade = grade_answer(slow_duckdb_database, CROSS_JOIN + ";", CROSS_JOIN + " WHERE 1;")
+  assert grade.ungraded and isinstance(grade.comparison_error, QueryCancelledError)
@@ -0,0 +1,61 @@
+from canonical_sql import canonical_definition, canonical_query, same_query
+
+SCHEMA = frozenset({"a", "b", "c", "id", "t", "grp", "a_id", "amount"})
+
+
+def test_whitespace_case_and_quoting():
+  assert same_query("SELECT id, t FROM a WHERE grp = 1;", 'select  "ID", T from "A"  where GRP=1', schema_names=SCHEMA)
+
+def test_commutative_predicates():
+  assert same_query("SELECT id FROM a WHERE grp = 1 AND id > 5;", "SELECT id FROM a WHERE 5 < id AND 1 = grp;", schema_names=SCHEMA)
+  assert same_query("SELECT id FROM a WHERE (grp = 1 OR grp = 2) AND id > 5;", "SELECT id FROM a WHERE id > 5 AND (grp = 2 OR grp = 1);",
+                    schema_names=SCHEMA)
+  assert not same_query("SELECT id FROM a WHERE (grp = 1 OR grp = 2) AND id > 5;", "SELECT id FROM a WHERE grp = 1 OR grp = 2 AND id > 5;",
+                        schema_names=SCHEMA)
+  assert not same_query("SELECT id - 1 FROM a;", "SELECT 1 - id FROM a;", schema_names=SCHEMA)
+
+def test_update_assignments_are_not_reordered():
+  assert canonical_query("UPDATE a SET grp = 1 WHERE 3 = id;", schema_names=SCHEMA) == "UPDATE a SET grp = 1 WHERE 3 = id"
+
+def test_string_literals_keep_their_case():
+  assert not same_query("SELECT id FROM c WHERE t = 'Bob';", "SELECT id FROM c WHERE t = 'bob';", schema_names=SCHEMA)
+
+def test_double_quoted_strings_keep_their_case():
+  # sqlite reads "Bob" as a string when there's no column called Bob
+  assert not same_query('SELECT id FROM c WHERE t = "Bob";', 'SELECT id FROM c WHERE t = "bob";', schema_names=SCHEMA)
+  assert same_query('SELECT id FROM c WHERE "T" = \'Bob\';', "SELECT id FROM c WHERE t = 'Bob';", schema_names=SCHEMA)
+
+def test_redundant_aliases():
+  assert same_query("SELECT x.id AS id FROM a x WHERE x.grp = 1;", "SELECT id FROM a WHERE grp = 1;", schema_names=SCHEMA)
+  assert same_query("SELECT p.id FROM a p JOIN b q ON p.id = q.a_id;", "SELECT a.id FROM a JOIN b ON b.a_id = a.id;", schema_names=SCHEMA)
+
+def test_swapped_aliases():
+  swapped = "SELECT a.id, b.id FROM a AS b JOIN b AS a ON a.id = b.id;"
+  assert canonical_query(swapped, schema_names=SCHEMA) == canonical_query("SELECT b.id, a.id FROM a JOIN b ON b.id = a.id;", schema_names=SCHEMA)
+  assert not same_query(swapped, "SELECT a.id, b.id FROM a JOIN b ON a.id = b.id;", schema_names=SCHEMA)
+
+def test_table_named_after_being_aliased_is_left_alone():
+  # doesn't run (a is only known as x), so it mustn't canonicalise to the query that does
+  assert not same_query("SELECT a.id FROM a AS x;", "SELECT a.id FROM a;", schema_names=SCHEMA)
+
+def test_unparseable_queries_never_match():
+  assert canonical_query("SELECT 1; SELECT 2;") is None
+  assert not same_query("SELECT id FROM a;", "SELECT 1; SELECT 2;")
+
+def test_upsert_assignments_are_not_reordered():
+  upsert = "INSERT INTO c (id, t) VALUES (1, 'x') ON CONFLICT (id) DO UPDATE SET t = 'y';"
+  assert not same_query(upsert, "INSERT INTO c (id, t) VALUES (1, 'x') ON CONFLICT (id) DO UPDATE SET 'y' = t;", schema_names=SCHEMA)
+  assert not same_query("UPDATE a SET grp = id;", "UPDATE a SET id = grp;", schema_names=SCHEMA)
+
+def test_literals_differing_in_whitespace_never_match():
+  assert not same_query("SELECT id FROM c WHERE t = 'Bob  Smith';", "SELECT id FROM c WHERE t = 'Bob Smith';", schema_names=SCHEMA)
+  assert not same_query("SELECT id FROM c WHERE t = 'Bob' || '  ';", "SELECT id FROM c WHERE t = 'Bob' || ' ';", schema_names=SCHEMA)
+  assert same_query("SELECT id FROM c WHERE t = 'Bob  Smith';", "SELECT id\n  FROM c WHERE t = 'Bob  Smith';", schema_names=SCHEMA)
+
+def test_definitions_keep_their_literals():
+  # sqlglot can't parse triggers, so they're compared token by token
+  trigger = "CREATE TRIGGER tag AFTER INSERT ON c BEGIN UPDATE c SET t = 'New' WHERE id = NEW.id; END"
+  assert canonical_definition(trigger, schema_names=SCHEMA) == canonical_definition(
+    "create  trigger TAG after insert on C begin update c set t = 'New' where id = new.id; end", schema_names=SCHEMA)
+  assert canonical_definition(trigger, schema_names=SCHEMA) != canonical_definition(trigger.replace("'New'", "'new'"), schema_names=SCHEMA)
+  assert canonical_definition(trigger, schema_names=SCHEMA) != canonical_definition(trigger.replace("'New'", "New"), schema_names=SCHEMA)
@@ -0,0 +1,82 @@
+from database import QueryCancelledError
+from grading import grade_answer, rule_based_feedback
+
+
+def test_identical_answers_are_not_run(database):
+  grade = grade_answer(database, "SELECT id FROM a WHERE grp = 1;", 'select "ID" from A where 1 = grp')
+  assert grade.correct and grade.method == "identical"
+
+def test_small_results_match_on_fingerprints(database):
+  grade = grade_answer(database, "SELECT id FROM a WHERE grp = 1;", "SELECT id FROM a WHERE grp + 0 = 1;")
+  assert grade.correct and grade.method == "fingerprint"
+
+def test_results_past_the_row_cap_are_compared_in_the_database(open_sqlite):
+  database = open_sqlite(max_result_rows=5)
+  result = database.execute_query("SELECT id FROM a;", fingerprint=True)
+  assert result.truncated and result.fingerprint is None and len(result) == 5
+
+  grade = grade_answer(database, "SELECT id FROM a;", "SELECT id FROM a WHERE id > 0;")
+  assert grade.correct and grade.method == "comparison"
+  grade = grade_answer(database, "SELECT id FROM a;", "SELECT id FROM a WHERE id > 1;")
+  assert not grade.correct and grade.comparison.missing_count == 1
+
+def test_order_matters_only_with_order_by(database):
+  assert grade_answer(database, "SELECT id FROM a;", "SELECT id FROM a ORDER BY id DESC;").correct
+  grade = grade_answer(database, "SELECT id FROM a ORDER BY id;", "SELECT id FROM a ORDER BY id DESC;")
+  assert not grade.correct and grade.comparison.order_mismatch_at == 0
+  grade = grade_answer(database, "SELECT id FROM a ORDER BY id;", "SELECT id FROM a ORDER BY id = 5, id;")
+  assert not grade.correct and grade.comparison.order_mismatch_at == 4
+
+def test_comparison_out_of_time_is_ungraded(open_sqlite):
+  # each answer's first rows come back straight away, but comparing 3.2M rows doesn't fit in the budget
+  database = open_sqlite(max_result_rows=5, timeout_seconds=0.2)
+  cross_join = "SELECT a1.id, a2.id, a3.id, a4.id, a5.id FROM a a1, a a2, a a3, a a4, a a5"
+  grade = grade_answer(database, cross_join + ";", cross_join + " WHERE 1;")
+  assert grade.ungraded and grade.method == "ungraded" and grade.user_error is None
+  assert isinstance(grade.comparison_error, QueryCancelledError)
+
+def test_case_of_string_literals_matters(database):
+  grade = grade_answer(database, "SELECT id FROM c WHERE t = 'Bob';", "SELECT id FROM c WHERE t = 'bob';")
+  assert not grade.correct
+
+def test_dml_answers_compare_their_changes(database):
+  assert grade_answer(database, "DELETE FROM a WHERE grp = 1;", "DELETE FROM a WHERE NOT grp <> 1;").correct
+  grade = grade_answer(database, "DELETE FROM a WHERE grp = 1;", "DELETE FROM a WHERE grp = 2;")
+  assert not grade.correct and grade.method == "changes"
+  assert database.execute_query("SELECT COUNT(*) FROM a;")[0][0] == 20 # sandboxed, nothing was deleted
+
+def test_rule_based_feedback_explains_obvious_mistakes(database):
+  model_answer = "SELECT id, t FROM a WHERE grp = 1;"
+  for user_answer, expected in [("SELECT id, nope FROM a;", "no such column"),
+                                ("SELECT id FROM a WHERE grp = 1;", "column"),
+                                ("SELECT id, t FROM a;", "too many"),
+                                ("SELECT id, t FROM a WHERE grp = 1 AND id > 5;", "missing"),
+                                ("DELETE FROM a;", "answered with SELECT")]:
+    grade = grade_answer(database, model_answer, user_answer)
+    assert not grade.correct
+    assert expected in rule_based_feedback(grade, model_answer, user_answer)
+
+def test_double_quoted_strings_are_not_identical(database):
+  grade = grade_answer(database, 'SELECT id FROM c WHERE t = "Bob";', 'SELECT id FROM c WHERE t = "bob";')
+  assert not grade.correct
+  assert [row[0] for row in grade.model_result] == [1, 3, 5, 7, 9, 11, 13, 15, 17, 19]
+  assert [row[0] for row in grade.user_result] == [2, 4, 6, 8, 10, 12, 14, 16, 18, 20]
+
+def test_cached_results_keep_whitespace_in_literals(database):
+  assert list(database.execute_query_cached("SELECT 'a  b';")) == [("a  b",)]
+  assert list(database.execute_query_cached("SELECT 'a b';")) == [("a b",)]
+
+def test_duckdb_order_is_compared_in_the_database(duckdb_database):
+  grade = grade_answer(duckdb_database, "SELECT id FROM a ORDER BY id;", "SELECT id FROM a ORDER BY id = 5, id;")
+  assert not grade.correct and grade.comparison.order_mismatch_at == 4
+  assert grade_answer(duckdb_database, "SELECT id FROM a ORDER BY id;", "SELECT id FROM a WHERE id > 0 ORDER BY id;").correct
+
+def test_views_compare_their_definitions(database):
+  model_answer = "CREATE VIEW bobs AS SELECT id FROM c WHERE t = 'Bob';"
+  assert grade_answer(database, model_answer, "create view BOBS as select ID from C where 'Bob' = T;").correct
+  assert not grade_answer(database, model_answer, "CREATE VIEW bobs AS SELECT id FROM c WHERE t = 'bob';").correct
+
+def test_duckdb_views_compare_their_definitions(duckdb_database):
+  model_answer = "CREATE VIEW bobs AS SELECT id FROM c WHERE t = 'Bob';"
+  assert grade_answer(duckdb_database, model_answer, "create view bobs as select ID from C where T = 'Bob';").correct
+  assert not grade_answer(duckdb_database, model_answer, "CREATE VIEW bobs AS SELECT id FROM c WHERE t = 'bob';").correct
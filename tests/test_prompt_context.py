@@ -0,0 +1,25 @@
+import io
+import sqlite3
+
+from cache import DiskCache
+from conftest import make_sqlite_bytes
+from database import SQLiteUserDatabase
+from prompt_context import PromptContextBuilder
+
+
+def test_tables_with_quoted_names_keep_their_schema(tmp_path, manager):
+  path = str(tmp_path / "quoted.db")
+  make_sqlite_bytes(path)
+  conn = sqlite3.connect(path)
+  conn.execute('CREATE TABLE "order items" (id INTEGER PRIMARY KEY, a_id INTEGER);')
+  conn.execute('CREATE TABLE [my-table] (id INTEGER PRIMARY KEY);')
+  conn.executemany('INSERT INTO "order items" VALUES (?, ?);', [(i, i) for i in range(1, 6)])
+  conn.executemany('INSERT INTO [my-table] VALUES (?);', [(i,) for i in range(1, 6)])
+  conn.commit()
+  conn.close()
+  with open(path, "rb") as db_file:
+    database = SQLiteUserDatabase(io.BytesIO(db_file.read()), manager=manager, cache=DiskCache(str(tmp_path / "introspection.db")))
+  statements = PromptContextBuilder()._schema_statements(database)
+  assert statements["order items"].startswith('CREATE TABLE "order items"')
+  assert statements["my-table"].startswith("CREATE TABLE [my-table]")
+  assert set(statements) == set(database.tables)
@@ -0,0 +1,18 @@
+def test_sqlite_samples_are_repeatable(database):
+  # runs of block_size rows from seeded random rowids
+  columns, rows, row_count = database.sample_table_rows("a", 10, block_size=5)
+  assert columns == ["id", "grp", "t"] and row_count == 20 and 0 < len(rows) <= 10
+  assert database.sample_table_rows("a", 10, block_size=5) == (columns, rows, row_count)
+
+def test_duckdb_samples_with_any_upload_hash(duckdb_database):
+  # the seed comes from the upload's hash, whose top bit is set about half the time
+  for db_hash in ("0" * 64, "f" * 64, "80000000" + "0" * 56):
+    duckdb_database.db_hash = db_hash
+    columns, rows, row_count = duckdb_database.sample_table_rows("a", 5)
+    assert columns == ["id", "grp", "t"] and row_count == 20 and len(rows) == 5
+    assert duckdb_database.sample_table_rows("a", 5)[1] == rows
+
+def test_duckdb_column_profiles(duckdb_database):
+  duckdb_database.db_hash = "f" * 64
+  duckdb_database._column_profiles = None
+  assert set(duckdb_database.get_column_profiles()) == {"a", "b", "c"}
@@ -0,0 +1,75 @@
+import io
+import sqlite3
+import pytest
+from cache import DiskCache
+from conftest import make_sqlite_bytes
+from database import ChangeSet, SQLiteUserDatabase, query_command
+
+WITH_DELETE = "WITH odd AS (SELECT id FROM a WHERE id % 2 = 1) DELETE FROM a WHERE id IN (SELECT id FROM odd);"
+
+
+def count_rows(database, table="a"):
+  return database.execute_query(f"SELECT COUNT(*) FROM {table};")[0][0]
+
+def test_query_command_finds_the_statement_under_a_with():
+  assert query_command(WITH_DELETE) == "DELETE"
+  assert query_command("WITH x AS (SELECT 1) SELECT * FROM x;") == "WITH"
+  assert query_command("with x as (select 1) update a set grp = 0;") == "UPDATE"
+
+def test_dml_is_rolled_back(database):
+  result = database.execute_query("UPDATE a SET grp = 9 WHERE id <= 5;")
+  assert isinstance(result, ChangeSet) and result.counts["updated"] == 5
+  assert database.execute_query("SELECT COUNT(*) FROM a WHERE grp = 9;")[0][0] == 0
+
+def test_with_dml_runs_in_the_sandbox(database):
+  result = database.execute_query(WITH_DELETE)
+  assert isinstance(result, ChangeSet) and result.table == "a" and result.counts["deleted"] == 10
+  assert count_rows(database) == 20
+
+def test_ddl_is_rolled_back(database):
+  database.execute_query("DROP TABLE b;")
+  assert count_rows(database, "b") == 20
+
+def test_nested_sandboxes_roll_back(database):
+  with database.sandbox() as conn:
+    conn.exec_driver_sql("DELETE FROM a WHERE id > 10;")
+    with database.sandbox() as inner:
+      inner.exec_driver_sql("DELETE FROM a;")
+      assert inner.exec_driver_sql("SELECT COUNT(*) FROM a;").scalar() == 0
+    assert conn.exec_driver_sql("SELECT COUNT(*) FROM a;").scalar() == 10
+  assert count_rows(database) == 20
+
+def test_reads_cannot_write(database):
+  with pytest.raises(Exception):
+    with database.read_connection() as conn:
+      conn.exec_driver_sql("DELETE FROM a;")
+  assert count_rows(database) == 20
+
+def test_memoised_results_stay_valid_after_dml(database):
+  assert database.execute_query_cached("SELECT COUNT(*) FROM a;")[0][0] == 20
+  database.execute_query(WITH_DELETE)
+  assert database.execute_query("SELECT COUNT(*) FROM a;")[0][0] == 20
+
+def test_duckdb_with_dml_runs_in_the_sandbox(duckdb_database):
+  result = duckdb_database.execute_query(WITH_DELETE)
+  assert isinstance(result, ChangeSet) and result.counts["deleted"] == 10
+  assert count_rows(duckdb_database) == 20
+
+def test_replaced_rows_are_captured(database):
+  result = database.execute_query("INSERT OR REPLACE INTO c VALUES (1, 'x');")
+  assert result.counts == {"inserted": 1, "deleted": 1, "updated": 0}
+  assert ("deleted", 1, "Bob") in result and ("inserted", 1, "x") in result
+  assert count_rows(database, "c") == 20
+
+def test_user_triggers_run_as_they_would_for_the_user(tmp_path, manager):
+  # the trigger fires again for its own UPDATE only with recursive_triggers on, which sqlite leaves off
+  path = str(tmp_path / "triggers.db")
+  make_sqlite_bytes(path)
+  conn = sqlite3.connect(path)
+  conn.execute("CREATE TRIGGER bump AFTER UPDATE OF grp ON a WHEN NEW.grp < 10 BEGIN UPDATE a SET grp = NEW.grp + 1 WHERE id = NEW.id; END;")
+  conn.commit()
+  conn.close()
+  with open(path, "rb") as db_file:
+    database = SQLiteUserDatabase(io.BytesIO(db_file.read()), manager=manager, cache=DiskCache(str(tmp_path / "introspection.db")))
+  result = database.execute_query("UPDATE a SET grp = 5 WHERE id = 1;")
+  assert result.counts["updated"] == 2 and ("after", 1, 6, "Bob") in result
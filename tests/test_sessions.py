@@ -0,0 +1,79 @@
+import gc
+import io
+import os
+import threading
+import time
+
+from sessions import SessionDatabaseManager, SessionEnd
+
+
+def test_session_end_releases_when_collected(manager, db_bytes):
+  session_db = manager.open("ended", io.BytesIO(db_bytes))
+  session_db.engine.connect().close()
+  session_end = SessionEnd("ended", manager.release)
+  assert manager.get("ended") is not None
+  del session_end
+  gc.collect()
+  assert manager.get("ended") is None
+
+def test_release_removes_spooled_file(manager, db_bytes):
+  manager.large_file_threshold = 1
+  session_db = manager.open("spooled", io.BytesIO(db_bytes))
+  assert os.path.exists(session_db.path)
+  manager.release("spooled")
+  assert not os.path.exists(session_db.path)
+
+def test_sweep_removes_only_stale_files(tmp_path, db_bytes):
+  spool_dir = tmp_path / "spool"
+  spool_dir.mkdir()
+  manager = SessionDatabaseManager(spool_dir=str(spool_dir), large_file_threshold=1, stale_spool_seconds=60)
+  manager.open("live", io.BytesIO(db_bytes))
+  old = time.time() - 120
+  for name in ("crashed.db", "crashed.duckdb", "crashed-source-0.csv.partial", "live.db"):
+    (spool_dir / name).touch()
+    os.utime(spool_dir / name, (old, old))
+  (spool_dir / "recent.db").touch()
+  manager.sweep_spool_dir()
+  assert sorted(os.listdir(spool_dir)) == ["live.db", "recent.db"]
+  manager.release("live")
+
+def test_configure_sweeps_once(tmp_path):
+  spool_dir = tmp_path / "spool"
+  spool_dir.mkdir()
+  manager = SessionDatabaseManager()
+  stale = spool_dir / "crashed.db"
+  stale.touch()
+  os.utime(stale, (0, 0))
+  manager.configure({'spool_dir': str(spool_dir), 'stale_spool_hours': 1})
+  assert not stale.exists()
+  stale.touch()
+  os.utime(stale, (0, 0))
+  manager.configure({'spool_dir': str(spool_dir), 'stale_spool_hours': 1})
+  assert stale.exists()
+
+def test_evicted_upload_is_spilled_and_reloaded(manager, db_bytes):
+  manager.memory_budget = len(db_bytes) # room for one loaded database
+  first = manager.open("first", io.BytesIO(db_bytes))
+  with first.engine.connect() as conn:
+    assert conn.exec_driver_sql("SELECT COUNT(*) FROM a;").scalar() == 20
+  second = manager.open("second", io.BytesIO(db_bytes))
+  second.engine.connect().close()
+  assert not first.loaded
+  assert first.db_bytes is None and os.path.exists(first.spill_path)
+  assert manager.memory_in_use() <= manager.memory_budget
+  with first.engine.connect() as conn:
+    assert conn.exec_driver_sql("SELECT COUNT(*) FROM a;").scalar() == 20
+  assert first.size == len(db_bytes)
+  manager.release("first")
+  assert not os.path.exists(first.spill_path)
+
+def test_busy_session_is_not_spilled(manager, db_bytes):
+  manager.memory_budget = len(db_bytes)
+  first = manager.open("first", io.BytesIO(db_bytes))
+  first.engine.connect().close()
+  first.unload()
+  with first.lock: # as if mid-query, on another thread
+    spill = threading.Thread(target=manager._spill, args=(first,))
+    spill.start()
+    spill.join()
+  assert first.db_bytes is not None and first.spill_path is None
@@ -0,0 +1,160 @@
+# timing spans around the app's hot paths (queries, llm calls, introspection, grading), written as JSON lines to a
+# rotating file and summarised on the metrics page. while disabled a span is one shared object that does nothing
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import statistics
+import time
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class _NullSpan:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+  def set(self, **attributes):
+    pass
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+  def __init__(self, tracer, name, attributes):
+    self.tracer = tracer
+    self.name = name
+    self.attributes = attributes
+    self.span_id = next(_span_ids)
+    self.parent_id = None
+    self.error = None
+
+  def set(self, **attributes):
+    self.attributes.update(attributes)
+
+  def __enter__(self):
+    parent = _current_span.get()
+    self.parent_id = parent.span_id if parent is not None else None
+    self._token = _current_span.set(self)
+    self.started = time.time()
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, traceback):
+    duration_ms = (time.perf_counter() - self._start) * 1000
+    try:
+      _current_span.reset(self._token)
+    except ValueError: # an async generator closed from another context, the span still counts
+      pass
+    if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+      self.error = exc_type.__name__
+    self.tracer.write({"name": self.name, "span_id": self.span_id, "parent_id": self.parent_id, "start": self.started,
+                       "duration_ms": round(duration_ms, 3), "error": self.error, **self.attributes})
+    return False
+
+
+class Tracer:
+  # spans go to path, which is rotated at max_bytes, keeping backup_count old files (path.1, path.2, ...)
+  def __init__(self, path, enabled=False, max_bytes=10 * 1024 * 1024, backup_count=3):
+    self.path = path
+    self.enabled = enabled
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self._logger = None
+
+  def configure(self, tracing_config):
+    self.enabled = tracing_config.get('enabled', self.enabled)
+    path = tracing_config.get('path', self.path)
+    max_bytes = tracing_config.get('max_mb', self.max_bytes // (1024 * 1024)) * 1024 * 1024
+    backup_count = tracing_config.get('backup_count', self.backup_count)
+    if (path, max_bytes, backup_count) != (self.path, self.max_bytes, self.backup_count):
+      self.path, self.max_bytes, self.backup_count = path, max_bytes, backup_count
+      self._close()
+
+  def span(self, name, **attributes):
+    if not self.enabled:
+      return NULL_SPAN
+    return Span(self, name, attributes)
+
+  def write(self, record):
+    if self._logger is None:
+      self._open()
+    self._logger.info(json.dumps(record, default=str))
+
+  def _open(self):
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    # the logging module's handler already does thread-safe appends and rotation
+    handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backup_count)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger(f"sql_quiz.tracing.{id(self)}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers = [handler]
+    self._logger = logger
+
+  def _close(self):
+    if self._logger is not None:
+      for handler in self._logger.handlers:
+        handler.close()
+      self._logger.handlers = []
+      self._logger = None
+
+  def read_spans(self):
+    # oldest first, across the rotated files
+    spans = []
+    paths = [f"{self.path}.{i}" for i in range(self.backup_count, 0, -1)] + [self.path]
+    for path in paths:
+      if not os.path.exists(path):
+        continue
+      with open(path) as trace_file:
+        for line in trace_file:
+          try:
+            spans.append(json.loads(line))
+          except json.JSONDecodeError: # a line cut short by a crash
+            continue
+    return spans
+
+
+def percentile(values, fraction):
+  if len(values) == 1:
+    return values[0]
+  return statistics.quantiles(values, n=100, method="inclusive")[round(fraction * 100) - 1]
+
+def summarise_latencies(spans):
+  # span name -> count, error rate, p50/p95/max milliseconds
+  by_name = {}
+  for span in spans:
+    by_name.setdefault(span["name"], []).append(span)
+  summary = []
+  for name, named_spans in sorted(by_name.items()):
+    durations = sorted(span["duration_ms"] for span in named_spans)
+    summary.append({"span": name, "count": len(named_spans),
+                    "error_rate": sum(1 for span in named_spans if span.get("error")) / len(named_spans),
+                    "p50_ms": round(percentile(durations, 0.5), 3), "p95_ms": round(percentile(durations, 0.95), 3), "max_ms": durations[-1]})
+  return summary
+
+def summarise_token_spend(spans):
+  # (model, provider) -> llm requests, retries, prompt and completion tokens
+  by_model = {}
+  for span in spans:
+    if "prompt_tokens" not in span:
+      continue
+    totals = by_model.setdefault((span.get("model"), span.get("provider")),
+                                 {"requests": 0, "retries": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    totals["requests"] += 1
+    totals["retries"] += 1 if span.get("retry") else 0
+    totals["errors"] += 1 if span.get("error") else 0
+    totals["prompt_tokens"] += span.get("prompt_tokens") or 0
+    totals["completion_tokens"] += span.get("completion_tokens") or 0
+  return [{"model": model, "provider": provider, **totals} for (model, provider), totals in sorted(by_model.items(), key=str)]
+
+
+tracer = Tracer("cache/traces.jsonl") # one per process, configured from app_config.toml [tracing]
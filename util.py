@@ -1,5 +1,8 @@
 import os
 import tomllib
+import hashlib
+import json
+import functools
 
 def remove_file_if_exists(path):
   try:
@@ -14,6 +17,22 @@ def create_temp_folder():
     pass
 
 def load_app_config(path="app_config.toml"):
+  # parsed once, and again only if the file changes, rather than on every streamlit rerun
+  return _load_app_config(path, os.path.getmtime(path))
+
+@functools.lru_cache(maxsize=4)
+def _load_app_config(path, modified_time):
   with open(path, "rb") as config_file:
     config = tomllib.load(config_file)
-  return config
\ No newline at end of file
+  return config
+
+def hash_config(config):
+  return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+def hash_text(text):
+  return hashlib.sha256(text.encode()).hexdigest() if text else ""
+
+def hash_file_bytes(file_bytes):
+  # sha-256 of an upload (BytesIO / streamlit UploadedFile), read through its buffer rather than copied out
+  with file_bytes.getbuffer() as buffer:
+    return hashlib.sha256(buffer).hexdigest()